@@ -6,6 +6,7 @@ from api.schemas.schemas import AccountData
 # Import services
 import services.email_service as email_service
 import services.queue_service as queue_service
+import services.idle_service as idle_service
 
 
 router = APIRouter()
@@ -49,6 +50,7 @@ def create_account_route(account_data: AccountData):
     port = account_data.port
     interval = account_data.interval
     selected_inboxes = account_data.selected_inboxes
+    push_enabled = account_data.push_enabled
 
     if not all([email, password, protocol.lower(), server, port]):
         logging.error("Missing required fields")
@@ -62,11 +64,12 @@ def create_account_route(account_data: AccountData):
         "port": port,
         "selected_inboxes": selected_inboxes,
         "interval": interval,
+        "push_enabled": push_enabled,
     }
 
     logging.debug(f"Queueing account creation for {email}")
     task = queue_service.Task.create_task(queue_service.ACCOUNT_CREATION, task_data)
-    queue_service.task_queue.put(task)
+    queue_service.schedule_task(task)
 
     return {"message": "Account creation queued successfully"}
 
@@ -92,6 +95,7 @@ def get_accounts_route():
                 account.selected_inboxes.split(",") if account.selected_inboxes else []
             ),
             "interval": account.update_interval,
+            "push_enabled": bool(account.push_enabled),
         }
         for account in accounts
     ]
@@ -109,12 +113,14 @@ def update_account_route(account_id: int, account_data: AccountData):
     protocol = account_data.protocol
     server = account_data.server
     port = account_data.port
+    interval = account_data.interval
     selected_inboxes = account_data.selected_inboxes
+    push_enabled = account_data.push_enabled
 
     available_inboxes = email_service.get_available_inboxes_from_db(account_id)
     logging.debug(f"Available inboxes: {available_inboxes}")
 
-    email_service.update_account(
+    updated = email_service.update_account(
         account_id,
         email,
         password,
@@ -123,7 +129,14 @@ def update_account_route(account_id: int, account_data: AccountData):
         port,
         available_inboxes,
         selected_inboxes,
+        interval,
+        push_enabled,
     )
+    if not updated:
+        return {"error": "Account not found"}
+
+    # Watchers keep the settings they were started with
+    queue_service.refresh_idle_watchers(account_id)
 
     logging.debug(f"Account updated successfully")
 
@@ -132,6 +145,7 @@ def update_account_route(account_id: int, account_data: AccountData):
 
 @router.delete("/delete_account/{account_id}", status_code=200)
 def delete_account_route(account_id: int):
+    idle_service.stop_idle_watchers(account_id)
     email_service.delete_account(account_id)
     logging.debug(f"Account {account_id} deleted successfully")
     return {"message": "Account deleted successfully"}
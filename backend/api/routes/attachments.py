@@ -1,17 +1,20 @@
 import logging
-from fastapi import APIRouter, Response
+from typing import Optional
+from fastapi import APIRouter, Header
 import services.attachment_service as attachment_service
 
 router = APIRouter()
 
 
 @router.get("/download_attachment/{attachment_id}")
-def download_attachment(attachment_id: int):
+def download_attachment(attachment_id: int, range: Optional[str] = Header(None)):
     logging.debug(f"Received request to download attachment {attachment_id}")
-    return attachment_service.download_attachment(attachment_id)
+    return attachment_service.download_attachment(attachment_id, range_header=range)
 
 
-@router.get("/get_inline_image/{cid}")
-def get_inline_image(cid: str):
-    logging.debug(f"Received request to get inline image {cid}")
-    return attachment_service.get_inline_image(cid)
+@router.get("/get_inline_image/{email_id}/{cid}")
+def get_inline_image(
+    email_id: int, cid: str, if_none_match: Optional[str] = Header(None)
+):
+    logging.debug(f"Received request to get inline image {cid} of email {email_id}")
+    return attachment_service.get_inline_image(email_id, cid, if_none_match=if_none_match)
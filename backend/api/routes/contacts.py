@@ -0,0 +1,31 @@
+# contacts.py contains the FastAPI router for the correspondents of the archive. It includes endpoints to find contacts by address prefix, get the email counts of one contact and list the emails exchanged with it.
+import logging
+from typing import Optional
+from fastapi import APIRouter
+import services.address_service as address_service
+import services.email_service as email_service
+
+router = APIRouter()
+
+
+@router.get("/search")
+def search_contacts(q: str, limit: int = 10):
+    logging.debug(f"Received request to find contacts starting with {q}")
+    return address_service.find_contacts(q, limit)
+
+
+@router.get("/{address}")
+def get_contact(address: str):
+    logging.debug(f"Received request to get contact {address}")
+    return address_service.get_contact(address)
+
+
+@router.get("/{address}/emails")
+def get_contact_emails(
+    address: str,
+    role: Optional[str] = None,
+    cursor: Optional[str] = None,
+    per_page: int = 10,
+):
+    logging.debug(f"Received request to get the emails of contact {address}")
+    return email_service.get_correspondent_emails(address, role, cursor, per_page)
@@ -1,40 +1,89 @@
+import json
 import logging
+from typing import Optional
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
 from api.schemas.schemas import SearchQuery
 import services.email_service as email_service
 import services.search_service as search_service
+import services.suggest_service as suggest_service
 
 # Create a new FastAPI router
 router = APIRouter()
 
+# Streamed results are sent in chunks of this many lines
+NDJSON_CHUNK_LINES = 100
+
+
+def ndjson_response(items):
+    """
+    Stream items as newline-delimited JSON, one object per line.
+    """
+
+    def lines():
+        chunk = []
+        for item in items:
+            chunk.append(json.dumps(item, default=str) + "\n")
+            if len(chunk) >= NDJSON_CHUNK_LINES:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def search_result(email):
+    return {
+        "id": email["id"],
+        "account_id": email["account_id"],
+        "subject": email["subject"],
+        "sender": email["sender"],
+        "recipients": email["recipients"],
+        "date": str(email["date"]),
+        "snippet": email["snippet"],
+        "unique_id": email["fingerprint"].hex(),
+    }
+
 
 @router.get("/emails")
-def get_emails():
+def get_emails(
+    page: int = 1,
+    per_page: int = 10,
+    sort_by: str = "date",
+    sort_order: str = "desc",
+    cursor: Optional[str] = None,
+    stream: bool = False,
+):
     logging.debug("Received request to get emails")
-    return email_service.get_emails()
+    if stream:
+        # All emails from the cursor on, one JSON object per line
+        return ndjson_response(email_service.iter_emails(sort_by, sort_order, cursor))
+    return email_service.get_emails(page, per_page, sort_by, sort_order, cursor)
 
 
 @router.post("/search_emails")
 def search_emails(search_query: SearchQuery):
-    emails, search_time = search_service.search_emails(search_query.query)
-
-    email_data = [
-        {
-            "id": email[0],
-            "account_id": email[1],
-            "subject": email[2],
-            "sender": email[3],
-            "recipients": email[4],
-            "date": email[5],
-            "body": email[6],
-            "unique_id": email[7],
-        }
-        for email in emails
-    ]
+    if search_query.stream:
+        # All results from the cursor on, one JSON object per line
+        results = search_service.iter_search_results(search_query.query, search_query.cursor)
+        return ndjson_response(search_result(email) for email in results)
+
+    emails, search_time, next_cursor = search_service.search_emails(
+        search_query.query, search_query.cursor, search_query.limit
+    )
+
+    email_data = [search_result(email) for email in emails]
 
     logging.debug(f"Found {len(email_data)} emails")
 
-    return {"emails": email_data, "search_time": search_time}
+    return {"emails": email_data, "search_time": search_time, "next_cursor": next_cursor}
+
+
+@router.get("/suggest")
+def suggest(q: str, limit: int = 10):
+    logging.debug(f"Received request for suggestions starting with {q}")
+    return suggest_service.suggest(q, limit)
 
 
 @router.get("/email_details/{email_id}")
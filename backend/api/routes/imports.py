@@ -0,0 +1,47 @@
+# Routes are responsible only responsible for handling requests, validating input, and returning responses. They should not contain any business logic. The business logic should be implemented in services.
+
+# imports.py is a file that defines the API endpoints for importing email archives from local disk. The import_archive endpoint queues an import of an mbox file, Maildir folder or .eml tree below the configured import directory. The import_status endpoint reports the progress and throughput of an import job. The refresh_caches endpoint makes the server pick up emails imported with import_archive.py, which writes to the database from another process.
+import logging
+
+from fastapi import APIRouter
+from api.schemas.schemas import ImportRequest
+import services.import_service as import_service
+import services.queue_service as queue_service
+
+router = APIRouter()
+
+
+@router.post("/import_archive")
+def import_archive(import_request: ImportRequest):
+    logging.debug(f"Received request to import {import_request.path}")
+
+    path = import_service.resolve_import_path(import_request.path)
+    if path is None:
+        logging.error(f"Import path {import_request.path} is outside the import directory")
+        return {"error": "Invalid import path"}
+
+    job_id = import_service.create_import_job(import_request.account_id, path)
+    task = queue_service.Task.create_task(
+        queue_service.BULK_IMPORT,
+        {"job_id": job_id, "account_id": import_request.account_id},
+    )
+    queue_service.schedule_task(task)
+
+    return {"message": "Import queued successfully", "job_id": job_id}
+
+
+@router.get("/import_status/{job_id}")
+def import_status(job_id: str):
+    logging.debug(f"Received request to get status of import job {job_id}")
+    job = import_service.get_import_job(job_id)
+    if job:
+        return job
+    else:
+        return {"error": "Import job not found"}
+
+
+@router.post("/refresh_caches")
+def refresh_caches():
+    logging.debug("Received request to refresh the caches after an external import")
+    queue_service.refresh_archive_caches()
+    return {"message": "Caches refreshed, the suggestion index is being rebuilt"}
@@ -3,20 +3,16 @@ import logging
 
 from fastapi import APIRouter
 from api.schemas.schemas import SearchQuery
-from dateutil import parser
 import os
 from config.config import config
 import services.statistics_service as statistics_service
+import services.queue_service as queue_service
+import services.search_service as search_service
 
 router = APIRouter()
 
 
 # Utility Endpoints
-def format_date(date_str):
-    date_obj = parser.parse(date_str)
-    return date_obj.strftime("%a, %d %b %Y %H:%M:%S")
-
-
 @router.get("/fernet_key")
 def get_fernet_key():
     logging.debug("Received request to get Fernet key")
@@ -28,3 +24,21 @@ def get_fernet_key():
 def get_stats():
     logging.debug("Received request to get statistics")
     return statistics_service.email_statistics()
+
+
+@router.get("/sender_stats")
+def get_sender_stats(limit: int = 20):
+    logging.debug("Received request to get sender statistics")
+    return statistics_service.sender_statistics(limit)
+
+
+@router.get("/queue_stats")
+def get_queue_stats():
+    logging.debug("Received request to get queue statistics")
+    return queue_service.get_task_stats()
+
+
+@router.get("/search_cache_stats")
+def get_search_cache_stats():
+    logging.debug("Received request to get search cache statistics")
+    return search_service.get_search_cache_stats()
@@ -14,9 +14,23 @@ class AccountData(BaseModel):
     port: int
     interval: int = 300
     selected_inboxes: Optional[list] = None
+    push_enabled: bool = False
+
+class ImportRequest(BaseModel):
+    """
+    Represents a request to import an mbox/Maildir/.eml archive from disk.
+    The path is relative to the configured import directory.
+    """
+    account_id: int
+    path: str
 
 class SearchQuery(BaseModel):
     """
-    Represents a search query for emails.
+    Represents a search query for emails. cursor is the next_cursor of the
+    previous page of results. With stream, all results are returned as
+    newline-delimited JSON instead of one page.
     """
-    query: str
\ No newline at end of file
+    query: str
+    cursor: Optional[str] = None
+    limit: Optional[int] = None
+    stream: Optional[bool] = False
\ No newline at end of file
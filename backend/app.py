@@ -22,8 +22,10 @@ import uvicorn
 # Import routers for different API endpoints
 from api.routes.accounts import router as accounts_router
 from api.routes.attachments import router as attachments_router
+from api.routes.contacts import router as contacts_router
 from api.routes.emails import router as emails_router
 from api.routes.exports import router as exports_router
+from api.routes.imports import router as imports_router
 from api.routes.utilities import router as utilities_router
 
 # Initialize the FastAPI application
@@ -32,10 +34,20 @@ app = FastAPI()
 # Include routers for different API endpoints
 app.include_router(accounts_router, prefix="/accounts")
 app.include_router(attachments_router, prefix="/attachments")
+app.include_router(contacts_router, prefix="/contacts")
 app.include_router(emails_router, prefix="/emails")
 app.include_router(exports_router, prefix="/exports")
+app.include_router(imports_router, prefix="/imports")
 app.include_router(utilities_router, prefix="/utilities")
 
+import services.queue_service as queue_service
+
+
+# Start the task queue once the application is up
+@app.on_event("startup")
+def start_task_queue():
+    queue_service.start_task_worker()
+
 
 # Set up CORS middleware to allow requests from any origin
 
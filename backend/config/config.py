@@ -8,6 +8,59 @@ class Config:
     DATABASE_URL = os.getenv("DATABASE_URL")
     DATBASE_DIR = os.getenv("DATABASE_DIR")
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    # IMAP fetches are split into batches bounded by message count and total bytes
+    FETCH_BATCH_SIZE = int(os.getenv("FETCH_BATCH_SIZE", 200))
+    FETCH_BATCH_BYTES = int(os.getenv("FETCH_BATCH_BYTES", 25 * 1024 * 1024))
+    # Number of UIDs per header request used to skip already archived emails
+    FETCH_HEADER_CHUNK = int(os.getenv("FETCH_HEADER_CHUNK", 1000))
+    # Number of accounts synced concurrently and IMAP/POP3 connections allowed per server
+    SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", 4))
+    MAX_CONNECTIONS_PER_HOST = int(os.getenv("MAX_CONNECTIONS_PER_HOST", 2))
+    # IMAP IDLE push mode: seconds before an IDLE connection is renewed and reconnect backoff
+    IDLE_RENEW_INTERVAL = int(os.getenv("IDLE_RENEW_INTERVAL", 25 * 60))
+    IDLE_BACKOFF_BASE = int(os.getenv("IDLE_BACKOFF_BASE", 5))
+    IDLE_BACKOFF_MAX = int(os.getenv("IDLE_BACKOFF_MAX", 600))
+    # IMAP IDLE connections allowed per server across all accounts and inboxes. They are held
+    # open and counted apart from MAX_CONNECTIONS_PER_HOST, so retrievals are never starved
+    MAX_IDLE_CONNECTIONS_PER_HOST = int(os.getenv("MAX_IDLE_CONNECTIONS_PER_HOST", 10))
+    # POP3 messages are retrieved in small batches, messages above the size limit are retrieved last
+    POP3_BATCH_SIZE = int(os.getenv("POP3_BATCH_SIZE", 20))
+    POP3_DEFER_MESSAGE_BYTES = int(os.getenv("POP3_DEFER_MESSAGE_BYTES", 10 * 1024 * 1024))
+    # Directory that API-triggered imports of mbox/Maildir/.eml archives are restricted to
+    IMPORT_DIR = os.getenv("IMPORT_DIR", "imports")
+    # Root of the content-addressed attachment store
+    ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", "attachments")
+    # Stored files written or reused within this many seconds are never removed as unreferenced
+    BLOB_GRACE_PERIOD = int(os.getenv("BLOB_GRACE_PERIOD", 3600))
+    # Seconds between sweeps removing stored files that no attachment refers to
+    BLOB_SWEEP_INTERVAL = int(os.getenv("BLOB_SWEEP_INTERVAL", 6 * 3600))
+    IMPORT_REPORT_EVERY = int(os.getenv("IMPORT_REPORT_EVERY", 1000))
+    # Seconds the status of a finished import job stays available
+    IMPORT_JOB_TTL = int(os.getenv("IMPORT_JOB_TTL", 24 * 3600))
+    # Number of emails written per database transaction during ingestion
+    INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", 100))
+    # Processes parsing emails and emails buffered between fetching, parsing and writing
+    PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", os.cpu_count() or 2))
+    PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 64))
+    # Number of emails updated per transaction by the metadata backfill
+    BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", 500))
+    # Largest page of the email list and seconds the total email count is cached
+    MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 100))
+    EMAIL_COUNT_TTL = int(os.getenv("EMAIL_COUNT_TTL", 60))
+    # Default number of search results per page
+    SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 20))
+    # Rows fetched per round trip when streaming email lists and search results
+    STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 500))
+    # Subject words are suggested once this many emails contain them
+    SUGGEST_MIN_SUBJECT_COUNT = int(os.getenv("SUGGEST_MIN_SUBJECT_COUNT", 3))
+    # Index keys examined per suggestion request, bounding its latency
+    SUGGEST_SCAN_LIMIT = int(os.getenv("SUGGEST_SCAN_LIMIT", 1000))
+    # New suggestion keys are merged into the main index in the background once this many have been added
+    SUGGEST_DELTA_LIMIT = int(os.getenv("SUGGEST_DELTA_LIMIT", 20000))
+    # Seconds before a failed build of the suggestion index is retried
+    SUGGEST_BUILD_RETRY_DELAY = int(os.getenv("SUGGEST_BUILD_RETRY_DELAY", 300))
+    # Memory in bytes the search cache may use for result ID lists
+    SEARCH_CACHE_BYTES = int(os.getenv("SEARCH_CACHE_BYTES", 16 * 1024 * 1024))
     # Add more configuration variables as needed
 
 config = Config()
\ No newline at end of file
@@ -0,0 +1,62 @@
+# import_archive.py imports mbox files, Maildir folders and .eml files from local disk into an existing account.
+#
+# Usage: python import_archive.py --account-id 1 /path/to/archive [--server-url http://localhost:5050]
+#
+# The import writes to the database directly. A running server keeps cached search results, its dedup filter and
+# its suggestion index in memory, so it does not see the imported emails until it is restarted or asked to refresh
+# them through POST /imports/refresh_caches, which --server-url does once the import has finished.
+
+import argparse
+import logging
+import urllib.request
+from config.logging_config import configure_logging
+from config.config import config
+
+configure_logging(config.LOG_LEVEL)
+
+from models.database import initialize_database
+
+initialize_database()
+
+from services.import_service import import_archive
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import mbox files, Maildir folders and .eml files into an account."
+    )
+    parser.add_argument("path", help="mbox file, Maildir folder or directory tree to import")
+    parser.add_argument(
+        "--account-id", type=int, required=True, help="ID of the account to import into"
+    )
+    parser.add_argument(
+        "--server-url", help="URL of a running server to refresh its caches after the import"
+    )
+    args = parser.parse_args()
+
+    try:
+        stats = import_archive(args.account_id, args.path)
+    except ValueError as e:
+        logging.error(str(e))
+        raise SystemExit(1)
+
+    print(
+        f"Imported {stats['inserted']} of {stats['found']} messages "
+        f"({stats['skipped']} duplicates, {stats['failed']} failed) "
+        f"in {stats['elapsed_seconds']:.1f}s, {stats['messages_per_second']:.0f} messages/s."
+    )
+
+    if args.server_url:
+        request = urllib.request.Request(
+            args.server_url.rstrip("/") + "/imports/refresh_caches", method="POST"
+        )
+        try:
+            urllib.request.urlopen(request, timeout=30).close()
+            print("Refreshed the caches of the server.")
+        except OSError as e:
+            logging.error(f"Refreshing the caches of the server failed: {str(e)}")
+    elif stats["inserted"]:
+        print(
+            "Restart a running server or POST /imports/refresh_caches, "
+            "so its search results and suggestions include the imported emails."
+        )
@@ -2,7 +2,9 @@ import os
 import logging
 from config.config import config
 from models.models import Base
-from sqlalchemy import create_engine, text
+from services.search_backends import get_search_backend
+from utils.attachment_store import sniff_media_type, store_blob
+from sqlalchemy import LargeBinary, create_engine, inspect, literal, text
 from sqlalchemy.orm import sessionmaker
 
 # Create a database engine and session
@@ -17,30 +19,165 @@ def get_db():
     finally:
         db.close()
 
-def initialize_database():
-    if not os.path.exists(config.DATABASE_URL):
-        logging.info("Creating data directory")
-        if not os.path.exists(config.DATBASE_DIR):
-            os.makedirs(config.DATBASE_DIR)
+def _column_default(column, dialect):
+    # Scalar Python-side defaults become server defaults of added columns,
+    # so existing rows get the same value as new ones
+    default = column.default
+    if default is None or not default.is_scalar:
+        return ""
+    value = literal(default.arg, column.type).compile(
+        dialect=dialect, compile_kwargs={"literal_binds": True}
+    )
+    return f" DEFAULT {value}"
 
-        logging.debug("Database does not exist. Creating database..")
 
-        # Create tables based on the defined models
-        Base.metadata.create_all(bind=engine)
-
-        # Create full-text search index
-        with engine.connect() as connection:
+def _add_missing_columns(connection):
+    """
+    Add the mapped columns that an existing table lacks. create_all only
+    creates missing tables, so columns added to a model since the database
+    was created are added here.
+    """
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            logging.info(f"Adding column {table.name}.{column.name}.")
             connection.execute(
                 text(
-                    'CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(subject, sender, recipients, body, content="emails", content_rowid="id")'
+                    f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} "
+                    f"{column.type.compile(dialect=connection.dialect)}"
+                    f"{_column_default(column, connection.dialect)}"
                 )
             )
+
+
+def _convert_hex_fingerprints(connection, batch_size=10000):
+    """
+    Fingerprints were stored as hex strings before they became raw SHA-256
+    digests. SQLite keeps the strings in the column as they are, so they are
+    rewritten in ID order; PostgreSQL converts the column type.
+    """
+    if connection.dialect.name == "postgresql":
+        column = next(
+            column
+            for column in inspect(connection).get_columns("emails")
+            if column["name"] == "fingerprint"
+        )
+        if not isinstance(column["type"], LargeBinary):
+            logging.info("Converting the email fingerprints to binary digests.")
             connection.execute(
                 text(
-                    "INSERT INTO emails_fts(rowid, subject, sender, recipients, body) SELECT id, subject, sender, recipients, body FROM emails"
+                    "ALTER TABLE emails ALTER COLUMN fingerprint TYPE bytea USING decode(fingerprint, 'hex')"
                 )
             )
+        return
+
+    converted = 0
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            text(
+                "SELECT id, fingerprint FROM emails WHERE id > :last_id AND typeof(fingerprint) = 'text' ORDER BY id LIMIT :limit"
+            ),
+            {"last_id": last_id, "limit": batch_size},
+        ).all()
+        if not rows:
+            break
+        connection.execute(
+            text("UPDATE emails SET fingerprint = :fingerprint WHERE id = :id"),
+            [{"id": id, "fingerprint": bytes.fromhex(fingerprint)} for id, fingerprint in rows],
+        )
+        converted += len(rows)
+        last_id = rows[-1].id
+    if converted:
+        logging.info(f"Converted {converted} email fingerprints to binary digests.")
+
+
+def _move_attachment_content(engine, batch_size=100):
+    """
+    Attachment payloads were kept in attachments.content before they moved
+    to the attachment store. Each payload is written to the store and its
+    hash and size are filled in, one transaction per batch so an interrupted
+    upgrade resumes where it stopped. The column is dropped once it is
+    empty.
+    """
+    columns = {column["name"] for column in inspect(engine).get_columns("attachments")}
+    if "content" not in columns:
+        return
+
+    moved = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT id, content FROM attachments WHERE content IS NOT NULL ORDER BY id LIMIT :limit"
+                ),
+                {"limit": batch_size},
+            ).all()
+            if not rows:
+                break
+            updates = []
+            for id, content in rows:
+                if isinstance(content, str):
+                    content = content.encode()
+                sha256, size = store_blob(content)
+                updates.append(
+                    {
+                        "id": id,
+                        "sha256": sha256,
+                        "size": size,
+                        "content_type": sniff_media_type(content),
+                    }
+                )
+            connection.execute(
+                text(
+                    "UPDATE attachments SET sha256 = :sha256, size = :size, content_type = :content_type, content = NULL WHERE id = :id"
+                ),
+                updates,
+            )
+        moved += len(rows)
+        logging.info(f"Moved {moved} attachments to the attachment store.")
+
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE attachments DROP COLUMN content"))
+    logging.info("Dropped the column attachments.content.")
+
+
+def upgrade_schema(engine):
+    """
+    Bring a database created by an earlier version up to the current
+    models. Every step checks the existing schema first, so this is a no-op
+    on an up-to-date database and can run at every startup.
+    """
+    # Create the tables that do not exist yet, then upgrade the existing ones
+    Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as connection:
+        _add_missing_columns(connection)
+        _convert_hex_fingerprints(connection)
+
+    _move_attachment_content(engine)
+
+    # Indexes are only created by create_all together with their table
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def initialize_database():
+    if not os.path.exists(config.DATBASE_DIR):
+        logging.info("Creating data directory")
+        os.makedirs(config.DATBASE_DIR)
+
+    upgrade_schema(engine)
+
+    logging.info("Database initialized successfully.")
 
-        logging.info("Database initialized successfully.")
-    else:
-        logging.debug("Database already exists.")
+    # Create the full-text search index of the configured database
+    get_search_backend().ensure_index(engine)
@@ -1,8 +1,8 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, BigInteger, Boolean, String, DateTime, ForeignKey, Text, LargeBinary
+from sqlalchemy import UniqueConstraint
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Index, func
-from sqlalchemy import event
+from sqlalchemy import Index, text
 
 # Define the base class for all models
 Base = declarative_base()
@@ -20,9 +20,17 @@ class Account(Base):
     available_inboxes = Column(String)
     selected_inboxes = Column(String)
     update_interval = Column(Integer, default=300)
+    push_enabled = Column(Boolean, default=False)  # Use IMAP IDLE in addition to polling
 
-    emails = relationship("Email", back_populates="account") # One account can have many emails
-    email_uids = relationship("EmailUID", back_populates="account") 
+    # Collections are never loaded implicitly; accounts can own millions of
+    # emails. Rows are removed with bulk deletes, see delete_account.
+    emails = relationship("Email", back_populates="account", lazy="raise", passive_deletes=True) # One account can have many emails
+    pop3_seen_messages = relationship(
+        "Pop3SeenMessage", back_populates="account", lazy="raise", passive_deletes=True
+    )
+    sync_states = relationship(
+        "MailboxSyncState", back_populates="account", lazy="raise", passive_deletes=True
+    )
 
     def __repr__(self):
         return f"<Account(id={self.id}, email='{self.email}')>"
@@ -30,23 +38,46 @@ class Account(Base):
 
 class Email(Base):
     __tablename__ = "emails"
+    __table_args__ = (
+        # Keyset pagination of the email list, one index per sortable column
+        Index("ix_emails_date_id", "date", "id"),
+        Index("ix_emails_subject_id", "subject", "id"),
+        Index("ix_emails_sender_id", "sender", "id"),
+        Index("ix_emails_recipients_id", "recipients", "id"),
+        # Search operators: account: and has:attachment, newest first
+        Index("ix_emails_account_date_id", "account_id", "date", "id"),
+        Index(
+            "ix_emails_attachments_date_id",
+            "date",
+            "id",
+            sqlite_where=text("attachment_count > 0"),
+            postgresql_where=text("attachment_count > 0"),
+        ),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     account_id = Column(Integer, ForeignKey("accounts.id"))
     subject = Column(String)
     sender = Column(String)
     recipients = Column(String)
     date = Column(DateTime)
-    body = Column(Text)
-    fingerprint = Column(String, unique=True)
-    __ts_vector__ = Column(
-        Text,
-        nullable=False,
-        default="",
-        index=Index("ix_emails_fts", postgresql_using="gin"),
-    )
+    # Bodies are deferred so metadata queries never read them; load them
+    # explicitly with undefer() where they are needed
+    body = deferred(Column(Text))  # text/plain alternative, derived from the HTML if there is none
+    html_body = deferred(Column(Text))  # text/html alternative
+    # Display form of the body, computed at ingest or on first view
+    content_type = Column(String)
+    rendered_body = deferred(Column(Text))
+    body_size = Column(Integer)
+    # Summary shown in email lists, maintained at ingest
+    snippet = Column(String)
+    size_bytes = Column(Integer)  # Size of the raw message
+    attachment_count = Column(Integer, default=0)  # Attachments excluding inline parts
+    fingerprint = Column(LargeBinary(32), unique=True)  # Raw SHA-256 digest
 
     account = relationship("Account", back_populates="emails")
-    attachments = relationship("Attachment", back_populates="email")
+    attachments = relationship(
+        "Attachment", back_populates="email", lazy="raise", passive_deletes=True
+    )
 
     def to_dict(self):
         return {
@@ -57,50 +88,127 @@ class Email(Base):
             "recipients": self.recipients,
             "date": self.date,
             "body": self.body,
+            "html_body": self.html_body,
         }
 
     def __repr__(self):
         return f"<Email(id={self.id}, subject='{self.subject}')>"
 
 
-def update_email_ts_vector(target, value, oldvalue, initiator):
-    target.__ts_vector__ = func.to_tsvector(value)
-
-
-event.listen(Email.body, "set", update_email_ts_vector)
-
-
 class Attachment(Base):
     __tablename__ = "attachments"
+    __table_args__ = (
+        # Inline images are looked up by Content-ID within their email
+        Index("ix_attachments_email_cid", "email_id", "cid"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     email_id = Column(Integer, ForeignKey("emails.id"))
     filename = Column(String)
-    content = Column(String)
+    # The content is kept in the on-disk attachment store, see utils/attachment_store.py
+    sha256 = Column(String(64), index=True)
+    size = Column(Integer)
+    content_type = Column(String)
     cid = Column(String)
+    inline = Column(Boolean, default=False)  # Inline part referenced from the HTML body
 
-    email = relationship("Email", back_populates="attachments")
+    email = relationship("Email", back_populates="attachments", lazy="raise")
 
     def to_dict(self):
         return {
             "id": self.id,
             "email_id": self.email_id,
             "filename": self.filename,
+            "sha256": self.sha256,
+            "size": self.size,
+            "content_type": self.content_type,
             "cid": self.cid,
+            "inline": self.inline,
         }
 
     def __repr__(self):
         return f"<Attachment(id={self.id}, filename='{self.filename}')>"
 
 
-class EmailUID(Base):
-    __tablename__ = "email_uids"
+class Address(Base):
+    """
+    Normalized email address seen in the From, To, Cc or Bcc header of an
+    archived email.
+    """
+
+    __tablename__ = "addresses"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    account_id = Column(Integer, ForeignKey("accounts.id"))
-    uid = Column(String)
+    address = Column(String, unique=True, nullable=False)  # Lowercase
+    name = Column(String)  # Display name first seen with the address
+
+    def __repr__(self):
+        return f"<Address(id={self.id}, address='{self.address}')>"
+
+
+class EmailAddress(Base):
+    """
+    Occurrence of an address in an email header. role is "from", "to",
+    "cc" or "bcc".
+    """
+
+    __tablename__ = "email_addresses"
+    __table_args__ = (
+        # Emails exchanged with one address, newest first, and its per-role
+        # counts are read from this index alone
+        Index("ix_email_addresses_address_date", "address_id", "date", "email_id", "role"),
+        # Per-sender statistics
+        Index("ix_email_addresses_role_address", "role", "address_id"),
+    )
+
+    email_id = Column(Integer, ForeignKey("emails.id"), primary_key=True)
+    address_id = Column(Integer, ForeignKey("addresses.id"), primary_key=True)
+    role = Column(String, primary_key=True)
+    date = Column(DateTime)  # Copy of Email.date, for sorting without a join
+
+    def __repr__(self):
+        return f"<EmailAddress(email_id={self.email_id}, address_id={self.address_id}, role='{self.role}')>"
+
+
+class Pop3SeenMessage(Base):
+    """
+    UIDL of a POP3 message that has already been retrieved for an account.
+    """
+
+    __tablename__ = "pop3_seen_messages"
+    __table_args__ = (
+        UniqueConstraint("account_id", "uidl", name="uq_pop3_seen_messages_account_uidl"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    account_id = Column(Integer, ForeignKey("accounts.id"), nullable=False)
+    uidl = Column(String, nullable=False)
+
+    account = relationship("Account", back_populates="pop3_seen_messages")
+
+    def __repr__(self):
+        return f"<Pop3SeenMessage(account_id={self.account_id}, uidl='{self.uidl}')>"
+
+
+class MailboxSyncState(Base):
+    """
+    Incremental IMAP sync checkpoint for one mailbox of an account.
+    """
+
+    __tablename__ = "mailbox_sync_states"
+    __table_args__ = (
+        UniqueConstraint("account_id", "mailbox", name="uq_mailbox_sync_states_account_mailbox"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    account_id = Column(Integer, ForeignKey("accounts.id"), nullable=False)
+    mailbox = Column(String, nullable=False)
+    uidvalidity = Column(BigInteger)
+    last_uid = Column(BigInteger, nullable=False, default=0)
+    highestmodseq = Column(BigInteger)
+    last_synced_at = Column(DateTime)
 
-    account = relationship("Account", back_populates="email_uids")
+    account = relationship("Account", back_populates="sync_states")
 
     def __repr__(self):
-        return f"<EmailUID(id={self.id}, uid='{self.uid}')>"
+        return f"<MailboxSyncState(account_id={self.account_id}, mailbox='{self.mailbox}', last_uid={self.last_uid})>"
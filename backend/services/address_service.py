@@ -0,0 +1,202 @@
+# Services are used to interact with the database, perform business logic and other necesarry core functions. They are to be imported into the routes. Services should not use FastAPI's Request and Response classes. They should only return data to the routes. The routes will then use this data to return a response to the client.
+
+# address_service.py maintains the normalized address index: every address in the From, To, Cc and Bcc headers of an archived email is stored once in addresses and linked to the email with its role in email_addresses. Correspondent lookups and per-contact counts are then index range scans instead of LIKE scans over Email.sender and Email.recipients.
+
+import logging
+from sqlalchemy import exists, func, update
+from sqlalchemy.dialects import postgresql, sqlite
+from models.database import get_db
+from models.models import Address, Email, EmailAddress
+from config.config import config
+from utils.email_utils import parse_addresses
+
+logger = logging.getLogger(__name__)
+
+# Addresses looked up per IN (...) query, below the SQLite parameter limit
+ADDRESS_LOOKUP_CHUNK = 500
+
+# INSERT statements that can skip rows violating a unique constraint
+INSERT_IGNORING_CONFLICTS = {
+    "sqlite": sqlite.insert,
+    "postgresql": postgresql.insert,
+}
+
+# Roles of the addresses that received an email
+RECIPIENT_ROLES = ("to", "cc", "bcc")
+
+
+def _known_addresses(db, addresses):
+    known = {}
+    addresses = list(addresses)
+    for start in range(0, len(addresses), ADDRESS_LOOKUP_CHUNK):
+        chunk = addresses[start : start + ADDRESS_LOOKUP_CHUNK]
+        known.update(
+            (address, (address_id, name))
+            for address_id, address, name in db.query(
+                Address.id, Address.address, Address.name
+            ).filter(Address.address.in_(chunk))
+        )
+    return known
+
+
+def store_email_addresses(db, occurrences):
+    """
+    Link emails to their addresses, creating the addresses that are new.
+    occurrences are (email_id, date, role, display name, address) tuples
+    with lowercase addresses. The caller commits.
+    """
+    if not occurrences:
+        return
+
+    names = {}
+    for _, _, _, name, address in occurrences:
+        if names.get(address) is None:
+            names[address] = name
+
+    known = _known_addresses(db, names)
+    missing = [address for address in names if address not in known]
+    if missing:
+        # Other writers may add the same address concurrently
+        insert = INSERT_IGNORING_CONFLICTS[db.get_bind().dialect.name]
+        db.execute(
+            insert(Address).on_conflict_do_nothing(index_elements=["address"]),
+            [{"address": address, "name": names[address]} for address in missing],
+        )
+        known.update(_known_addresses(db, missing))
+
+    # Addresses first seen without a display name get the first one found
+    named = [
+        {"id": address_id, "name": names[address]}
+        for address, (address_id, name) in known.items()
+        if name is None and names[address]
+    ]
+    if named:
+        db.execute(update(Address), named)
+
+    db.execute(
+        EmailAddress.__table__.insert(),
+        [
+            {
+                "email_id": email_id,
+                "address_id": known[address][0],
+                "role": role,
+                "date": date,
+            }
+            for email_id, date, role, _, address in occurrences
+        ],
+    )
+
+
+def backfill_email_addresses(batch_size=None):
+    """
+    Index the addresses of emails archived before the address index
+    existed. Only Email.sender and Email.recipients were kept for those, so
+    they are indexed with the from and to roles. Returns the number of
+    emails indexed.
+    """
+    batch_size = batch_size or config.BACKFILL_BATCH_SIZE
+    db = next(get_db())
+    indexed = 0
+    last_id = 0
+
+    while True:
+        emails = (
+            db.query(Email.id, Email.date, Email.sender, Email.recipients)
+            .filter(
+                Email.id > last_id,
+                ~exists().where(EmailAddress.email_id == Email.id),
+            )
+            .order_by(Email.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not emails:
+            break
+
+        occurrences = []
+        for email in emails:
+            for role, header in (("from", email.sender), ("to", email.recipients)):
+                seen = set()
+                for name, address in parse_addresses([header]):
+                    if address not in seen:
+                        seen.add(address)
+                        occurrences.append((email.id, email.date, role, name, address))
+        store_email_addresses(db, occurrences)
+        db.commit()
+        indexed += len(emails)
+        last_id = emails[-1].id
+        logging.info(f"Indexed the addresses of {indexed} existing emails.")
+
+    if indexed:
+        logging.info(f"Address backfill completed. {indexed} emails indexed.")
+    return indexed
+
+
+def _contact_data(address, counts):
+    sent = counts.get("from", {})
+    received = [counts[role] for role in RECIPIENT_ROLES if role in counts]
+    first_dates = [row["first"] for row in [sent] + received if row.get("first")]
+    last_dates = [row["last"] for row in [sent] + received if row.get("last")]
+    return {
+        "id": address.id,
+        "address": address.address,
+        "name": address.name,
+        "sent": sent.get("count", 0),
+        "received": sum(row["count"] for row in received),
+        "first_date": str(min(first_dates)) if first_dates else None,
+        "last_date": str(max(last_dates)) if last_dates else None,
+    }
+
+
+def _role_counts(db, address_ids):
+    # One range scan of ix_email_addresses_address_date per address
+    counts = {}
+    rows = (
+        db.query(
+            EmailAddress.address_id,
+            EmailAddress.role,
+            func.count(),
+            func.min(EmailAddress.date),
+            func.max(EmailAddress.date),
+        )
+        .filter(EmailAddress.address_id.in_(address_ids))
+        .group_by(EmailAddress.address_id, EmailAddress.role)
+    )
+    for address_id, role, count, first, last in rows:
+        counts.setdefault(address_id, {})[role] = {"count": count, "first": first, "last": last}
+    return counts
+
+
+def find_contacts(prefix, limit=10):
+    """
+    Return the addresses starting with prefix with the number of emails
+    sent from and received by each.
+    """
+    db = next(get_db())
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return []
+    limit = max(1, min(limit, config.MAX_PAGE_SIZE))
+
+    # A range instead of LIKE, so the unique index on address is used
+    addresses = (
+        db.query(Address)
+        .filter(Address.address >= prefix, Address.address < prefix + "\uffff")
+        .order_by(Address.address)
+        .limit(limit)
+        .all()
+    )
+    counts = _role_counts(db, [address.id for address in addresses])
+    return [_contact_data(address, counts.get(address.id, {})) for address in addresses]
+
+
+def get_address(db, address):
+    return db.query(Address).filter(Address.address == address.strip().lower()).first()
+
+
+def get_contact(address):
+    db = next(get_db())
+    contact = get_address(db, address)
+    if contact is None:
+        return {"error": "Contact not found"}
+    return _contact_data(contact, _role_counts(db, [contact.id]).get(contact.id, {}))
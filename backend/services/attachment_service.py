@@ -1,32 +1,214 @@
 # Services are used to interact with the database, perform business logic and other necesarry core functions. They are to be imported into the routes. Services should not use FastAPI's Request and Response classes. They should only return data to the routes. The routes will then use this data to return a response to the client.
 
 import logging
+import os
+from urllib.parse import quote
 from models.database import get_db
 from models.models import Attachment
-from config import config
-from utils.encryption import cipher_suite
+from utils.attachment_store import (
+    blob_age,
+    blob_path,
+    list_blobs,
+    remove_blob,
+    sniff_media_type,
+)
+from config.config import config
 from fastapi import Response
+from fastapi.responses import FileResponse, StreamingResponse
 
+# Size of the chunks read from disk when streaming a byte range
+RANGE_CHUNK_SIZE = 64 * 1024
 
-def download_attachment(attachment_id: int):
+# Stored files checked per query by the sweep, below the SQLite parameter limit
+SWEEP_CHUNK = 500
+
+# Inline images are addressed by content hash and never change
+INLINE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def parse_range_header(range_header, size):
+    """
+    Return the (start, end) byte positions, end inclusive, requested by a
+    single-range Range header. Returns None if the whole file should be sent,
+    which includes headers with several ranges. Raises ValueError if the
+    range cannot be satisfied.
+    """
+    if not range_header:
+        return None
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+
+    start, _, end = ranges.strip().partition("-")
+    if not (start or end) or not (start or "0").isdigit() or not (end or "0").isdigit():
+        # Malformed ranges are ignored
+        return None
+
+    if not start:
+        # Suffix range: the last N bytes
+        length = int(end)
+        if length == 0 or size == 0:
+            raise ValueError("Range not satisfiable")
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start >= size or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, min(end, size - 1)
+
+
+def content_disposition(disposition, filename):
+    # Same form as FileResponse: names that are not plain ASCII, or contain
+    # characters such as quotes, use the RFC 6266 filename* parameter
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"{disposition}; filename*=utf-8''{quoted}"
+    return f'{disposition}; filename="{filename}"'
+
+
+def iter_file_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_response(
+    path, media_type, filename, disposition="attachment", range_header=None, headers=None
+):
+    """
+    Send a file from the attachment store. Whole files are handed to
+    FileResponse, which lets the server send the file directly where it
+    supports it; a single requested byte range is streamed with 206. Other
+    Range headers are answered with the whole file, streamed as well since
+    recent Starlette versions of FileResponse read the Range header
+    themselves.
+    """
+    size = os.path.getsize(path)
+    headers = dict(headers or {}, **{"Accept-Ranges": "bytes"})
+    try:
+        byte_range = parse_range_header(range_header, size)
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    if byte_range is None and range_header:
+        if filename:
+            headers["Content-Disposition"] = content_disposition(disposition, filename)
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(
+            iter_file_range(path, 0, size - 1), media_type=media_type, headers=headers
+        )
+    if byte_range is None:
+        return FileResponse(
+            path,
+            media_type=media_type,
+            filename=filename or None,
+            content_disposition_type=disposition,
+            headers=headers,
+        )
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    if filename:
+        headers["Content-Disposition"] = content_disposition(disposition, filename)
+    return StreamingResponse(
+        iter_file_range(path, start, end),
+        status_code=206,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+def remove_unreferenced_blobs(db, hashes):
+    """
+    Delete the stored files among hashes that no attachment refers to any
+    more. Call after the attachments have been deleted and committed.
+    Returns the number of files deleted.
+
+    Parse workers store files before the attachment rows referring to them
+    are committed, so files written or reused within BLOB_GRACE_PERIOD
+    seconds are kept; a row that is still in flight cannot be seen here.
+    Those are deleted by sweep_unreferenced_blobs once they are older.
+    """
+    hashes = {sha256 for sha256 in hashes if sha256}
+    if not hashes:
+        return 0
+    referenced = {
+        sha256
+        for (sha256,) in db.query(Attachment.sha256).filter(Attachment.sha256.in_(hashes))
+    }
+    removed = 0
+    for sha256 in hashes - referenced:
+        age = blob_age(sha256)
+        if age is not None and age >= config.BLOB_GRACE_PERIOD:
+            remove_blob(sha256)
+            removed += 1
+    return removed
+
+
+def sweep_unreferenced_blobs():
+    """
+    Delete every stored file that no attachment refers to and that is older
+    than BLOB_GRACE_PERIOD, such as the files kept by remove_unreferenced_blobs
+    because they were too recent. Run periodically by the task queue.
+    Returns the number of files deleted.
+    """
+    db = next(get_db())
+    removed = 0
+    chunk = []
+    for sha256 in list_blobs():
+        chunk.append(sha256)
+        if len(chunk) >= SWEEP_CHUNK:
+            removed += remove_unreferenced_blobs(db, chunk)
+            chunk = []
+    removed += remove_unreferenced_blobs(db, chunk)
+    if removed:
+        logging.info(f"Removed {removed} unreferenced files from the attachment store.")
+    return removed
+
+
+def download_attachment(attachment_id: int, range_header=None):
     logging.debug(f"Received request to download attachment {attachment_id}")
 
     db = next(get_db())
 
     attachment = db.query(Attachment).filter(Attachment.id == attachment_id).first()
 
-    if attachment:
-        filename = attachment.filename
-        content = attachment.content
-        media_type = "application/octet-stream"
-        headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    if attachment and attachment.sha256:
+        path = blob_path(attachment.sha256)
+        if not os.path.exists(path):
+            logging.error(
+                f"Content of attachment {attachment_id} is missing from the attachment store."
+            )
+            return {"error": "Attachment not found"}
 
-        return Response(content=content, media_type=media_type, headers=headers)
+        return file_response(
+            path, "application/octet-stream", attachment.filename, range_header=range_header
+        )
     else:
         return {"error": "Attachment not found"}
 
 
-def get_inline_image(cid: str):
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in if_none_match.split(",")
+    )
+
+
+def get_inline_image(email_id: int, cid: str, if_none_match=None):
     db = next(get_db())
 
     # check if CID has < and >, if not, add them
@@ -35,14 +217,37 @@ def get_inline_image(cid: str):
     if not cid.endswith(">"):
         cid = cid + ">"
 
-    attachment = db.query(Attachment).filter(Attachment.cid == cid).first()
+    attachment = (
+        db.query(Attachment)
+        .filter(Attachment.email_id == email_id, Attachment.cid == cid)
+        .first()
+    )
+
+    if attachment and attachment.sha256:
+        # The content never changes for a given hash, so the hash is a strong
+        # validator and the image can be cached indefinitely
+        etag = f'"{attachment.sha256}"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": INLINE_CACHE_CONTROL,
+            "X-Content-Type-Options": "nosniff",
+            # Keeps scripts in SVG images from running when opened directly
+            "Content-Security-Policy": "default-src 'none'; style-src 'unsafe-inline'; sandbox",
+        }
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+
+        path = blob_path(attachment.sha256)
+        if not os.path.exists(path):
+            return {"error": "Inline image not found"}
 
-    if attachment:
-        content = attachment.content
-        filename = attachment.filename
-        media_type = f"image/{filename.split('.')[-1]}"
-        headers = {"Content-Disposition": f"inline; filename={filename}"}
+        media_type = attachment.content_type
+        if not media_type or media_type == "application/octet-stream":
+            with open(path, "rb") as f:
+                media_type = sniff_media_type(f.read(512))
 
-        return Response(content=content, media_type=media_type, headers=headers)
+        return file_response(
+            path, media_type, attachment.filename, disposition="inline", headers=headers
+        )
     else:
         return {"error": "Inline image not found"}
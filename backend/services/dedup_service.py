@@ -0,0 +1,117 @@
+# Services are used to interact with the database, perform business logic and other necesarry core functions. They are to be imported into the routes. Services should not use FastAPI's Request and Response classes. They should only return data to the routes. The routes will then use this data to return a response to the client.
+
+# dedup_service.py decides which fetched emails are already archived. Fingerprints are unique across accounts, so the fingerprints of all accounts are loaded into one Bloom filter that is shared by every sync and import. New emails are recognized without a database round-trip and only possible duplicates are confirmed with batched IN queries.
+
+import logging
+import math
+import threading
+from sqlalchemy import func
+from models.models import Email
+
+logger = logging.getLogger(__name__)
+
+# Number of fingerprints per IN (...) confirmation query
+CONFIRM_CHUNK_SIZE = 500
+
+
+class FingerprintFilter:
+    """
+    Bloom filter over 32-byte SHA-256 fingerprints.
+
+    The fingerprints are already uniformly distributed, so the bit positions
+    are derived from the digest itself by double hashing instead of hashing
+    it again.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.num_bits = max(
+            int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 64
+        )
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, fingerprint):
+        h1 = int.from_bytes(fingerprint[:8], "little")
+        h2 = int.from_bytes(fingerprint[8:16], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, fingerprint):
+        for position in self._positions(fingerprint):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, fingerprint):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(fingerprint)
+        )
+
+
+class FingerprintDeduplicator:
+    """
+    Tracks the archived fingerprints of all accounts. The filter is sized
+    for the existing fingerprints plus headroom; see get_deduplicator.
+    """
+
+    def __init__(self, db, headroom=10000):
+        existing_count = db.query(func.count(Email.id)).scalar()
+        self.capacity = existing_count + headroom
+        self.count = existing_count
+        self.lock = threading.Lock()
+        self.filter = FingerprintFilter(self.capacity)
+        for (fingerprint,) in db.query(Email.fingerprint).yield_per(10000):
+            if fingerprint:
+                self.filter.add(fingerprint)
+
+        logging.debug(f"Loaded {existing_count} fingerprints into the dedup filter.")
+
+    def find_existing(self, db, fingerprints):
+        """
+        Return the subset of fingerprints that are already archived. Only the
+        fingerprints the filter reports as possibly present are looked up,
+        using the given session so the filter can be shared between threads.
+        """
+        candidates = [fingerprint for fingerprint in fingerprints if fingerprint in self.filter]
+        existing = set()
+        for start in range(0, len(candidates), CONFIRM_CHUNK_SIZE):
+            chunk = candidates[start : start + CONFIRM_CHUNK_SIZE]
+            existing.update(
+                fingerprint
+                for (fingerprint,) in db.query(Email.fingerprint).filter(
+                    Email.fingerprint.in_(chunk)
+                )
+            )
+        return existing
+
+    def add(self, fingerprint):
+        # Setting bits is a read-modify-write of the shared bytearray
+        with self.lock:
+            self.filter.add(fingerprint)
+            self.count += 1
+
+
+_deduplicator = None
+_deduplicator_lock = threading.Lock()
+
+
+def get_deduplicator(db):
+    """
+    Return the deduplicator shared by all syncs and imports. It is loaded on
+    first use and reloaded once more fingerprints have been added than it
+    was sized for, which would raise its false positive rate.
+    """
+    global _deduplicator
+    with _deduplicator_lock:
+        if _deduplicator is None or _deduplicator.count >= _deduplicator.capacity:
+            _deduplicator = FingerprintDeduplicator(db)
+        return _deduplicator
+
+
+def reset_deduplicator():
+    """
+    Reload the fingerprints on next use, e.g. after another process such as
+    import_archive.py has archived emails.
+    """
+    global _deduplicator
+    with _deduplicator_lock:
+        _deduplicator = None
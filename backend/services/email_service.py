@@ -1,26 +1,432 @@
 # Services are used to interact with the database, perform business logic and other necesarry core functions. They are to be imported into the routes. Services should not use FastAPI's Request and Response classes. They should only return data to the routes. The routes will then use this data to return a response to the client.
 
-from models.database import get_db
-from models.models import Account, Email, EmailUID, Attachment
+from models.database import get_db, upgrade_schema
+from models.models import (
+    Account,
+    Email,
+    EmailAddress,
+    Attachment,
+    MailboxSyncState,
+    Pop3SeenMessage,
+)
 import imaplib
 import poplib
 import logging
 import email
-import hashlib
 import time
 import traceback
+from datetime import datetime
 from utils.encryption import cipher_suite
 from jwt import InvalidTokenError
-from utils.email_utils import decode_header, extract_body, decode_filename, parse_date
+from utils.email_utils import (
+    fingerprint_from_headers,
+    format_date,
+    html_to_text,
+    make_snippet,
+    quote_mailbox,
+    render_body,
+)
+from utils.pagination import (
+    decode_cursor,
+    decode_sort_value,
+    encode_cursor,
+    fetch_keyset_page,
+    iter_keyset_rows,
+    order_by_clauses,
+)
+from services.ingest_service import IngestPipeline
+from services.dedup_service import get_deduplicator
+import services.attachment_service as attachment_service
+import services.search_service as search_service
+import services.address_service as address_service
 import re
 from config.config import config
+from sqlalchemy import func, insert, or_
+from sqlalchemy.orm import undefer
 from sqlalchemy.exc import IntegrityError
 
-from api.routes.utilities import format_date
-
 
 logger = logging.getLogger(__name__)
 
+_FETCH_UID_PATTERN = re.compile(rb"UID (\d+)")
+_FETCH_SIZE_PATTERN = re.compile(rb"RFC822\.SIZE (\d+)")
+FINGERPRINT_HEADER_FIELDS = "HEADER.FIELDS (SUBJECT FROM TO DATE MESSAGE-ID)"
+
+
+def _fetch_message_headers(client, uids):
+    """
+    Fetch RFC822.SIZE and the header fields used for the fingerprint for the
+    given UIDs. Returns a list of (uid, size, raw_headers) tuples.
+    """
+    _, data = client.uid(
+        "fetch", ",".join(uids), f"(RFC822.SIZE BODY.PEEK[{FINGERPRINT_HEADER_FIELDS}])"
+    )
+    headers = []
+    current = None
+    for item in data:
+        if isinstance(item, tuple) and len(item) > 1:
+            current = {"meta": item[0], "headers": item[1]}
+            headers.append(current)
+        elif isinstance(item, bytes) and current is not None:
+            # Some servers send UID or RFC822.SIZE after the literal
+            current["meta"] += item
+            current = None
+
+    result = []
+    for entry in headers:
+        uid_match = _FETCH_UID_PATTERN.search(entry["meta"])
+        size_match = _FETCH_SIZE_PATTERN.search(entry["meta"])
+        if uid_match and size_match:
+            result.append(
+                (uid_match.group(1).decode(), int(size_match.group(1)), entry["headers"])
+            )
+    return result
+
+
+def _filter_new_messages(client, db, dedup, account_id, uids, stats, location=""):
+    """
+    First phase of the two-phase fetch: download only the fingerprint headers
+    and sizes of the given UIDs and return (uid, size) tuples for the messages
+    that are not archived yet, so bodies are only downloaded for those. Also
+    returns the UIDs the server sent no parseable UID or size for.
+    """
+    headers = _fetch_message_headers(client, uids)
+    fetched = {uid for uid, _, _ in headers}
+    missing = [uid for uid in uids if uid not in fetched]
+    fingerprints = [
+        (uid, size, fingerprint_from_headers(raw_headers))
+        for uid, size, raw_headers in headers
+    ]
+    existing = dedup.find_existing(
+        db, [fingerprint for _, _, fingerprint in fingerprints]
+    )
+
+    new_messages = []
+    seen = set()
+    for uid, size, fingerprint in fingerprints:
+        if fingerprint in existing or fingerprint in seen:
+            logging.debug(
+                f"Skipping email with UID {uid} for account {account_id}{location} as it already exists."
+            )
+            stats["skipped"] += 1
+            continue
+        seen.add(fingerprint)
+        new_messages.append((uid, size))
+    return new_messages, missing
+
+
+def _plan_fetch_batches(sized_uids, max_count, max_bytes):
+    """
+    Group (uid, size) tuples into batches that hold at most max_count messages
+    and at most max_bytes of message data. A single message larger than
+    max_bytes gets a batch of its own.
+    """
+    batch = []
+    batch_bytes = 0
+    for uid, size in sized_uids:
+        if batch and (len(batch) >= max_count or batch_bytes + size > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(uid)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def _fetch_raw_messages(client, uids):
+    """
+    Fetch the full bodies for a batch of UIDs and return a list of
+    (uid, raw_email) tuples in the order the UIDs were requested.
+    """
+    _, data = client.uid("fetch", ",".join(uids), "(BODY.PEEK[])")
+    raw_by_uid = {}
+    pending_raw = None
+    for item in data:
+        if isinstance(item, tuple) and len(item) > 1:
+            uid_match = _FETCH_UID_PATTERN.search(item[0])
+            if uid_match:
+                raw_by_uid[uid_match.group(1).decode()] = item[1]
+            else:
+                # Some servers send the UID after the literal
+                pending_raw = item[1]
+        elif isinstance(item, bytes) and pending_raw is not None:
+            uid_match = _FETCH_UID_PATTERN.search(item)
+            if uid_match:
+                raw_by_uid[uid_match.group(1).decode()] = pending_raw
+            pending_raw = None
+    return [(uid, raw_by_uid.get(uid)) for uid in uids]
+
+
+def _imap_capabilities(client):
+    # Capabilities can change after authentication, so ask the server again
+    _, data = client.capability()
+    return set(data[0].decode().upper().split())
+
+
+def _parse_status_response(data):
+    """
+    Parse a STATUS response such as b'INBOX (UIDNEXT 5 UIDVALIDITY 1)' into
+    a dictionary of integer values keyed by the status item name.
+    """
+    line = data[0].decode() if isinstance(data[0], bytes) else data[0]
+    items = line[line.rfind("(") + 1 : line.rfind(")")].split()
+    return {items[i].upper(): int(items[i + 1]) for i in range(0, len(items) - 1, 2)}
+
+
+def _get_sync_state(db, account_id, mailbox):
+    state = (
+        db.query(MailboxSyncState)
+        .filter(
+            MailboxSyncState.account_id == account_id,
+            MailboxSyncState.mailbox == mailbox,
+        )
+        .first()
+    )
+    if state is None:
+        state = MailboxSyncState(account_id=account_id, mailbox=mailbox, last_uid=0)
+        db.add(state)
+    return state
+
+
+def _sync_imap_mailbox(
+    client, db, dedup, account_id, inbox, supports_condstore, stats
+):
+    """
+    Archive the messages that arrived in a mailbox since its last checkpoint.
+
+    A STATUS request tells whether anything changed since the previous poll,
+    so unchanged mailboxes are skipped without selecting or searching them.
+    When the UIDVALIDITY of the mailbox changes, the checkpoint is reset and
+    the mailbox is synced again from the start; already archived messages are
+    skipped by their fingerprint.
+    """
+    status_items = (
+        "(UIDVALIDITY UIDNEXT HIGHESTMODSEQ)"
+        if supports_condstore
+        else "(UIDVALIDITY UIDNEXT)"
+    )
+    _, data = client.status(quote_mailbox(inbox), status_items)
+    status = _parse_status_response(data)
+    uidvalidity = status.get("UIDVALIDITY")
+    uidnext = status.get("UIDNEXT")
+    highestmodseq = status.get("HIGHESTMODSEQ")
+
+    state = _get_sync_state(db, account_id, inbox)
+    if state.uidvalidity is not None and state.uidvalidity != uidvalidity:
+        logging.warning(
+            f"UIDVALIDITY of inbox {inbox} for account {account_id} changed from {state.uidvalidity} to {uidvalidity}. Resynchronizing the inbox."
+        )
+        state.last_uid = 0
+        state.highestmodseq = None
+    state.uidvalidity = uidvalidity
+    db.commit()
+
+    unchanged_modseq = (
+        highestmodseq is not None and highestmodseq == state.highestmodseq
+    )
+    no_new_uids = uidnext is not None and uidnext <= state.last_uid + 1
+    if unchanged_modseq or no_new_uids:
+        logging.debug(f"No new emails for account {account_id} in inbox {inbox}.")
+        state.last_synced_at = datetime.utcnow()
+        db.commit()
+        return
+
+    logging.debug(f"Selecting {inbox} for email retrieval.")
+    client.select(quote_mailbox(inbox), readonly=True)
+
+    criteria = f"UID {state.last_uid + 1}:*"
+    if supports_condstore and state.highestmodseq:
+        criteria += f" MODSEQ {state.highestmodseq + 1}"
+    _, data = client.uid("search", None, criteria)
+    # "n:*" always matches the highest UID in the mailbox, even below n
+    email_uids = [
+        uid.decode() for uid in data[0].split() if int(uid) > state.last_uid
+    ]
+
+    stats["found"] += len(email_uids)
+    logging.info(
+        f"Found {len(email_uids)} new emails for account {account_id} in inbox {inbox}."
+    )
+
+    location = f" in inbox {inbox}"
+    pipeline = IngestPipeline(account_id, dedup, stats, location)
+    try:
+        email_uids.sort(key=int)
+        for start in range(0, len(email_uids), config.FETCH_HEADER_CHUNK):
+            chunk = email_uids[start : start + config.FETCH_HEADER_CHUNK]
+
+            # Phase one: headers only, to drop messages that are already archived
+            new_messages, missing = _filter_new_messages(
+                client, db, dedup, account_id, chunk, stats, location
+            )
+            for uid in missing:
+                # Failed, so the checkpoint stays below it and it is retried
+                logging.warning(
+                    f"No size or headers received for email with UID {uid} for account {account_id}{location}."
+                )
+                stats["failed"] += 1
+                pipeline.mark_failed(uid)
+
+            # Phase two: download the new messages in batches bounded by
+            # message count and total size. Parsing and persisting happen in
+            # the pipeline while the next batch downloads
+            batches = _plan_fetch_batches(
+                new_messages, config.FETCH_BATCH_SIZE, config.FETCH_BATCH_BYTES
+            )
+            for batch in batches:
+                for uid, raw_email in _fetch_raw_messages(client, batch):
+                    if not raw_email:
+                        logging.warning(
+                            f"Failed to fetch email with UID {uid} for account {account_id}{location}."
+                        )
+                        stats["failed"] += 1
+                        pipeline.mark_failed(uid)
+                        continue
+                    pipeline.submit(uid, raw_email)
+                pipeline.checkpoint(
+                    _uid_checkpoint(state.id, int(batch[-1]), pipeline.failed_uids)
+                )
+
+            pipeline.checkpoint(
+                _uid_checkpoint(state.id, int(chunk[-1]), pipeline.failed_uids)
+            )
+    finally:
+        pipeline.close()
+
+    db.refresh(state)
+    if pipeline.failed_uids:
+        # Keep the previous HIGHESTMODSEQ so the next poll does not consider
+        # the mailbox unchanged and searches the failed emails again
+        logging.warning(
+            f"{len(pipeline.failed_uids)} emails for account {account_id}{location} failed and will be retried by the next sync."
+        )
+    else:
+        state.highestmodseq = highestmodseq
+    state.last_synced_at = datetime.utcnow()
+    db.commit()
+
+
+def _uid_checkpoint(state_id, uid, failed_uids):
+    """
+    Return a pipeline checkpoint that advances the sync state of a mailbox
+    once every email up to the given UID has been persisted. The checkpoint
+    stays below the lowest UID in failed_uids, so failed emails are fetched
+    again by the next sync.
+    """
+
+    def advance(db):
+        last_uid = uid
+        if failed_uids:
+            last_uid = min(last_uid, min(int(failed) for failed in failed_uids) - 1)
+        db.query(MailboxSyncState).filter(
+            MailboxSyncState.id == state_id, MailboxSyncState.last_uid < last_uid
+        ).update({MailboxSyncState.last_uid: last_uid})
+        db.commit()
+
+    return advance
+
+
+def _pop3_checkpoint(account_id, uidls, failed_uidls):
+    """
+    Return a pipeline checkpoint that records POP3 messages as seen once
+    they have been persisted. Messages in failed_uidls are not recorded, so
+    they are retrieved again by the next sync.
+    """
+
+    def mark_seen(db):
+        seen = [uidl for uidl in uidls if uidl not in failed_uidls]
+        if not seen:
+            return
+        # Overlapping syncs or servers repeating a UIDL may record it twice
+        insert_ignoring_conflicts = address_service.INSERT_IGNORING_CONFLICTS[
+            db.get_bind().dialect.name
+        ]
+        db.execute(
+            insert_ignoring_conflicts(Pop3SeenMessage).on_conflict_do_nothing(
+                index_elements=["account_id", "uidl"]
+            ),
+            [{"account_id": account_id, "uidl": uidl} for uidl in seen],
+        )
+        db.commit()
+
+    return mark_seen
+
+
+def _sync_pop3_mailbox(client, db, dedup, account_id, stats):
+    """
+    Archive the POP3 messages whose UIDL has not been seen yet.
+
+    Messages are identified by their UIDL instead of their message number,
+    which shifts whenever the server deletes mail. They are retrieved one at
+    a time and persisted in small batches. Messages larger than
+    POP3_DEFER_MESSAGE_BYTES (according to LIST) are deferred until all
+    other messages have been persisted.
+    """
+    _, uidl_lines, _ = client.uidl()
+    _, list_lines, _ = client.list()
+    sizes = {}
+    for line in list_lines:
+        number, size = line.split()[:2]
+        sizes[int(number)] = int(size)
+
+    server_messages = []
+    for line in uidl_lines:
+        number, uidl = line.split()[:2]
+        server_messages.append((int(number), uidl.decode()))
+
+    seen = {
+        uidl
+        for (uidl,) in db.query(Pop3SeenMessage.uidl).filter(
+            Pop3SeenMessage.account_id == account_id
+        )
+    }
+    new_messages = [
+        (number, uidl, sizes.get(number, 0))
+        for number, uidl in server_messages
+        if uidl not in seen
+    ]
+    regular = [m for m in new_messages if m[2] <= config.POP3_DEFER_MESSAGE_BYTES]
+    deferred = [m for m in new_messages if m[2] > config.POP3_DEFER_MESSAGE_BYTES]
+
+    stats["found"] += len(new_messages)
+    logging.info(
+        f"Found {len(new_messages)} new emails for account {account_id} ({len(deferred)} deferred for size)."
+    )
+
+    pipeline = IngestPipeline(account_id, dedup, stats)
+    try:
+        for start in range(0, len(regular), config.POP3_BATCH_SIZE):
+            batch = regular[start : start + config.POP3_BATCH_SIZE]
+            for number, uidl, _ in batch:
+                pipeline.submit(uidl, b"\n".join(client.retr(number)[1]))
+            pipeline.checkpoint(
+                _pop3_checkpoint(account_id, [m[1] for m in batch], pipeline.failed_uids)
+            )
+
+        if deferred:
+            # Make sure everything else is archived before the large messages
+            pipeline.join()
+            for number, uidl, size in deferred:
+                logging.info(
+                    f"Retrieving deferred email {uidl} ({size} bytes) for account {account_id}."
+                )
+                pipeline.submit(uidl, b"\n".join(client.retr(number)[1]))
+                pipeline.checkpoint(
+                    _pop3_checkpoint(account_id, [uidl], pipeline.failed_uids)
+                )
+    finally:
+        pipeline.close()
+
+    # Forget UIDLs of messages that were deleted from the server
+    stale = list(seen - {uidl for _, uidl in server_messages})
+    for start in range(0, len(stale), 500):
+        db.query(Pop3SeenMessage).filter(
+            Pop3SeenMessage.account_id == account_id,
+            Pop3SeenMessage.uidl.in_(stale[start : start + 500]),
+        ).delete(synchronize_session=False)
+    db.commit()
+
 
 def fetch_and_archive_emails(
     account_id,
@@ -32,6 +438,7 @@ def fetch_and_archive_emails(
     selected_inboxes=None,
 ):
     start_time = time.time()
+    stats = {"found": 0, "skipped": 0, "failed": 0, "inserted": 0, "attachments": 0}
     try:
         logging.info(f"Started email archiving for account {account_id}.")
         if not isinstance(encrypted_password, bytes):
@@ -43,18 +450,15 @@ def fetch_and_archive_emails(
             return 0
 
         db = next(get_db())
-
-        last_uid = (
-            db.query(EmailUID.uid)
-            .filter(EmailUID.account_id == account_id)
-            .order_by(EmailUID.id.desc())
-            .first()
-        )
+        dedup = get_deduplicator(db)
 
         if protocol == "imap":
             client = imaplib.IMAP4_SSL(server, port)
             client._mode_utf8()
             client.login(username, password)
+            capabilities = _imap_capabilities(client)
+            # QRESYNC implies CONDSTORE
+            supports_condstore = bool({"CONDSTORE", "QRESYNC"} & capabilities)
 
             if selected_inboxes:
                 inboxes = selected_inboxes.split(",")
@@ -64,248 +468,24 @@ def fetch_and_archive_emails(
 
             for inbox in inboxes:
                 if inbox:  # Check if inbox is not empty
-                    logging.debug(f"Selecting {inbox} for email retrieval.")
-
                     # strip the inbox name of any leading or trailing whitespaces
                     inbox = inbox.strip()
-
-                    client.select(inbox, readonly=True)
-                    _, data = client.uid("search", None, "ALL")
-                    all_uids = data[0].split()
-
-                    if last_uid:
-                        _, data = client.uid("search", None, f"UID {last_uid[0]}:*")
-                        email_uids = data[0].split()
-                    else:
-                        email_uids = all_uids
-
-                    if all_uids:
-                        _, data = client.status(inbox, "(UIDNEXT)")
-                        uidnext = data[0].decode().split()[-1].strip(")")
-                    else:
-                        uidnext = None
-
-                    if email_uids:
-                        email_uids_str = [uid.decode() for uid in email_uids]
-                        _, data = client.uid(
-                            "fetch", ",".join(email_uids_str), "(BODY.PEEK[])"
-                        )
-                        raw_emails = []
-                        for item in data:
-                            if isinstance(item, tuple) and len(item) > 1:
-                                raw_emails.append(item[1])
-                    else:
-                        raw_emails = []
-
-                    total_emails = len(email_uids)
-                    logging.info(
-                        f"Found {total_emails} new emails for account {account_id} in inbox {inbox}."
+                    _sync_imap_mailbox(
+                        client, db, dedup, account_id, inbox, supports_condstore, stats
                     )
 
-                    skipped_emails = 0
-                    failed_emails = 0
-                    total_attachments_inserted = 0
-                    new_emails_inserted = 0
-
-                    for uid, raw_email in zip(email_uids, raw_emails):
-                        if not raw_email:
-                            logging.warning(
-                                f"Failed to fetch email with UID {uid.decode() if isinstance(uid, bytes) else uid} for account {account_id} in inbox {inbox}."
-                            )
-                            failed_emails += 1
-                            continue
-
-                        email_message = email.message_from_bytes(raw_email)
-
-                        subject = decode_header(email_message["Subject"])
-                        sender = decode_header(email_message["From"])
-                        recipients = decode_header(email_message["To"])
-                        date = email_message["Date"]
-                        message_id = email_message["Message-ID"]
-
-                        fingerprint_data = (
-                            f"{subject}|{sender}|{recipients}|{date}|{message_id}"
-                        )
-                        fingerprint = hashlib.sha256(
-                            fingerprint_data.encode()
-                        ).hexdigest()
-
-                        existing_email = (
-                            db.query(Email.id)
-                            .filter(Email.fingerprint == fingerprint)
-                            .first()
-                        )
-                        if existing_email:
-                            logging.debug(
-                                f"Skipping email with UID {uid.decode() if isinstance(uid, bytes) else uid} for account {account_id} in inbox {inbox} as it already exists."
-                            )
-                            skipped_emails += 1
-                            continue
-
-                        body = extract_body(email_message)
-                        parsed_date = parse_date(date)
-
-                        email_obj = Email(
-                            account_id=account_id,
-                            subject=subject,
-                            sender=sender,
-                            recipients=recipients,
-                            date=parsed_date,
-                            body=body,
-                            fingerprint=fingerprint,
-                        )
-                        db.add(email_obj)
-                        db.commit()
-
-                        email_id = email_obj.id
-                        new_emails_inserted += 1
-
-                        attachments_inserted = 0
-                        for part in email_message.walk():
-                            if (
-                                part.get_content_maintype() == "multipart"
-                                or part.get("Content-Disposition") is None
-                            ):
-                                continue
-
-                            filename = decode_filename(part.get_filename())
-                            if filename:
-                                content = part.get_payload(decode=True)
-                                cid = part.get(
-                                    "Content-ID", ""
-                                )  # Get the Content-ID (cid) value
-                                attachment = Attachment(
-                                    email_id=email_id,
-                                    filename=filename,
-                                    content=content,
-                                    cid=cid,
-                                )
-                                db.add(attachment)
-                                attachments_inserted += 1
-
-                        db.commit()
-                        logging.info(
-                            f"Inserted email with UID {uid.decode() if isinstance(uid, bytes) else uid} for account {account_id} in inbox {inbox} into the database."
-                        )
-
-                        if attachments_inserted > 0:
-                            logging.info(
-                                f"Saved {attachments_inserted} attachment(s) for email with UID {uid.decode() if isinstance(uid, bytes) else uid} and account {account_id} in inbox {inbox}."
-                            )
-                            total_attachments_inserted += attachments_inserted
-
-                    if uidnext:
-                        email_uid = EmailUID(account_id=account_id, uid=uidnext)
-                        db.merge(email_uid)
-                        db.commit()
-
-            client.close()
+            if client.state == "SELECTED":
+                client.close()
             client.logout()
 
         elif protocol == "pop3":
             client = poplib.POP3_SSL(server, port)
             client.user(username)
             client.pass_(password)
-            if last_uid:
-                num_emails = len(client.list()[1])
-                email_uids = range(last_uid[0] + 1, num_emails + 1)
-            else:
-                num_emails = len(client.list()[1])
-                email_uids = range(1, num_emails + 1)
-
-            raw_emails = [b"\n".join(client.retr(uid)[1]) for uid in email_uids]
-            client.quit()
-
-            total_emails = len(email_uids)
-            logging.info(f"Found {total_emails} new emails for account {account_id}.")
-
-            skipped_emails = 0
-            failed_emails = 0
-            total_attachments_inserted = 0
-            new_emails_inserted = 0
-
-            for uid, raw_email in zip(email_uids, raw_emails):
-                if not raw_email:
-                    logging.warning(
-                        f"Failed to fetch email with UID {uid.decode() if isinstance(uid, bytes) else uid} for account {account_id}."
-                    )
-                    failed_emails += 1
-                    continue
-
-                email_message = email.message_from_bytes(raw_email)
-
-                subject = decode_header(email_message["Subject"])
-                sender = decode_header(email_message["From"])
-                recipients = decode_header(email_message["To"])
-                date = email_message["Date"]
-                message_id = email_message["Message-ID"]
-
-                fingerprint_data = (
-                    f"{subject}|{sender}|{recipients}|{date}|{message_id}"
-                )
-                fingerprint = hashlib.sha256(fingerprint_data.encode()).hexdigest()
-
-                existing_email = (
-                    db.query(Email.id).filter(Email.fingerprint == fingerprint).first()
-                )
-                if existing_email:
-                    logging.debug(
-                        f"Skipping email with UID {uid.decode() if isinstance(uid, bytes) else uid} for account {account_id} as it already exists."
-                    )
-                    skipped_emails += 1
-                    continue
-
-                body = extract_body(email_message)
-                parsed_date = parse_date(date)
-
-                email_obj = Email(
-                    account_id=account_id,
-                    subject=subject,
-                    sender=sender,
-                    recipients=recipients,
-                    date=parsed_date,
-                    body=body,
-                    fingerprint=fingerprint,
-                )
-                db.add(email_obj)
-                db.commit()
-
-                email_id = email_obj.id
-                new_emails_inserted += 1
-
-                attachments_inserted = 0
-                for part in email_message.walk():
-                    if (
-                        part.get_content_maintype() == "multipart"
-                        or part.get("Content-Disposition") is None
-                    ):
-                        continue
-
-                    filename = decode_filename(part.get_filename())
-                    if filename:
-                        content = part.get_payload(decode=True)
-                        cid = part.get(
-                            "Content-ID", ""
-                        )  # Get the Content-ID (cid) value
-                        attachment = Attachment(
-                            email_id=email_id,
-                            filename=filename,
-                            content=content,
-                            cid=cid,
-                        )
-                        db.add(attachment)
-                        attachments_inserted += 1
-
-                db.commit()
-                logging.info(
-                    f"Inserted email with UID {uid.decode() if isinstance(uid, bytes) else uid} for account {account_id} into the database."
-                )
-
-                if attachments_inserted > 0:
-                    logging.info(
-                        f"Saved {attachments_inserted} attachment(s) for email with UID {uid.decode() if isinstance(uid, bytes) else uid} and account {account_id}."
-                    )
-                    total_attachments_inserted += attachments_inserted
+            try:
+                _sync_pop3_mailbox(client, db, dedup, account_id, stats)
+            finally:
+                client.quit()
 
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -316,14 +496,14 @@ def fetch_and_archive_emails(
             f"Email archiving completed successfully for account {account_id}."
         )
         logging.info(f"Execution time: {elapsed_time_str}")
-        logging.info(f"Total emails found: {total_emails}")
-        logging.info(f"Skipped emails (already exists): {skipped_emails}")
-        logging.info(f"Failed emails (fetching error): {failed_emails}")
-        logging.info(f"New emails inserted: {new_emails_inserted}")
-        logging.info(f"New attachments saved: {total_attachments_inserted}")
+        logging.info(f"Total emails found: {stats['found']}")
+        logging.info(f"Skipped emails (already exists): {stats['skipped']}")
+        logging.info(f"Failed emails (fetching error): {stats['failed']}")
+        logging.info(f"New emails inserted: {stats['inserted']}")
+        logging.info(f"New attachments saved: {stats['attachments']}")
         logging.info("-" * 50)
 
-        return new_emails_inserted
+        return stats["inserted"]
 
     except Exception as e:
         logging.error(
@@ -334,7 +514,14 @@ def fetch_and_archive_emails(
 
 
 def create_account(
-    email, password, protocol, server, port, update_interval=300, selected_inboxes=None
+    email,
+    password,
+    protocol,
+    server,
+    port,
+    update_interval=300,
+    selected_inboxes=None,
+    push_enabled=False,
 ):
     logging.info(f"Creating {protocol.upper()} account for {email}.")
 
@@ -355,6 +542,7 @@ def create_account(
             port=int(port),
             selected_inboxes=",".join(selected_inboxes) if selected_inboxes else None,
             update_interval=update_interval,
+            push_enabled=push_enabled,
         )
 
         db.add(account)
@@ -404,14 +592,12 @@ def get_available_inboxes(email, password, protocol, server, port):
 
 
 # get availabl inboxes from database
-def get_available_inboxes_from_db(conn, account_id):
-    cursor = conn.cursor()
-    cursor.execute("SELECT selected_inboxes FROM accounts WHERE id = ?", (account_id,))
-    selected_inboxes = cursor.fetchone()
-    if selected_inboxes:
-        return selected_inboxes[0].split(",") if selected_inboxes[0] else []
-    else:
-        return []
+def get_available_inboxes_from_db(account_id):
+    db = next(get_db())
+    available_inboxes = (
+        db.query(Account.available_inboxes).filter(Account.id == account_id).scalar()
+    )
+    return available_inboxes.split(",") if available_inboxes else []
 
 
 def get_account(conn, account_id):
@@ -430,31 +616,46 @@ def get_account(conn, account_id):
 
 
 def update_account(
-    conn, account_id, email, password, protocol, server, port, mailbox, interval
+    account_id,
+    email,
+    password,
+    protocol,
+    server,
+    port,
+    available_inboxes,
+    selected_inboxes,
+    update_interval=300,
+    push_enabled=False,
 ):
+    """
+    Update the settings of an account. Returns False if it does not exist.
+    Running IDLE watchers keep the old settings until they are refreshed,
+    see queue_service.refresh_idle_watchers.
+    """
     logging.info(f"Updating account {account_id} with email {email}.")
 
+    db = next(get_db())
+    account = db.query(Account).filter(Account.id == account_id).first()
+    if account is None:
+        return False
+
+    if selected_inboxes:
+        selected_inboxes = [inbox.strip() for inbox in selected_inboxes]
+
+    account.email = email
     # Encrypt the new password
-    encrypted_password = cipher_suite.encrypt(password.encode())
+    account.password = cipher_suite.encrypt(password.encode())
+    account.protocol = protocol
+    account.server = server
+    account.port = int(port)
+    account.available_inboxes = ",".join(available_inboxes) if available_inboxes else None
+    account.selected_inboxes = ",".join(selected_inboxes) if selected_inboxes else None
+    account.update_interval = update_interval
+    account.push_enabled = push_enabled
+    db.commit()
 
-    cursor = conn.cursor()
-    cursor.execute(
-        """UPDATE accounts
-                      SET email = ?, password = ?, protocol = ?, server = ?, port = ?, mailbox = ?, interval = ?
-                      WHERE id = ?""",
-        (
-            email,
-            encrypted_password,
-            protocol,
-            server,
-            port,
-            mailbox,
-            interval,
-            account_id,
-        ),
-    )
-    conn.commit()
     logging.info(f"Account {account_id} updated successfully.")
+    return True
 
 
 def delete_account(account_id):
@@ -462,8 +663,35 @@ def delete_account(account_id):
     logging.info(f"Deleting account {account_id}.")
     account = db.query(Account).filter(Account.id == account_id).first()
     if account:
+        # Delete dependent rows with bulk statements instead of loading the
+        # account's emails into the session
+        email_ids = db.query(Email.id).filter(Email.account_id == account_id)
+        hashes = {
+            sha256
+            for (sha256,) in db.query(Attachment.sha256)
+            .filter(Attachment.email_id.in_(email_ids))
+            .distinct()
+        }
+        db.query(Attachment).filter(Attachment.email_id.in_(email_ids)).delete(
+            synchronize_session=False
+        )
+        db.query(EmailAddress).filter(EmailAddress.email_id.in_(email_ids)).delete(
+            synchronize_session=False
+        )
+        db.query(Email).filter(Email.account_id == account_id).delete(
+            synchronize_session=False
+        )
+        db.query(MailboxSyncState).filter(MailboxSyncState.account_id == account_id).delete(
+            synchronize_session=False
+        )
+        db.query(Pop3SeenMessage).filter(Pop3SeenMessage.account_id == account_id).delete(
+            synchronize_session=False
+        )
         db.delete(account)
         db.commit()
+        invalidate_email_count()
+        search_service.invalidate_search_cache()
+        attachment_service.remove_unreferenced_blobs(db, hashes)
         logging.info(f"Account {account_id} deleted successfully.")
 
 
@@ -471,11 +699,20 @@ def delete_email(email_id: int):
     db = next(get_db())
 
     try:
-        email = db.query(Email).filter(Email.id == email_id).first()
-        if email:
-            db.delete(email)
+        if db.query(Email.id).filter(Email.id == email_id).first():
+            hashes = [
+                sha256
+                for (sha256,) in db.query(Attachment.sha256).filter(
+                    Attachment.email_id == email_id
+                )
+            ]
             db.query(Attachment).filter(Attachment.email_id == email_id).delete()
+            db.query(EmailAddress).filter(EmailAddress.email_id == email_id).delete()
+            db.query(Email).filter(Email.id == email_id).delete()
             db.commit()
+            invalidate_email_count()
+            search_service.invalidate_search_cache()
+            attachment_service.remove_unreferenced_blobs(db, hashes)
             return {"message": "Email deleted successfully"}
         else:
             return {"error": "Email not found"}
@@ -487,7 +724,9 @@ def delete_email(email_id: int):
 
 def export_email(email_id):
     db = next(get_db())
-    email = db.query(Email).filter(Email.id == email_id).first()
+    email = (
+        db.query(Email).options(undefer(Email.body)).filter(Email.id == email_id).first()
+    )
 
     if email:
         email_data = email.body  # Assuming the body column contains the raw email data
@@ -496,78 +735,228 @@ def export_email(email_id):
         return None
 
 
-def get_emails(
-    page: int = 1, per_page: int = 10, sort_by: str = "date", sort_order: str = "desc"
-):
-    db = next(get_db())
+# Columns the email list can be sorted by; each has a (column, id) index
+EMAIL_SORT_COLUMNS = {
+    "date": Email.date,
+    "subject": Email.subject,
+    "sender": Email.sender,
+    "recipients": Email.recipients,
+}
 
-    total_emails = db.query(Email).count()
+# Total number of archived emails, refreshed at most every EMAIL_COUNT_TTL seconds
+_email_count_cache = {"value": None, "expires_at": 0.0}
 
-    offset = (page - 1) * per_page
 
-    emails = (
-        db.query(Email)
-        .order_by(getattr(getattr(Email, sort_by), sort_order)())
-        .limit(per_page)
-        .offset(offset)
-        .all()
+def get_email_count(db):
+    now = time.time()
+    if _email_count_cache["value"] is None or now >= _email_count_cache["expires_at"]:
+        _email_count_cache["value"] = db.query(func.count(Email.id)).scalar()
+        _email_count_cache["expires_at"] = now + config.EMAIL_COUNT_TTL
+    return _email_count_cache["value"]
+
+
+def invalidate_email_count():
+    _email_count_cache["expires_at"] = 0.0
+
+
+def _email_cursor(email, sort_by, sort_order, direction):
+    return encode_cursor(
+        {
+            "sort": sort_by,
+            "order": sort_order,
+            "value": getattr(email, sort_by),
+            "id": email.id,
+            "dir": direction,
+        }
     )
 
-    email_data = []
-    for email in emails:
-        attachment_count = (
-            db.query(Attachment).filter(Attachment.email_id == email.id).count()
-        )
 
-        email_data.append(
-            {
-                "id": email.id,
-                "account_id": email.account_id,
-                "subject": email.subject,
-                "sender": email.sender,
-                "recipients": email.recipients,
-                "date": str(email.date),  # Convert the date to a string for FastAPI
-                "body": email.body,
-                "unique_id": email.fingerprint,
-                "has_attachments": attachment_count > 0,
-            }
-        )
+def _list_query(db):
+    return db.query(
+        Email.id,
+        Email.account_id,
+        Email.subject,
+        Email.sender,
+        Email.recipients,
+        Email.date,
+        Email.fingerprint,
+        Email.snippet,
+        Email.size_bytes,
+        Email.attachment_count,
+    )
 
-    return {"emails": email_data, "total_emails": total_emails}
 
+def _email_summary(email):
+    return {
+        "id": email.id,
+        "account_id": email.account_id,
+        "subject": email.subject,
+        "sender": email.sender,
+        "recipients": email.recipients,
+        "date": str(email.date),  # Convert the date to a string for FastAPI
+        "snippet": email.snippet,
+        "size_bytes": email.size_bytes,
+        "unique_id": email.fingerprint.hex(),
+        "attachment_count": email.attachment_count or 0,
+        "has_attachments": bool(email.attachment_count),
+    }
 
-def email_details(email_id: int):
+
+def get_emails(
+    page: int = 1,
+    per_page: int = 10,
+    sort_by: str = "date",
+    sort_order: str = "desc",
+    cursor: str = None,
+):
+    """
+    Return one page of emails. Pages are addressed by the opaque next_cursor
+    and prev_cursor of the previous response; page is only used without a
+    cursor and falls back to OFFSET. total_emails is cached and may lag
+    behind by up to EMAIL_COUNT_TTL seconds.
+    """
     db = next(get_db())
-    email, attachments, attachment_filenames = get_email_details(db, email_id)
 
-    if email:
-        email_data = {
-            "id": email.id,
-            "account_id": email.account_id,
-            "subject": email.subject,
-            "sender": email.sender,
-            "recipients": email.recipients,
-            "date": str(email.date),  # Convert the date to a string for FastAPI
-            "body": email.body,
-            "content_type": email.content_type,
-        }
+    if sort_by not in EMAIL_SORT_COLUMNS:
+        sort_by = "date"
+    sort_order = "asc" if sort_order == "asc" else "desc"
+    column = EMAIL_SORT_COLUMNS[sort_by]
+    per_page = max(1, min(per_page, config.MAX_PAGE_SIZE))
+
+    position = decode_cursor(cursor) if cursor else None
+    if position and (position.get("sort"), position.get("order")) != (sort_by, sort_order):
+        # The sort order changed since the cursor was issued
+        position = None
+
+    # Previous pages are read in reverse order and flipped afterwards
+    backwards = position is not None and position.get("dir") == "prev"
+    descending = (sort_order == "desc") != backwards
+
+    query = _list_query(db)
+    if position is None and page > 1:
+        emails = (
+            query.order_by(*order_by_clauses(column, Email.id, descending))
+            .offset((page - 1) * per_page)
+            .limit(per_page + 1)
+            .all()
+        )
+    else:
+        after = None
+        if position is not None:
+            after = (decode_sort_value(position.get("value")), position.get("id", 0))
+        emails = fetch_keyset_page(query, column, Email.id, after, descending, per_page + 1)
+    has_more = len(emails) > per_page
+    emails = emails[:per_page]
+    if backwards:
+        emails.reverse()
+
+    has_next = has_more if not backwards else bool(emails)
+    has_prev = has_more if backwards else (position is not None or page > 1)
+    next_cursor = (
+        _email_cursor(emails[-1], sort_by, sort_order, "next")
+        if emails and has_next
+        else None
+    )
+    prev_cursor = (
+        _email_cursor(emails[0], sort_by, sort_order, "prev")
+        if emails and has_prev
+        else None
+    )
 
-        attachment_data = [
-            {"id": attachment.id, "filename": attachment.filename}
-            for attachment in attachments
-        ]
+    email_data = [_email_summary(email) for email in emails]
 
-        # Check if the email body is large
-        body_size = len(email.body)
-        is_large_file = body_size > 1000000  # Adjust the threshold as needed
+    return {
+        "emails": email_data,
+        "total_emails": get_email_count(db),
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+    }
 
-        return {
-            "email": email_data,
-            "attachments": attachment_data,
-            "is_large_file": is_large_file,
-        }
+
+def iter_emails(sort_by: str = "date", sort_order: str = "desc", cursor: str = None):
+    """
+    Yield every email in the order of get_emails, starting after the
+    next_cursor cursor if one is given. Rows are read from a server-side
+    cursor in batches of STREAM_BATCH_SIZE, so memory use stays the same
+    however many emails are archived.
+    """
+    db = next(get_db())
+
+    if sort_by not in EMAIL_SORT_COLUMNS:
+        sort_by = "date"
+    sort_order = "asc" if sort_order == "asc" else "desc"
+    column = EMAIL_SORT_COLUMNS[sort_by]
+
+    after = None
+    position = decode_cursor(cursor) if cursor else None
+    if (
+        position
+        and (position.get("sort"), position.get("order")) == (sort_by, sort_order)
+        and position.get("dir") != "prev"
+    ):
+        after = (decode_sort_value(position.get("value")), position.get("id", 0))
+
+    batches = iter_keyset_rows(
+        _list_query(db), column, Email.id, after, sort_order == "desc", config.STREAM_BATCH_SIZE
+    )
+    for batch in batches:
+        for email in batch:
+            yield _email_summary(email)
+
+
+def get_correspondent_emails(
+    address: str, role: str = None, cursor: str = None, per_page: int = 10
+):
+    """
+    Return one page of the emails exchanged with address, newest first.
+    role "from" limits them to emails sent by the address and "to" to
+    emails it received as To, Cc or Bcc recipient. The page is read from
+    the address index without scanning emails.
+    """
+    db = next(get_db())
+    contact = address_service.get_address(db, address)
+    if contact is None:
+        return {"error": "Contact not found"}
+
+    if role == "from":
+        roles = ["from"]
+    elif role == "to":
+        roles = list(address_service.RECIPIENT_ROLES)
     else:
-        return {"error": "Email not found"}
+        roles = ["from", *address_service.RECIPIENT_ROLES]
+    per_page = max(1, min(per_page, config.MAX_PAGE_SIZE))
+
+    # An email lists the same address in several roles at most a few times
+    query = (
+        db.query(EmailAddress.email_id, EmailAddress.date)
+        .filter(EmailAddress.address_id == contact.id, EmailAddress.role.in_(roles))
+        .distinct()
+    )
+    position = decode_cursor(cursor) if cursor else None
+    after = None
+    if position is not None:
+        after = (decode_sort_value(position.get("value")), position.get("id", 0))
+    rows = fetch_keyset_page(
+        query, EmailAddress.date, EmailAddress.email_id, after, True, per_page + 1
+    )
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor({"value": rows[-1].date, "id": rows[-1].email_id})
+
+    emails_by_id = {
+        email.id: email
+        for email in _list_query(db).filter(Email.id.in_([row.email_id for row in rows]))
+    }
+    return {
+        "emails": [
+            _email_summary(emails_by_id[row.email_id])
+            for row in rows
+            if row.email_id in emails_by_id
+        ],
+        "next_cursor": next_cursor,
+    }
 
 
 def latest_emails(limit=5):
@@ -592,52 +981,109 @@ def latest_emails(limit=5):
     return emails_data
 
 
+def render_email(email):
+    """
+    Store the display form of an email whose body has not been rendered yet.
+    """
+    email.content_type, email.rendered_body, email.body_size = render_body(
+        email.body, email.html_body
+    )
+
+
+def backfill_email_metadata(batch_size=None):
+    """
+    Render the bodies and fill in the list metadata of emails archived
+    before these were computed at ingest. Emails are processed in ID order
+    with one transaction per batch, so the backfill can be interrupted and
+    resumed. Returns the number of emails updated.
+
+    The backfill reads and writes columns that databases created by earlier
+    versions only get from the schema upgrade, so the upgrade is applied
+    first; it does nothing once initialize_database has run.
+    """
+    batch_size = batch_size or config.BACKFILL_BATCH_SIZE
+    db = next(get_db())
+    upgrade_schema(db.get_bind())
+    updated = 0
+    last_id = 0
+
+    logging.info("Started backfilling the metadata of existing emails.")
+    while True:
+        emails = (
+            db.query(Email)
+            .options(undefer(Email.body), undefer(Email.html_body))
+            .filter(
+                or_(Email.content_type.is_(None), Email.snippet.is_(None)),
+                Email.id > last_id,
+            )
+            .order_by(Email.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not emails:
+            break
+
+        attachment_stats = {
+            email_id: (count, inline_count, size)
+            for email_id, count, inline_count, size in db.query(
+                Attachment.email_id,
+                func.count(Attachment.id),
+                func.count(Attachment.id).filter(Attachment.inline.is_(True)),
+                func.coalesce(func.sum(Attachment.size), 0),
+            )
+            .filter(Attachment.email_id.in_([email.id for email in emails]))
+            .group_by(Attachment.email_id)
+        }
+        for email in emails:
+            if email.content_type is None:
+                render_email(email)
+            count, inline_count, attachment_size = attachment_stats.get(email.id, (0, 0, 0))
+            text_body = email.body
+            if email.html_body is None and email.content_type == "text/html":
+                # Only the HTML was kept for emails archived before the
+                # text alternative was stored separately
+                text_body = html_to_text(text_body or "")
+            email.snippet = make_snippet(text_body)
+            email.attachment_count = count - inline_count
+            # The raw message is not kept, so the size is estimated from its parts
+            email.size_bytes = (
+                len((email.body or "").encode())
+                + len((email.html_body or "").encode())
+                + attachment_size
+            )
+        db.commit()
+        updated += len(emails)
+        last_id = emails[-1].id
+        db.expunge_all()
+        logging.info(f"Backfilled the metadata of {updated} existing emails.")
+
+    logging.info(f"Metadata backfill completed. {updated} emails updated.")
+    return updated
+
+
 def get_email_details(email_id):
     logging.info(f"Fetching email details for email ID {email_id}.")
 
     db = next(get_db())  # Get a database session
 
-    email = db.query(Email).filter(Email.id == email_id).first()
+    email = (
+        db.query(Email)
+        .options(undefer(Email.rendered_body))
+        .filter(Email.id == email_id)
+        .first()
+    )
 
     if email:
-        attachments = db.query(Attachment).filter(Attachment.email_id == email_id).all()
-
-        html_tags = re.compile(r"<(?!!)(?P<tag>[a-zA-Z]+).*?>", re.IGNORECASE)
-        code_block_pattern = re.compile(r"```.*?```", re.DOTALL)
-
-        content_type = "text/plain"
-        body = email.body
-
-        # Check for HTML content
-        if (
-            "<!doctype html>" in body.lower()
-            or "<html" in body.lower()
-            or html_tags.search(body) is not None
-        ):
-            content_type = "text/html"
-            logging.info(f"Email with ID {email_id} is an HTML email.")
-
-            # Replace code blocks with <pre><code> tags
-            body = code_block_pattern.sub(
-                lambda match: f"<pre><code>{match.group()[3:-3]}</code></pre>", body
-            )
-
-            # Extract the HTML portion of the email
-            html_start = (
-                body.lower().find("<!doctype html>")
-                if "<!doctype html>" in body.lower()
-                else body.lower().find("<html")
-            )
-            html_end = body.lower().rfind("</html>") + len("</html>")
-            if html_start != -1 and html_end != -1:
-                body = body[html_start:html_end]
-        else:
-            logging.info(f"Email with ID {email_id} is a plain text email.")
+        if email.content_type is None:
+            # Not reached by the backfill yet; render once and keep the result
+            render_email(email)
+            db.commit()
 
-            # Replace code blocks with <pre><code> tags
-            body = code_block_pattern.sub(
-                lambda match: f"<pre><code>{match.group()[3:-3]}</code></pre>", body
-            )
+        attachments = (
+            db.query(Attachment)
+            .filter(Attachment.email_id == email_id, Attachment.inline.isnot(True))
+            .all()
+        )
 
         attachment_data = [
             {"id": attachment.id, "filename": attachment.filename}
@@ -645,8 +1091,7 @@ def get_email_details(email_id):
         ]
 
         # Check if the email body is large
-        body_size = len(email.body)
-        is_large_file = body_size > 1000000
+        is_large_file = email.body_size > 1000000
 
         email_data = {
             "id": email.id,
@@ -655,8 +1100,8 @@ def get_email_details(email_id):
             "sender": email.sender,
             "recipients": email.recipients,
             "date": str(email.date),
-            "body": body,
-            "content_type": content_type,
+            "body": email.rendered_body,
+            "content_type": email.content_type,
         }
 
         logging.info(
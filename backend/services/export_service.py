@@ -2,6 +2,7 @@
 
 from models.database import get_db
 from models.models import Email
+from sqlalchemy.orm import undefer
 import logging
 import zipfile
 import io
@@ -10,7 +11,7 @@ logger = logging.getLogger(__name__)
 
 def export_all_emails():
     db = next(get_db())
-    emails = db.query(Email).all()
+    emails = db.query(Email).options(undefer(Email.body)).all()
 
     zip_buffer = io.BytesIO()
     with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
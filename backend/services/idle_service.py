@@ -0,0 +1,242 @@
+# Services are used to interact with the database, perform business logic and other necesarry core functions. They are to be imported into the routes. Services should not use FastAPI's Request and Response classes. They should only return data to the routes. The routes will then use this data to return a response to the client.
+
+# idle_service.py implements the optional IMAP push mode. For every account with push enabled, an IdleWatcher thread keeps a connection per watched inbox in IMAP IDLE and requests an incremental email retrieval as soon as the server reports new messages. Accounts whose server lacks IDLE keep relying on interval polling.
+
+import imaplib
+import logging
+import random
+import socket
+import threading
+from utils.encryption import cipher_suite
+from utils.email_utils import quote_mailbox
+from config.config import config
+
+logger = logging.getLogger(__name__)
+
+# Running watchers per account ID, guarded by watchers_lock
+watchers = {}
+watchers_lock = threading.Lock()
+
+
+class IdleUnsupported(Exception):
+    pass
+
+
+class IdleWatcher(threading.Thread):
+    """
+    Keeps one IMAP connection in IDLE on a single inbox and calls
+    on_new_mail(account_id) whenever the server announces new messages.
+
+    The connection is renewed every IDLE_RENEW_INTERVAL seconds, before
+    servers drop idle clients (RFC 2177 recommends less than 29 minutes).
+    Connection errors are retried with exponential backoff.
+
+    Messages that arrive while the watcher is disconnected are not
+    announced, so on_new_mail is also called after every reconnect.
+
+    The connection counts against the IDLE limit of the task queue:
+    acquire_connection(host) must return True before connecting and
+    release_connection(host) is called after disconnecting. While the server
+    has no connection to spare, the inbox is only polled.
+    """
+
+    def __init__(
+        self,
+        account_id,
+        server,
+        port,
+        username,
+        encrypted_password,
+        inbox,
+        on_new_mail,
+        acquire_connection=None,
+        release_connection=None,
+    ):
+        super().__init__(name=f"imap-idle-{account_id}-{inbox}", daemon=True)
+        self.account_id = account_id
+        self.server = server
+        self.host = (server or "").lower()
+        self.port = port
+        self.username = username
+        self.encrypted_password = encrypted_password
+        self.inbox = inbox
+        self.on_new_mail = on_new_mail
+        self.acquire_connection = acquire_connection or (lambda host: True)
+        self.release_connection = release_connection or (lambda host: None)
+        self.stop_event = threading.Event()
+        self.client = None
+
+    def stop(self):
+        self.stop_event.set()
+        client = self.client
+        if client is not None:
+            try:
+                # Unblock a pending read
+                client.shutdown()
+            except Exception:
+                pass
+
+    def run(self):
+        failures = 0
+        refused = False
+        connected = False
+        while not self.stop_event.is_set():
+            if not self.acquire_connection(self.host):
+                if not refused:
+                    logging.warning(
+                        f"No IDLE connection to {self.server} available for inbox {self.inbox} of account {self.account_id} (MAX_IDLE_CONNECTIONS_PER_HOST is {config.MAX_IDLE_CONNECTIONS_PER_HOST}). The inbox is polled until one is free."
+                    )
+                refused = True
+                self.stop_event.wait(config.IDLE_BACKOFF_MAX)
+                continue
+            refused = False
+            delay = 0
+            try:
+                self._connect()
+                failures = 0
+                if connected:
+                    # Catch up on messages that arrived while disconnected
+                    self.on_new_mail(self.account_id)
+                connected = True
+                while not self.stop_event.is_set():
+                    if self._idle_once():
+                        self.on_new_mail(self.account_id)
+            except IdleUnsupported:
+                logging.info(
+                    f"Server {self.server} does not support IDLE. Account {self.account_id} falls back to polling."
+                )
+                return
+            except socket.timeout:
+                # Renew the IDLE session on a fresh connection
+                logging.debug(
+                    f"Renewing IDLE connection for account {self.account_id} in inbox {self.inbox}."
+                )
+            except Exception as e:
+                if self.stop_event.is_set():
+                    break
+                failures += 1
+                delay = min(
+                    config.IDLE_BACKOFF_BASE * 2 ** (failures - 1), config.IDLE_BACKOFF_MAX
+                )
+                delay *= random.uniform(0.8, 1.2)
+                logging.warning(
+                    f"IDLE connection for account {self.account_id} in inbox {self.inbox} failed: {str(e)}. Reconnecting in {delay:.0f}s."
+                )
+            finally:
+                self._disconnect()
+                self.release_connection(self.host)
+            # The connection is released during the backoff
+            self.stop_event.wait(delay)
+
+    def _connect(self):
+        encrypted_password = self.encrypted_password
+        if not isinstance(encrypted_password, bytes):
+            encrypted_password = encrypted_password.encode()
+        password = cipher_suite.decrypt(encrypted_password).decode()
+
+        self.client = imaplib.IMAP4_SSL(self.server, self.port)
+        self.client._mode_utf8()
+        self.client.login(self.username, password)
+
+        _, data = self.client.capability()
+        if "IDLE" not in data[0].decode().upper().split():
+            raise IdleUnsupported()
+
+        self.client.select(quote_mailbox(self.inbox), readonly=True)
+        self.client.sock.settimeout(config.IDLE_RENEW_INTERVAL)
+        logging.info(
+            f"Watching inbox {self.inbox} of account {self.account_id} with IMAP IDLE."
+        )
+
+    def _disconnect(self):
+        client, self.client = self.client, None
+        if client is None:
+            return
+        try:
+            client.logout()
+        except Exception:
+            pass
+
+    def _idle_once(self):
+        """
+        Run one IDLE command until the server reports new messages. Returns
+        True if new messages arrived.
+        """
+        client = self.client
+        tag = client._new_tag()
+        client.send(tag + b" IDLE\r\n")
+
+        line = client.readline()
+        if not line.startswith(b"+"):
+            raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+        new_mail = False
+        while not new_mail:
+            line = client.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed during IDLE")
+            if line.startswith(b"* BYE"):
+                raise imaplib.IMAP4.abort(line.decode(errors="replace").strip())
+            if line.startswith(b"*") and line.rstrip().upper().endswith(b"EXISTS"):
+                new_mail = True
+
+        client.send(b"DONE\r\n")
+        while True:
+            line = client.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed while leaving IDLE")
+            if line.startswith(tag):
+                break
+
+        return new_mail
+
+
+def start_idle_watchers(account, on_new_mail, acquire_connection=None, release_connection=None):
+    """
+    Start IDLE watchers for the inboxes of an IMAP account with push enabled.
+    Accounts without selected inboxes watch INBOX. acquire_connection and
+    release_connection account for the connections, see IdleWatcher.
+    """
+    if account.protocol != "imap" or not account.push_enabled:
+        return
+
+    if account.selected_inboxes:
+        inboxes = [inbox.strip() for inbox in account.selected_inboxes.split(",")]
+    else:
+        inboxes = ["INBOX"]
+
+    with watchers_lock:
+        if account.id in watchers:
+            return
+        account_watchers = [
+            IdleWatcher(
+                account.id,
+                account.server,
+                account.port,
+                account.email,
+                account.password,
+                inbox,
+                on_new_mail,
+                acquire_connection,
+                release_connection,
+            )
+            for inbox in inboxes
+            if inbox
+        ]
+        watchers[account.id] = account_watchers
+
+    for watcher in account_watchers:
+        watcher.start()
+
+
+def stop_idle_watchers(account_id, timeout=5):
+    """
+    Stop the watchers of an account and wait up to timeout seconds for them
+    to close their connections, so a restarted watcher finds them released.
+    """
+    with watchers_lock:
+        account_watchers = watchers.pop(account_id, [])
+    for watcher in account_watchers:
+        watcher.stop()
+    for watcher in account_watchers:
+        watcher.join(timeout)
@@ -0,0 +1,214 @@
+# Services are used to interact with the database, perform business logic and other necesarry core functions. They are to be imported into the routes. Services should not use FastAPI's Request and Response classes. They should only return data to the routes. The routes will then use this data to return a response to the client.
+
+# import_service.py imports mbox files, Maildir folders and .eml files from local disk. Messages go through the same ingest pipeline as live IMAP/POP3 syncs, so they are parsed in parallel, deduplicated by fingerprint and persisted in batches.
+
+import logging
+import mmap
+import os
+import threading
+import time
+import uuid
+from models.database import get_db
+from models.models import Account
+from services.dedup_service import get_deduplicator
+from services.ingest_service import IngestPipeline
+from config.config import config
+
+logger = logging.getLogger(__name__)
+
+MBOX_BOUNDARY = b"\nFrom "
+MAILDIR_SUBDIRS = ("cur", "new")
+
+# Progress of import jobs started through the API, keyed by job ID. Jobs
+# are removed IMPORT_JOB_TTL seconds after they finished.
+import_jobs = {}
+import_jobs_lock = threading.Lock()
+
+
+def iter_mbox_messages(path):
+    """
+    Yield the raw messages of an mbox file. The file is memory-mapped and
+    scanned for "From " separator lines, so only one message at a time is
+    copied into memory.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:5] == b"From ":
+                start = 0
+            else:
+                start = mm.find(MBOX_BOUNDARY)
+                if start == -1:
+                    return
+                start += 1
+
+            while start != -1:
+                # Skip the "From " separator line itself
+                body_start = mm.find(b"\n", start) + 1
+                if body_start == 0:
+                    return
+                boundary = mm.find(MBOX_BOUNDARY, body_start - 1)
+                end = boundary + 1 if boundary != -1 else len(mm)
+                raw_email = mm[body_start:end]
+                if raw_email.strip():
+                    yield raw_email
+                start = boundary + 1 if boundary != -1 else -1
+
+
+def is_mbox_file(path):
+    if path.lower().endswith((".mbox", ".mbx")):
+        return True
+    try:
+        with open(path, "rb") as f:
+            return f.read(5) == b"From "
+    except OSError:
+        return False
+
+
+def iter_archive_messages(path):
+    """
+    Yield (source, raw_email) tuples for every message below path. Maildir
+    folders (directories with cur/new), mbox files and .eml files are
+    recognized; other files are ignored.
+    """
+    if os.path.isfile(path):
+        if path.lower().endswith(".eml"):
+            with open(path, "rb") as f:
+                yield path, f.read()
+        elif is_mbox_file(path):
+            for index, raw_email in enumerate(iter_mbox_messages(path)):
+                yield f"{path}#{index}", raw_email
+        return
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        if any(os.path.isdir(os.path.join(root, sub)) for sub in MAILDIR_SUBDIRS):
+            for sub in MAILDIR_SUBDIRS:
+                subdir = os.path.join(root, sub)
+                if not os.path.isdir(subdir):
+                    continue
+                for name in sorted(os.listdir(subdir)):
+                    message_path = os.path.join(subdir, name)
+                    if os.path.isfile(message_path):
+                        with open(message_path, "rb") as f:
+                            yield message_path, f.read()
+            # Maildir++ subfolders are dot-directories next to cur/new/tmp
+            dirs[:] = [d for d in dirs if d not in ("cur", "new", "tmp")]
+
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            if name.lower().endswith(".eml"):
+                with open(file_path, "rb") as f:
+                    yield file_path, f.read()
+            elif is_mbox_file(file_path):
+                for index, raw_email in enumerate(iter_mbox_messages(file_path)):
+                    yield f"{file_path}#{index}", raw_email
+
+
+def import_archive(account_id, path, progress=None):
+    """
+    Import all messages below path into the given account and return the
+    import statistics including the throughput in messages per second.
+    progress, if given, is a dictionary updated while the import runs.
+    """
+    db = next(get_db())
+    if not db.query(Account.id).filter(Account.id == account_id).first():
+        raise ValueError(f"Account with ID {account_id} not found.")
+    if not os.path.exists(path):
+        raise ValueError(f"Import path {path} does not exist.")
+
+    logging.info(f"Started importing {path} into account {account_id}.")
+    start_time = time.time()
+    stats = {"found": 0, "skipped": 0, "failed": 0, "inserted": 0, "attachments": 0}
+    progress = progress if progress is not None else {}
+
+    dedup = get_deduplicator(db)
+    pipeline = IngestPipeline(account_id, dedup, stats, location=f" from {path}")
+    try:
+        for source, raw_email in iter_archive_messages(path):
+            stats["found"] += 1
+            pipeline.submit(source, raw_email)
+            if stats["found"] % config.IMPORT_REPORT_EVERY == 0:
+                elapsed = time.time() - start_time
+                rate = stats["found"] / elapsed if elapsed else 0.0
+                progress.update(messages_read=stats["found"], messages_per_second=rate)
+                logging.info(
+                    f"Import of {path}: {stats['found']} messages read ({rate:.0f} messages/s)."
+                )
+    finally:
+        pipeline.close()
+
+    elapsed = time.time() - start_time
+    stats["elapsed_seconds"] = elapsed
+    stats["messages_per_second"] = stats["found"] / elapsed if elapsed else 0.0
+    progress.update(messages_read=stats["found"], **stats)
+
+    logging.info(f"Import of {path} into account {account_id} completed.")
+    logging.info(f"Execution time: {elapsed:.1f}s ({stats['messages_per_second']:.0f} messages/s)")
+    logging.info(f"Total emails found: {stats['found']}")
+    logging.info(f"Skipped emails (already exists): {stats['skipped']}")
+    logging.info(f"Failed emails (parsing error): {stats['failed']}")
+    logging.info(f"New emails inserted: {stats['inserted']}")
+    logging.info(f"New attachments saved: {stats['attachments']}")
+    logging.info("-" * 50)
+
+    return stats
+
+
+def resolve_import_path(relative_path):
+    """
+    Resolve a path given through the API against IMPORT_DIR. Returns None if
+    it points outside of IMPORT_DIR.
+    """
+    base = os.path.realpath(config.IMPORT_DIR)
+    path = os.path.realpath(os.path.join(base, relative_path))
+    if path != base and not path.startswith(base + os.sep):
+        return None
+    return path
+
+
+def _expire_import_jobs():
+    # Called with import_jobs_lock held
+    now = time.time()
+    expired = [
+        job_id
+        for job_id, job in import_jobs.items()
+        if job.get("finished_at") is not None and now - job["finished_at"] > config.IMPORT_JOB_TTL
+    ]
+    for job_id in expired:
+        del import_jobs[job_id]
+
+
+def create_import_job(account_id, path):
+    job_id = uuid.uuid4().hex
+    with import_jobs_lock:
+        _expire_import_jobs()
+        import_jobs[job_id] = {
+            "job_id": job_id,
+            "account_id": account_id,
+            "path": path,
+            "status": "queued",
+        }
+    return job_id
+
+
+def run_import_job(job_id):
+    job = import_jobs[job_id]
+    job["status"] = "running"
+    try:
+        import_archive(job["account_id"], job["path"], progress=job)
+        job["status"] = "completed"
+    except Exception as e:
+        logging.error(f"Import job {job_id} failed: {str(e)}")
+        job["status"] = "failed"
+        job["error"] = str(e)
+    finally:
+        job["finished_at"] = time.time()
+
+
+def get_import_job(job_id):
+    with import_jobs_lock:
+        _expire_import_jobs()
+        job = import_jobs.get(job_id)
+        return dict(job) if job else None
@@ -0,0 +1,360 @@
+# Services are used to interact with the database, perform business logic and other necesarry core functions. They are to be imported into the routes. Services should not use FastAPI's Request and Response classes. They should only return data to the routes. The routes will then use this data to return a response to the client.
+
+# ingest_service.py turns raw emails into archived rows. The IngestPipeline parses raw emails in a process pool and hands the parsed records to a single writer thread, which persists them in batches. Emails and their attachments are written with multi-row INSERT statements inside one transaction per batch instead of one commit per email.
+
+import logging
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from models.database import SessionLocal
+from models.models import Email, Attachment
+from utils.email_utils import parse_raw_email
+from utils.attachment_store import sniff_media_type, store_blob
+from config.config import config
+import services.search_service as search_service
+import services.suggest_service as suggest_service
+import services.address_service as address_service
+
+logger = logging.getLogger(__name__)
+
+# Process pool shared by all pipelines, created on first use
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=config.PARSE_WORKERS)
+        return _parse_pool
+
+
+def submit_parse(raw_email):
+    """
+    Submit a raw email to the parse pool. A pool whose worker died, e.g.
+    killed for using too much memory, refuses new work, so it is replaced
+    by a fresh one.
+    """
+    global _parse_pool
+    pool = get_parse_pool()
+    try:
+        return pool.submit(parse_and_store_email, raw_email)
+    except BrokenProcessPool:
+        logging.warning("The email parse pool is broken, starting a new one.")
+        with _parse_pool_lock:
+            if _parse_pool is pool:
+                _parse_pool = None
+        pool.shutdown(wait=False)
+        return get_parse_pool().submit(parse_and_store_email, raw_email)
+
+
+def parse_and_store_email(raw_email):
+    """
+    Parse a raw email and move its attachment payloads into the attachment
+    store. Runs in the parse pool, so only the attachment metadata is sent
+    back to the writer. The stored media type is detected from the content,
+    as the declared one is often generic or wrong.
+    """
+    record = parse_raw_email(raw_email)
+    for attachment in record["attachments"]:
+        content = attachment.pop("content")
+        attachment["content_type"] = sniff_media_type(content, attachment["content_type"])
+        attachment["sha256"], attachment["size"] = store_blob(content)
+    return record
+
+
+class EmailBatchWriter:
+    """
+    Buffers parsed email records and writes them in batched transactions.
+
+    Records are the dictionaries produced by parse_and_store_email plus an "account_id" and a "uid" used for logging. If a batch fails, it is
+    retried one email per transaction so only the offending email is lost.
+    """
+
+    def __init__(self, db, stats, batch_size=None, location="", failed_uids=None):
+        self.db = db
+        self.stats = stats
+        self.failed_uids = failed_uids if failed_uids is not None else set()
+        self.batch_size = batch_size or config.INSERT_BATCH_SIZE
+        self.location = location
+        self.pending = []
+        self.pending_fingerprints = set()
+
+    def is_pending(self, fingerprint):
+        return fingerprint in self.pending_fingerprints
+
+    def add(self, record):
+        self.pending.append(record)
+        self.pending_fingerprints.add(record["fingerprint"])
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        records = self.pending
+        self.pending = []
+        self.pending_fingerprints = set()
+
+        try:
+            self._insert(records)
+            self.db.commit()
+        except SQLAlchemyError as e:
+            self.db.rollback()
+            logging.warning(
+                f"Batch insert of {len(records)} emails failed, retrying them one by one: {str(e)}"
+            )
+            for record in records:
+                try:
+                    self._insert([record])
+                    self.db.commit()
+                except IntegrityError:
+                    # The fingerprint is unique across accounts, so another
+                    # account may already have archived the same email
+                    self.db.rollback()
+                    self.stats["skipped"] += 1
+                    logging.debug(
+                        f"Skipping email with UID {record['uid']} for account {record['account_id']}{self.location} as it already exists."
+                    )
+                    continue
+                except SQLAlchemyError as e:
+                    self.db.rollback()
+                    self.stats["failed"] += 1
+                    self.failed_uids.add(record["uid"])
+                    logging.error(
+                        f"Failed to insert email with UID {record['uid']} for account {record['account_id']}{self.location}: {str(e)}"
+                    )
+                    continue
+                self._record_inserted([record])
+            return
+
+        self._record_inserted(records)
+
+    def _insert(self, records):
+        email_rows = [
+            {
+                "account_id": record["account_id"],
+                "subject": record["subject"],
+                "sender": record["sender"],
+                "recipients": record["recipients"],
+                "date": record["date"],
+                "body": record["body"],
+                "html_body": record["html_body"],
+                "content_type": record["content_type"],
+                "rendered_body": record["rendered_body"],
+                "body_size": record["body_size"],
+                "snippet": record["snippet"],
+                "size_bytes": record["size_bytes"],
+                "attachment_count": record["attachment_count"],
+                "fingerprint": record["fingerprint"],
+            }
+            for record in records
+        ]
+        email_ids = self.db.scalars(
+            insert(Email).returning(Email.id, sort_by_parameter_order=True),
+            email_rows,
+        ).all()
+        for email_id, record in zip(email_ids, records):
+            record["id"] = email_id
+
+        attachment_rows = [
+            {
+                "email_id": email_id,
+                "filename": attachment["filename"],
+                "sha256": attachment["sha256"],
+                "size": attachment["size"],
+                "content_type": attachment["content_type"],
+                "cid": attachment["cid"],
+                "inline": attachment["inline"],
+            }
+            for email_id, record in zip(email_ids, records)
+            for attachment in record["attachments"]
+        ]
+        if attachment_rows:
+            self.db.execute(insert(Attachment), attachment_rows)
+
+        address_service.store_email_addresses(
+            self.db,
+            [
+                (email_id, record["date"], role, name, address)
+                for email_id, record in zip(email_ids, records)
+                for role, name, address in record["addresses"]
+            ],
+        )
+
+    def _record_inserted(self, records):
+        attachments_inserted = sum(len(record["attachments"]) for record in records)
+        self.stats["inserted"] += len(records)
+        self.stats["attachments"] += attachments_inserted
+        search_service.invalidate_search_cache()
+        suggest_service.add_emails(records)
+        logging.info(
+            f"Inserted {len(records)} emails with {attachments_inserted} attachment(s) for account {records[0]['account_id']}{self.location} into the database."
+        )
+
+
+class IngestPipeline:
+    """
+    Staged ingestion of raw emails for one account.
+
+    The caller fetches raw emails and submits them. Parsing runs in a shared
+    process pool and a single writer thread with its own database session
+    deduplicates and persists the parsed records in submission order. The
+    stages are joined by a bounded queue, so a fetcher that runs ahead of
+    the parser and writer blocks instead of buffering the whole mailbox.
+    """
+
+    def __init__(self, account_id, dedup, stats, location=""):
+        self.account_id = account_id
+        self.dedup = dedup
+        self.stats = stats
+        self.location = location
+        self.writer_stats = {"skipped": 0, "failed": 0, "inserted": 0, "attachments": 0}
+        # UIDs of the emails that could not be fetched, parsed or stored.
+        # Only used by the writer thread until the pipeline is closed, so
+        # checkpoints can avoid moving past them.
+        self.failed_uids = set()
+        self.error = None
+        self.queue = queue.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+        self.thread = threading.Thread(
+            target=self._run, name=f"ingest-writer-{account_id}", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, uid, raw_email):
+        # The raw email is kept until it is written, so it can be parsed
+        # again if the parse pool breaks
+        self._put(("message", uid, submit_parse(raw_email), raw_email))
+
+    def mark_failed(self, uid):
+        """
+        Record an email the caller could not fetch, in order with the
+        submitted emails.
+        """
+        self._put(("failed", uid))
+
+    def checkpoint(self, callback):
+        """
+        Call callback(db) from the writer thread once every email submitted
+        before the checkpoint has been persisted.
+        """
+        self._put(("checkpoint", callback))
+
+    def join(self):
+        """
+        Wait until every email submitted so far has been persisted.
+        """
+        done = threading.Event()
+        self._put(("barrier", done))
+        done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put(("stop",))
+        self.thread.join()
+        for key, value in self.writer_stats.items():
+            self.stats[key] += value
+        if self.error is not None:
+            raise self.error
+
+    def _put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def _run(self):
+        db = SessionLocal()
+        writer = EmailBatchWriter(
+            db, self.writer_stats, location=self.location, failed_uids=self.failed_uids
+        )
+        records = []
+        try:
+            while True:
+                item = self.queue.get()
+                kind = item[0]
+
+                if self.error is not None:
+                    # Keep draining so producers never block on a dead writer
+                    if kind == "barrier":
+                        item[1].set()
+                    elif kind == "stop":
+                        return
+                    continue
+
+                try:
+                    if kind == "message":
+                        _, uid, future, raw_email = item
+                        try:
+                            try:
+                                record = future.result()
+                            except BrokenProcessPool:
+                                # Every email in flight fails with the worker
+                                # that died, so each is retried once on a new pool
+                                record = submit_parse(raw_email).result()
+                        except Exception as e:
+                            logging.error(
+                                f"Failed to parse email with UID {uid} for account {self.account_id}{self.location}: {str(e)}"
+                            )
+                            self.writer_stats["failed"] += 1
+                            self.failed_uids.add(uid)
+                            continue
+                        record["account_id"] = self.account_id
+                        record["uid"] = uid
+                        records.append(record)
+                        if len(records) >= writer.batch_size:
+                            self._write(db, writer, records)
+                            records = []
+                        continue
+                    if kind == "failed":
+                        self.failed_uids.add(item[1])
+                        continue
+
+                    self._write(db, writer, records)
+                    records = []
+                    if kind == "checkpoint":
+                        item[1](db)
+                    elif kind == "barrier":
+                        item[1].set()
+                    elif kind == "stop":
+                        return
+                except Exception as e:
+                    logging.error(
+                        f"Ingestion failed for account {self.account_id}{self.location}: {str(e)}"
+                    )
+                    self.error = e
+                    if kind == "barrier":
+                        item[1].set()
+                    elif kind == "stop":
+                        return
+        finally:
+            db.close()
+
+    def _write(self, db, writer, records):
+        """
+        Persist the records that are not archived yet in one transaction.
+        Possible duplicates are confirmed with one batched lookup.
+        """
+        if not records:
+            return
+
+        existing = self.dedup.find_existing(
+            db, [record["fingerprint"] for record in records]
+        )
+        for record in records:
+            fingerprint = record["fingerprint"]
+            if fingerprint in existing or writer.is_pending(fingerprint):
+                logging.debug(
+                    f"Skipping email with UID {record['uid']} for account {self.account_id}{self.location} as it already exists."
+                )
+                self.writer_stats["skipped"] += 1
+                continue
+
+            self.dedup.add(fingerprint)
+            writer.add(record)
+        writer.flush()
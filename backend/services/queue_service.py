@@ -1,15 +1,25 @@
 # Services are used to interact with the database, perform business logic and other necesarry core functions. They are to be imported into the routes. Services should not use FastAPI's Request and Response classes. They should only return data to the routes. The routes will then use this data to return a response to the client.
 
-# queue_manager.py is a script that manages a task queue for creating accounts and retrieving emails. It initializes the task queue with email retrieval tasks for existing accounts and processes tasks based on their execution time. The script uses a worker thread to process tasks and executes account creation and email retrieval tasks as needed.
+# queue_manager.py is a script that manages a task queue for creating accounts and retrieving emails. It initializes the task queue with email retrieval tasks for existing accounts and processes tasks based on their execution time. Tasks are kept in a min-heap ordered by their next execution time and a dispatcher thread sleeps until the earliest task is due or a new task is scheduled.
 
-import queue
+import heapq
+import itertools
 import threading
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from models.models import Account
 from models.database import get_db
+from config.config import config
 
+import services.attachment_service as attachment_service
 import services.email_service as email_service
+import services.import_service as import_service
+import services.idle_service as idle_service
+import services.suggest_service as suggest_service
+import services.address_service as address_service
+import services.dedup_service as dedup_service
+import services.search_service as search_service
 
 
 # Configure logging
@@ -17,12 +27,43 @@ logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-# Initialize queue
-task_queue = queue.Queue()
-
 # Task types
 ACCOUNT_CREATION = "account_creation"
 EMAIL_RETRIEVAL = "email_retrieval"
+BULK_IMPORT = "bulk_import"
+METADATA_BACKFILL = "metadata_backfill"
+SUGGEST_INDEX_BUILD = "suggest_index_build"
+BLOB_SWEEP = "blob_sweep"
+
+# Pseudo host used to limit concurrent imports from local disk
+IMPORT_HOST = "local-import"
+
+# Worker pool for email retrieval tasks
+retrieval_executor = ThreadPoolExecutor(
+    max_workers=config.SYNC_WORKERS, thread_name_prefix="email-retrieval"
+)
+
+# Single worker for the startup maintenance tasks, so they never take a
+# retrieval worker that the slot accounting believes is free
+maintenance_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="maintenance"
+)
+
+# Accounts that are currently being synced and open connections per server,
+# guarded by slot_lock
+slot_lock = threading.Lock()
+running_accounts = set()
+host_connections = {}
+# Open IMAP IDLE connections per server, limited separately
+idle_connections = {}
+# Retrieval tasks waiting for a free slot, rescheduled when a slot is released
+deferred_tasks = []
+
+# Queue lag and duration of the latest retrieval of each account
+task_stats = {}
+
+# Accounts with a push-triggered retrieval waiting to be dispatched
+pending_push_retrievals = set()
 
 
 class Task:
@@ -37,7 +78,7 @@ class Task:
         self.task_type = task_type
         self.task_data = task_data
         self.interval = interval
-        self.next_execution = next_execution or time.time() + interval
+        self.next_execution = next_execution or time.time() + (interval or 0)
         self.execute_immediately = execute_immediately
 
     def to_dict(self):
@@ -58,15 +99,133 @@ class Task:
         next_execution=None,
         execute_immediately=False,
     ):
-        if interval is None and execute_immediately:
+        if execute_immediately or interval is None:
             next_execution = time.time()
-        return {
-            "task_type": task_type,
-            "task_data": task_data,
-            "interval": interval,
-            "next_execution": next_execution or time.time() + (interval or 0),
-            "execute_immediately": execute_immediately,
-        }
+        return cls(
+            task_type,
+            task_data,
+            interval,
+            next_execution=next_execution,
+            execute_immediately=execute_immediately,
+        )
+
+
+class TaskScheduler:
+    """
+    Timer scheduler backed by a min-heap ordered by next_execution.
+
+    get() blocks until the earliest task is due. put() wakes the waiting
+    dispatcher, so a task that is due earlier than the current head of the
+    heap (e.g. an immediate task) fires right away.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()  # Keeps equal due times in FIFO order
+        self._condition = threading.Condition()
+
+    def put(self, task):
+        with self._condition:
+            heapq.heappush(
+                self._heap, (task.next_execution, next(self._counter), task)
+            )
+            self._condition.notify()
+
+    def get(self):
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay <= 0:
+                    return heapq.heappop(self._heap)[2]
+                self._condition.wait(timeout=delay)
+
+    def __len__(self):
+        with self._condition:
+            return len(self._heap)
+
+
+task_scheduler = TaskScheduler()
+
+
+def schedule_task(task):
+    task_scheduler.put(task)
+
+
+def request_immediate_retrieval(account_id):
+    """
+    Schedule a one-off email retrieval for an account, e.g. when IMAP IDLE
+    reports new messages. Requests for an account that already has one
+    waiting are coalesced.
+    """
+    with slot_lock:
+        if account_id in pending_push_retrievals:
+            return
+        pending_push_retrievals.add(account_id)
+    logging.debug(f"New mail reported for account {account_id}, scheduling retrieval.")
+    schedule_task(
+        Task.create_task(
+            EMAIL_RETRIEVAL,
+            {"account_id": account_id, "push": True},
+            execute_immediately=True,
+        )
+    )
+
+
+def acquire_idle_connection(host):
+    """
+    Reserve a connection to host for an IMAP IDLE watcher. Watchers hold
+    their connection for as long as they run, so they are limited by
+    MAX_IDLE_CONNECTIONS_PER_HOST instead of sharing the connections of
+    retrievals. Returns False if none is available.
+    """
+    with slot_lock:
+        if idle_connections.get(host, 0) >= config.MAX_IDLE_CONNECTIONS_PER_HOST:
+            return False
+        idle_connections[host] = idle_connections.get(host, 0) + 1
+        return True
+
+
+def release_idle_connection(host):
+    with slot_lock:
+        idle_connections[host] -= 1
+        if idle_connections[host] <= 0:
+            del idle_connections[host]
+
+
+def start_idle_watchers(account):
+    idle_service.start_idle_watchers(
+        account,
+        request_immediate_retrieval,
+        acquire_connection=acquire_idle_connection,
+        release_connection=release_idle_connection,
+    )
+
+
+def refresh_idle_watchers(account_id):
+    """
+    Restart the IDLE watchers of an account after its settings changed, so
+    they use the new server, credentials and inboxes, or stop them if push
+    was disabled.
+    """
+    idle_service.stop_idle_watchers(account_id)
+    db = next(get_db())
+    account = db.query(Account).filter(Account.id == account_id).first()
+    if account:
+        start_idle_watchers(account)
+
+
+def refresh_archive_caches():
+    """
+    Drop the in-memory state derived from the archived emails after another
+    process, such as import_archive.py, wrote to the database: cached search
+    results, the dedup filter and the suggestion index, which is rebuilt.
+    """
+    search_service.invalidate_search_cache()
+    dedup_service.reset_deduplicator()
+    schedule_task(Task.create_task(SUGGEST_INDEX_BUILD, {}))
 
 
 def initialize_email_retrieval_tasks():
@@ -76,13 +235,14 @@ def initialize_email_retrieval_tasks():
     """
     logging.info("Initializing email retrieval tasks...")
     db = next(get_db())
-    accounts = db.query(Account.id, Account.update_interval).all()
+    accounts = db.query(Account).all()
 
     for account in accounts:
-        account_id, interval = account
+        account_id, interval = account.id, account.update_interval
+        start_idle_watchers(account)
         task_data = {"account_id": account_id}
         task = Task.create_task(EMAIL_RETRIEVAL, task_data, interval)
-        task_queue.put(task)
+        schedule_task(task)
         logging.info(
             f"Added email retrieval task for account {account_id} to the queue."
         )
@@ -90,92 +250,256 @@ def initialize_email_retrieval_tasks():
     logging.info("Email retrieval tasks initialized.")
 
 
+def schedule_startup_tasks():
+    """
+    Schedule the one-off jobs run at startup: backfilling the metadata and
+    address index of emails archived before these were computed at ingest,
+    and building the suggestion index. Also schedule the periodic sweep of
+    unreferenced attachment files.
+    """
+    # The suggestion build is quick, so it runs before the long backfill
+    schedule_task(Task.create_task(SUGGEST_INDEX_BUILD, {}))
+    schedule_task(Task.create_task(METADATA_BACKFILL, {}))
+    schedule_task(Task.create_task(BLOB_SWEEP, {}, config.BLOB_SWEEP_INTERVAL))
+
+
+def acquire_retrieval_slot(account_id, host, task):
+    """
+    Reserve a worker, the account and a connection to its server. If all
+    workers are busy, the account is already being synced or the server has
+    reached its connection limit, the task is deferred until a slot is
+    released and False is returned.
+    """
+    with slot_lock:
+        if (
+            len(running_accounts) >= config.SYNC_WORKERS
+            or account_id in running_accounts
+            or host_connections.get(host, 0) >= config.MAX_CONNECTIONS_PER_HOST
+        ):
+            deferred_tasks.append(task)
+            return False
+        running_accounts.add(account_id)
+        host_connections[host] = host_connections.get(host, 0) + 1
+        return True
+
+
+def release_retrieval_slot(account_id, host):
+    with slot_lock:
+        running_accounts.discard(account_id)
+    _release_host_connection(host)
+
+
+def _release_host_connection(host):
+    with slot_lock:
+        host_connections[host] -= 1
+        if host_connections[host] <= 0:
+            del host_connections[host]
+
+        # Give deferred tasks another chance, they keep their original due
+        # time and therefore their position in the schedule
+        waiting = deferred_tasks[:]
+        deferred_tasks.clear()
+    for task in waiting:
+        schedule_task(task)
+
+
+def get_task_stats():
+    with slot_lock:
+        return {
+            "workers": config.SYNC_WORKERS,
+            "scheduled_tasks": len(task_scheduler),
+            "deferred_tasks": len(deferred_tasks),
+            "running_accounts": sorted(running_accounts),
+            "host_connections": dict(host_connections),
+            "idle_connections": dict(idle_connections),
+            "accounts": {
+                account_id: dict(stats) for account_id, stats in task_stats.items()
+            },
+        }
+
+
+def run_email_retrieval(account_id, account_data, host, scheduled_at):
+    started_at = time.time()
+    lag = max(started_at - scheduled_at, 0)
+    logging.info(
+        f"Starting email retrieval for account {account_id} (queue lag {lag:.2f}s)."
+    )
+    with slot_lock:
+        task_stats[account_id] = {
+            "scheduled_at": scheduled_at,
+            "started_at": started_at,
+            "lag_seconds": lag,
+            "finished_at": None,
+            "duration_seconds": None,
+        }
+
+    try:
+        email_service.fetch_and_archive_emails(account_id, *account_data)
+        logging.info(f"Email retrieval completed for account {account_id}.")
+    except Exception as e:
+        logging.error(f"Email retrieval failed for account {account_id}: {str(e)}")
+    finally:
+        finished_at = time.time()
+        with slot_lock:
+            task_stats[account_id]["finished_at"] = finished_at
+            task_stats[account_id]["duration_seconds"] = finished_at - started_at
+        release_retrieval_slot(account_id, host)
+
+
+def dispatch_task(task):
+    if task.task_type == ACCOUNT_CREATION:
+        email = task.task_data["email"]
+        password = task.task_data["password"]
+        protocol = task.task_data["protocol"]
+        server = task.task_data["server"]
+        port = task.task_data["port"]
+        update_interval = task.task_data["interval"]
+        selected_inboxes = task.task_data["selected_inboxes"]
+        push_enabled = task.task_data.get("push_enabled", False)
+        account_id = email_service.create_account(
+            email,
+            password,
+            protocol,
+            server,
+            port,
+            update_interval,
+            selected_inboxes,
+            push_enabled,
+        )
+        if account_id:
+            logging.info(
+                f"Account created successfully for {email}. Adding to email retrieval queue."
+            )
+            schedule_task(
+                Task.create_task(
+                    EMAIL_RETRIEVAL,
+                    {"account_id": account_id},
+                    interval=update_interval,
+                    execute_immediately=True,
+                )
+            )
+            if push_enabled:
+                db = next(get_db())
+                account = db.query(Account).filter(Account.id == account_id).first()
+                start_idle_watchers(account)
+        else:
+            logging.error(f"Failed to create account for {email}.")
+
+    elif task.task_type == EMAIL_RETRIEVAL:
+        account_id = task.task_data["account_id"]
+        db = next(get_db())  # Get a database session
+        account = db.query(Account).filter(Account.id == account_id).first()
+        if not account:
+            logging.error(f"Account with ID {account_id} not found.")
+            return
+
+        host = (account.server or "").lower()
+        if not acquire_retrieval_slot(account_id, host, task):
+            # The task keeps its scheduled time and is rescheduled as soon as
+            # a slot is released
+            return
+
+        if task.task_data.get("push"):
+            with slot_lock:
+                pending_push_retrievals.discard(account_id)
+
+        account_data = (
+            account.protocol,
+            account.server,
+            account.port,
+            account.email,
+            account.password,
+            account.selected_inboxes,
+        )
+        retrieval_executor.submit(
+            run_email_retrieval, account_id, account_data, host, task.next_execution
+        )
+
+    elif task.task_type == BULK_IMPORT:
+        account_id = task.task_data["account_id"]
+        # Imports share the account slot with retrievals and are limited like
+        # connections to a single server
+        if not acquire_retrieval_slot(account_id, IMPORT_HOST, task):
+            return
+        retrieval_executor.submit(
+            run_bulk_import, task.task_data["job_id"], account_id, IMPORT_HOST
+        )
+
+    elif task.task_type == METADATA_BACKFILL:
+        maintenance_executor.submit(run_metadata_backfill)
+    elif task.task_type == SUGGEST_INDEX_BUILD:
+        maintenance_executor.submit(run_suggest_index_build)
+    elif task.task_type == BLOB_SWEEP:
+        maintenance_executor.submit(run_blob_sweep)
+
+    # Update the next execution time based on the interval (if provided)
+    if task.interval is not None:
+        task.next_execution = time.time() + task.interval
+        task.execute_immediately = False  # Set execute_immediately back to False
+        schedule_task(task)
+
+
+def run_bulk_import(job_id, account_id, host):
+    try:
+        import_service.run_import_job(job_id)
+    finally:
+        release_retrieval_slot(account_id, host)
+
+
+def run_metadata_backfill():
+    try:
+        email_service.backfill_email_metadata()
+    except Exception as e:
+        logging.error(f"Metadata backfill failed: {str(e)}")
+    try:
+        address_service.backfill_email_addresses()
+    except Exception as e:
+        logging.error(f"Address backfill failed: {str(e)}")
+
+
+def run_blob_sweep():
+    try:
+        attachment_service.sweep_unreferenced_blobs()
+    except Exception as e:
+        logging.error(f"Sweeping the attachment store failed: {str(e)}")
+
+
+def run_suggest_index_build():
+    if not suggest_service.build_suggest_index():
+        logging.info(
+            f"Retrying the suggestion index build in {config.SUGGEST_BUILD_RETRY_DELAY} seconds."
+        )
+        schedule_task(
+            Task(
+                SUGGEST_INDEX_BUILD,
+                {},
+                None,
+                next_execution=time.time() + config.SUGGEST_BUILD_RETRY_DELAY,
+            )
+        )
+
+
 # Function to process tasks
 def process_tasks():
     while True:
-        current_time = time.time()
-        task = None
-
+        task = task_scheduler.get()
         try:
-            task_dict = task_queue.get(block=False)
-            task = Task(**task_dict)
-        except queue.Empty:
-            pass
-
-        if task:
-            if current_time >= task.next_execution or task.execute_immediately:
-                if task.task_type == ACCOUNT_CREATION:
-                    email = task.task_data["email"]
-                    password = task.task_data["password"]
-                    protocol = task.task_data["protocol"]
-                    server = task.task_data["server"]
-                    port = task.task_data["port"]
-                    update_interval = task.task_data["interval"]
-                    selected_inboxes = task.task_data["selected_inboxes"]
-                    account_id = email_service.create_account(
-                        email,
-                        password,
-                        protocol,
-                        server,
-                        port,
-                        update_interval,
-                        selected_inboxes,
-                    )
-                    if account_id:
-                        logging.info(
-                            f"Account created successfully for {email}. Adding to email retrieval queue."
-                        )
-                        task_queue.put(
-                            Task.create_task(
-                                EMAIL_RETRIEVAL,
-                                {"account_id": account_id},
-                                interval=update_interval,
-                                execute_immediately=True,
-                            )
-                        )
-                    else:
-                        logging.error(f"Failed to create account for {email}.")
-
-                elif task.task_type == EMAIL_RETRIEVAL:
-                    account_id = task.task_data["account_id"]
-                    db = next(get_db())  # Get a database session
-                    account = db.query(Account).filter(Account.id == account_id).first()
-                    if account:
-                        email_service.fetch_and_archive_emails(
-                            account_id,
-                            account.protocol,
-                            account.server,
-                            account.port,
-                            account.email,
-                            account.password,
-                            account.selected_inboxes,
-                        )
-                        logging.info(
-                            f"Email retrieval completed for account {account_id}."
-                        )
-                    else:
-                        logging.error(f"Account with ID {account_id} not found.")
-
-                # Update the next execution time based on the interval (if provided)
-                if task.interval is not None:
-                    task.next_execution = current_time + task.interval
-                    task.execute_immediately = (
-                        False  # Set execute_immediately back to False
-                    )
-                    task_queue.put(task.to_dict())
-            else:
-                # If the task is not ready for execution, put it back in the queue
-                task_queue.put(task.to_dict())
-                time.sleep(1)
-        else:
-            # If no tasks are available, sleep for a short interval before checking again
-            time.sleep(1)
+            dispatch_task(task)
+        except Exception as e:
+            logging.error(f"Failed to dispatch {task.task_type} task: {str(e)}")
 
 
-# Start worker thread
 task_worker = threading.Thread(target=process_tasks)
 
-# Initialize email retrieval tasks
-initialize_email_retrieval_tasks()
 
-task_worker.start()
+def start_task_worker():
+    """
+    Queue the retrieval of every account, start their IDLE watchers and the
+    startup tasks, then start the dispatcher thread. Called from the app
+    startup hook, so importing this module has no side effects.
+    """
+    if task_worker.is_alive():
+        return
+    initialize_email_retrieval_tasks()
+    schedule_startup_tasks()
+    task_worker.start()
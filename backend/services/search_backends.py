@@ -0,0 +1,311 @@
+# Services are used to interact with the database, perform business logic and other necesarry core functions. They are to be imported into the routes. Services should not use FastAPI's Request and Response classes. They should only return data to the routes. The routes will then use this data to return a response to the client.
+
+# search_backends.py contains the full-text search implementations for the supported databases. The backend is chosen from DATABASE_URL: SQLite uses an FTS5 table kept current by triggers, PostgreSQL a generated tsvector column with a GIN index. Both compile the text terms of a parsed query (see utils/search_query.py) into a single ranked statement together with the column predicates, and return the same result shape, so search_service does not depend on the database.
+
+import html
+import logging
+from sqlalchemy import Float, Integer, and_, or_, select, text
+from sqlalchemy.engine import make_url
+from config.config import config
+from models.models import Email
+
+logger = logging.getLogger(__name__)
+
+# Private use characters that the databases put around matches in
+# snippets. Snippets are escaped as HTML first and the markers replaced by
+# <mark> tags afterwards, so markup in the email text is never rendered.
+MATCH_START = "\ue000"
+MATCH_END = "\ue001"
+
+
+def highlight_snippet(snippet):
+    if snippet is None:
+        return None
+    return (
+        html.escape(snippet)
+        .replace(MATCH_START, "<mark>")
+        .replace(MATCH_END, "</mark>")
+    )
+
+
+class SearchBackend:
+    """
+    Full-text search over the subject, sender, recipients and body of emails.
+
+    search() returns (ids, next_position) where ids are the IDs of the
+    matching emails, best matches first, and next_position is the
+    dictionary to pass as position for the following page, or None.
+    iter_ids() streams all matching IDs in the same order, and snippets()
+    returns highlighted excerpts for some of them.
+    """
+
+    name = None
+
+    # Whether a higher rank is a better match
+    rank_descending = False
+
+    def ensure_index(self, engine):
+        raise NotImplementedError
+
+    def matches(self, terms):
+        """
+        Return a subquery of the IDs and rank of the emails matching all
+        SearchTerms in terms.
+        """
+        raise NotImplementedError
+
+    def snippets(self, db, terms, ids):
+        raise NotImplementedError
+
+    def ranked_query(self, terms, filters, position):
+        """
+        Select the IDs and rank of the emails matching terms and all SQL
+        expressions in filters that follow position, in rank order. Filters
+        are applied in the same statement by joining emails.
+        """
+        matches = self.matches(terms)
+        query = select(matches.c.id, matches.c.rank).select_from(matches)
+        if filters:
+            query = query.join(Email, Email.id == matches.c.id).where(*filters)
+
+        if position is not None:
+            rank, last_id = position.get("rank"), position.get("id", 0)
+            if isinstance(rank, (int, float)):
+                worse = matches.c.rank < rank if self.rank_descending else matches.c.rank > rank
+                query = query.where(or_(worse, and_(matches.c.rank == rank, matches.c.id > last_id)))
+
+        rank_order = matches.c.rank.desc() if self.rank_descending else matches.c.rank.asc()
+        return query.order_by(rank_order, matches.c.id)
+
+    def search(self, db, terms, filters, position, limit):
+        rows = db.execute(self.ranked_query(terms, filters, position).limit(limit + 1)).all()
+
+        next_position = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_position = {"rank": rows[-1].rank, "id": rows[-1].id}
+        return [row.id for row in rows], next_position
+
+    def iter_ids(self, db, terms, filters, position, batch_size):
+        """
+        Yield lists of up to batch_size matching IDs in rank order, fetched
+        from a server-side cursor.
+        """
+        result = db.execute(
+            self.ranked_query(terms, filters, position),
+            execution_options={"yield_per": batch_size},
+        )
+        for rows in result.partitions():
+            yield [row.id for row in rows]
+
+
+class Fts5SearchBackend(SearchBackend):
+    """
+    SQLite FTS5 external-content table over emails, ranked with bm25().
+    """
+
+    name = "fts5"
+
+    # Triggers keeping the external-content FTS5 table in sync with emails
+    TRIGGERS = {
+        "emails_fts_insert": """
+            CREATE TRIGGER emails_fts_insert AFTER INSERT ON emails BEGIN
+                INSERT INTO emails_fts(rowid, subject, sender, recipients, body)
+                VALUES (new.id, new.subject, new.sender, new.recipients, new.body);
+            END
+        """,
+        "emails_fts_delete": """
+            CREATE TRIGGER emails_fts_delete AFTER DELETE ON emails BEGIN
+                INSERT INTO emails_fts(emails_fts, rowid, subject, sender, recipients, body)
+                VALUES ('delete', old.id, old.subject, old.sender, old.recipients, old.body);
+            END
+        """,
+        "emails_fts_update": """
+            CREATE TRIGGER emails_fts_update AFTER UPDATE OF subject, sender, recipients, body ON emails BEGIN
+                INSERT INTO emails_fts(emails_fts, rowid, subject, sender, recipients, body)
+                VALUES ('delete', old.id, old.subject, old.sender, old.recipients, old.body);
+                INSERT INTO emails_fts(rowid, subject, sender, recipients, body)
+                VALUES (new.id, new.subject, new.sender, new.recipients, new.body);
+            END
+        """,
+    }
+
+    # Matching email IDs with their rank. bm25() is lower for better matches.
+    MATCHES_SQL = "SELECT rowid AS id, bm25(emails_fts) AS rank FROM emails_fts WHERE emails_fts MATCH :match"
+
+    # Highlighted excerpts from the best matching column
+    SNIPPET_SQL = """
+        SELECT rowid, snippet(emails_fts, -1, :start, :end, '…', 16)
+        FROM emails_fts
+        WHERE emails_fts MATCH :match AND rowid IN ({ids})
+    """
+
+    def ensure_index(self, engine):
+        """
+        Create the emails_fts table and its triggers. The index is rebuilt
+        from emails whenever a trigger had to be created, since rows may have
+        been written while it was not maintained.
+        """
+        with engine.begin() as connection:
+            existing_triggers = {
+                name
+                for (name,) in connection.execute(
+                    text("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+                )
+            }
+            connection.execute(
+                text(
+                    'CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(subject, sender, recipients, body, content="emails", content_rowid="id")'
+                )
+            )
+
+            missing_triggers = [name for name in self.TRIGGERS if name not in existing_triggers]
+            for name in missing_triggers:
+                connection.execute(text(self.TRIGGERS[name]))
+
+            if missing_triggers:
+                logging.info("Rebuilding the full-text search index.")
+                connection.execute(text("INSERT INTO emails_fts(emails_fts) VALUES ('rebuild')"))
+
+    @staticmethod
+    def match_expression(terms):
+        # Each term is a phrase, restricted to a column with a column filter;
+        # a trailing * makes the last word of the phrase a prefix
+        expressions = []
+        for term in terms:
+            phrase = '"' + " ".join(word.replace('"', '""') for word in term.words) + '"'
+            if term.prefix:
+                phrase += "*"
+            expressions.append(f"{term.column} : {phrase}" if term.column else phrase)
+        return " AND ".join(expressions)
+
+    def matches(self, terms):
+        return (
+            text(self.MATCHES_SQL)
+            .bindparams(match=self.match_expression(terms))
+            .columns(id=Integer, rank=Float)
+            .subquery("matches")
+        )
+
+    def snippets(self, db, terms, ids):
+        if not ids:
+            return {}
+        ids = ", ".join(str(int(email_id)) for email_id in ids)
+        rows = db.execute(
+            text(self.SNIPPET_SQL.format(ids=ids)),
+            {"match": self.match_expression(terms), "start": MATCH_START, "end": MATCH_END},
+        )
+        return {email_id: highlight_snippet(snippet) for email_id, snippet in rows}
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    PostgreSQL generated tsvector column with a GIN index, ranked with
+    ts_rank(). Text is split on non-alphanumeric characters before it is
+    indexed, so addresses and URLs are indexed word by word, and the 'simple'
+    configuration lowercases words without stemming. This matches the FTS5
+    unicode61 tokenizer, except that diacritics are kept.
+    """
+
+    name = "postgresql"
+    rank_descending = True
+
+    # Columns are indexed with their own weight, so terms can be restricted
+    # to one column with a weight label
+    COLUMN_WEIGHTS = {"subject": "A", "sender": "B", "recipients": "C", "body": "D"}
+
+    SEARCH_VECTOR_DDL = """
+        ALTER TABLE emails ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            {vectors}
+        ) STORED
+    """.format(
+        vectors=" ||\n            ".join(
+            f"setweight(to_tsvector('simple', regexp_replace(coalesce({column}, ''), '[^[:alnum:]]+', ' ', 'g')), '{weight}')"
+            for column, weight in COLUMN_WEIGHTS.items()
+        )
+    )
+    SEARCH_INDEX_DDL = (
+        "CREATE INDEX IF NOT EXISTS ix_emails_search_vector ON emails USING GIN (search_vector)"
+    )
+
+    # Matching email IDs with their rank, higher is better
+    MATCHES_SQL = """
+        SELECT id, ts_rank(search_vector, to_tsquery('simple', :query)) AS rank
+        FROM emails
+        WHERE search_vector @@ to_tsquery('simple', :query)
+    """
+
+    SNIPPET_SQL = text(
+        """
+        SELECT id, ts_headline(
+            'simple', coalesce(body, ''), to_tsquery('simple', :query), :options
+        )
+        FROM emails
+        WHERE id = ANY(:ids)
+        """
+    )
+
+    SNIPPET_OPTIONS = (
+        f"StartSel={MATCH_START}, StopSel={MATCH_END}, MaxWords=16, MinWords=6, FragmentDelimiter=…"
+    )
+
+    def ensure_index(self, engine):
+        with engine.begin() as connection:
+            connection.execute(text(self.SEARCH_VECTOR_DDL))
+            connection.execute(text(self.SEARCH_INDEX_DDL))
+
+    @classmethod
+    def tsquery_expression(cls, terms):
+        # websearch_to_tsquery has no prefix matching, so the query is built
+        # from quoted lexemes: <-> joins the words of a phrase, :* marks a
+        # prefix and a weight label restricts a lexeme to one column
+        expressions = []
+        for term in terms:
+            weight = cls.COLUMN_WEIGHTS[term.column] if term.column else ""
+            lexemes = []
+            for index, word in enumerate(term.words):
+                labels = ("*" if term.prefix and index == len(term.words) - 1 else "") + weight
+                lexeme = "'" + word.replace("'", "''") + "'"
+                lexemes.append(lexeme + ":" + labels if labels else lexeme)
+            expressions.append("(" + " <-> ".join(lexemes) + ")")
+        return " & ".join(expressions)
+
+    def matches(self, terms):
+        return (
+            text(self.MATCHES_SQL)
+            .bindparams(query=self.tsquery_expression(terms))
+            .columns(id=Integer, rank=Float)
+            .subquery("matches")
+        )
+
+    def snippets(self, db, terms, ids):
+        if not ids:
+            return {}
+        rows = db.execute(
+            self.SNIPPET_SQL,
+            {
+                "query": self.tsquery_expression(terms),
+                "ids": list(ids),
+                "options": self.SNIPPET_OPTIONS,
+            },
+        )
+        return {email_id: highlight_snippet(snippet) for email_id, snippet in rows}
+
+
+SEARCH_BACKENDS = {
+    "sqlite": Fts5SearchBackend,
+    "postgresql": PostgresSearchBackend,
+}
+
+
+def get_search_backend(database_url=None):
+    """
+    Return the search backend for the database in database_url, which
+    defaults to DATABASE_URL.
+    """
+    backend_name = make_url(database_url or config.DATABASE_URL).get_backend_name()
+    try:
+        return SEARCH_BACKENDS[backend_name]()
+    except KeyError:
+        raise ValueError(f"Full-text search is not supported on {backend_name} databases.")
@@ -1,97 +1,290 @@
+import html
 import logging
-import re
-from dateutil import parser
+import sys
+import threading
 import cachetools
-import hashlib
+from sqlalchemy import select
 from models.database import get_db
-from models.models import Email
-from sqlalchemy import func
-from sqlalchemy import or_
+from models.models import Account, Email
+from config.config import config
+from services.search_backends import get_search_backend
+from utils.pagination import (
+    decode_cursor,
+    decode_sort_value,
+    encode_cursor,
+    fetch_keyset_page,
+    iter_keyset_rows,
+)
+from utils.search_query import parse_search_query
 import time
 
 logger = logging.getLogger(__name__)
 
-# Create a cache with a maximum size of 1000 and a TTL of 5 minutes
-search_cache = cachetools.TTLCache(maxsize=1000, ttl=300)
+# Estimated memory of a cache entry besides its IDs: the key, the cursor
+# and the bookkeeping of the cache itself
+SEARCH_CACHE_ENTRY_OVERHEAD = 512
 
 
-def search_emails(query):
+def _cache_entry_size(entry):
+    ids, next_cursor = entry
+    return (
+        SEARCH_CACHE_ENTRY_OVERHEAD
+        + sys.getsizeof(ids)
+        + sum(sys.getsizeof(email_id) for email_id in ids)
+        + len(next_cursor or "")
+    )
+
+
+class SearchCache:
+    """
+    Least recently used cache of search result pages, bounded by the
+    estimated memory of its entries. Entries hold only the ranked email IDs
+    of a page and the cursor of the next one; the rows are read again on
+    every hit, so they are never stale.
+
+    Keys include a generation number that invalidate() increments whenever
+    emails are added or deleted. Entries of older generations can no longer
+    be hit and are evicted as the cache fills up.
+    """
+
+    def __init__(self, max_bytes):
+        self.entries = cachetools.LRUCache(maxsize=max_bytes, getsizeof=_cache_entry_size)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, normalized_query, cursor, limit):
+        return (self.generation, normalized_query, cursor, limit)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def set(self, key, ids, next_cursor):
+        entry = (tuple(ids), next_cursor)
+        with self.lock:
+            if key[0] != self.generation or _cache_entry_size(entry) > self.entries.maxsize:
+                return
+            while self.entries.currsize + _cache_entry_size(entry) > self.entries.maxsize:
+                self.entries.popitem()
+                self.evictions += 1
+            self.entries[key] = entry
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "generation": self.generation,
+                "entries": len(self.entries),
+                "bytes": self.entries.currsize,
+                "max_bytes": self.entries.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+search_cache = SearchCache(config.SEARCH_CACHE_BYTES)
+
+# Full-text search implementation of the configured database
+search_backend = get_search_backend()
+
+
+def search_filters(parsed):
+    """
+    Translate the column operators of a ParsedQuery into SQL expressions on
+    emails. Each can be answered from an index: account_id and date by
+    ix_emails_account_date_id and ix_emails_date_id, has:attachment by the
+    partial index ix_emails_attachments_date_id.
+    """
+    filters = []
+    if parsed.account:
+        if parsed.account.isdigit():
+            filters.append(Email.account_id == int(parsed.account))
+        else:
+            account_id = (
+                select(Account.id).where(Account.email == parsed.account).scalar_subquery()
+            )
+            filters.append(Email.account_id == account_id)
+    if parsed.has_attachment:
+        filters.append(Email.attachment_count > 0)
+    if parsed.after is not None:
+        filters.append(Email.date >= parsed.after)
+    if parsed.before is not None:
+        filters.append(Email.date < parsed.before)
+    return filters
+
+
+def invalidate_search_cache():
+    """
+    Make cached search results unreachable. Call after emails have been
+    added to or deleted from the archive.
+    """
+    search_cache.invalidate()
+
+
+def get_search_cache_stats():
+    return search_cache.stats()
+
+
+def _date_position(position):
+    if position is None or position.get("kind") != "date":
+        return None
+    return (decode_sort_value(position.get("value")), position.get("id", 0))
+
+
+def _search_by_date(db, filters, position, limit):
+    # Queries without text terms list the matching emails newest first
+    query = db.query(Email.id, Email.date).filter(*filters)
+    after = _date_position(position)
+    rows = fetch_keyset_page(query, Email.date, Email.id, after, True, limit + 1)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(
+            {"kind": "date", "value": rows[-1].date, "id": rows[-1].id}
+        )
+    return [row.id for row in rows], next_cursor
+
+
+def _load_emails(db, ids, snippets):
+    """
+    Read the listed columns of the emails in ids, in the order of ids.
+    snippets replaces the stored snippet of some of them with a highlighted
+    one. Snippets of search results are HTML, so stored snippets are
+    escaped.
+    """
+    if not ids:
+        return []
+    rows = db.query(
+        Email.id,
+        Email.account_id,
+        Email.subject,
+        Email.sender,
+        Email.recipients,
+        Email.date,
+        Email.snippet,
+        Email.fingerprint,
+    ).filter(Email.id.in_(ids))
+    emails_by_id = {row.id: dict(row._mapping) for row in rows}
+
+    emails = []
+    for email_id in ids:
+        email = emails_by_id.get(email_id)
+        if email is None:
+            continue  # Deleted since the IDs were cached
+        if email_id in snippets:
+            email["snippet"] = snippets[email_id]
+        elif email["snippet"]:
+            email["snippet"] = html.escape(email["snippet"])
+        emails.append(email)
+    return emails
+
+
+def search_emails(query, cursor=None, limit=None):
+    """
+    Search emails and return (emails, search_time, next_cursor). See
+    utils/search_query.py for the query syntax. Queries with text terms are
+    ranked by relevance; queries with only operators such as account: or a
+    date range list the matching emails newest first.
+    Pass next_cursor back to get the following page.
+    """
     start_time = time.time()
     logging.info(f"Searching for emails with query: {query}")
+    limit = max(1, min(limit or config.SEARCH_PAGE_SIZE, config.MAX_PAGE_SIZE))
 
-    # Generate a cache key based on the query
-    cache_key = hashlib.sha256(query.encode()).hexdigest()
+    parsed = parse_search_query(query.strip())
 
-    # Check if the search results are already cached
-    cached_results = search_cache.get(cache_key)
-    if cached_results is not None:
+    # Check if the query is empty
+    if parsed.is_empty():
+        logging.info("Empty search query. Returning no results.")
         end_time = time.time()
         search_time = end_time - start_time
-        logging.info("Returning cached search results.")
-        return cached_results, search_time
+        return [], search_time, None
 
     db = next(get_db())
 
-    # Remove leading/trailing whitespaces and convert to lowercase
-    query = query.strip().lower()
+    # Cached pages are shared by all spellings of the same query
+    cache_key = search_cache.key(parsed.normalized(), cursor, limit)
+    cached_results = search_cache.get(cache_key)
+    if cached_results is not None:
+        logging.info("Returning cached search results.")
+        ids, next_cursor = cached_results
+    else:
+        position = decode_cursor(cursor) if cursor else None
+        filters = search_filters(parsed)
 
-    # Check if the query is empty
-    if not query:
-        logging.info("Empty search query. Returning no results.")
-        end_time = time.time()
-        search_time = end_time - start_time
-        return [], search_time
-
-    # Check if the query contains a date range
-    date_range_pattern = r"(\d{1,2}\s+\w{3}\s+\d{4})\s*-\s*(\d{1,2}\s+\w{3}\s+\d{4})"
-    date_range_match = re.search(date_range_pattern, query)
-    if date_range_match:
-        start_date_str, end_date_str = date_range_match.groups()
-        try:
-            start_date = parser.parse(start_date_str, fuzzy=True).strftime("%Y-%m-%d")
-            end_date = parser.parse(end_date_str, fuzzy=True).strftime("%Y-%m-%d")
-            emails = (
-                db.query(
-                    Email.id,
-                    Email.account_id,
-                    Email.subject,
-                    Email.sender,
-                    Email.recipients,
-                    Email.date,
-                    Email.body,
-                    Email.fingerprint,
-                )
-                .filter(Email.date >= start_date)
-                .filter(Email.date <= end_date)
-                .all()
+        if parsed.terms:
+            # Text terms and column operators are answered by one ranked statement
+            if position is not None and position.get("kind") != search_backend.name:
+                position = None
+            ids, next_position = search_backend.search(
+                db, parsed.terms, filters, position, limit
             )
-            logging.info(f"Found {len(emails)} emails within the date range.")
-            search_cache[cache_key] = emails  # Cache the search results
-            return emails
-        except (ValueError, TypeError):
-            logging.info("Invalid date range format. Proceeding with text search.")
-
-    # Perform text search using the full-text search index
-    search_term = f"'{query}':*"
-    emails = (
-        db.query(
-            Email.id,
-            Email.account_id,
-            Email.subject,
-            Email.sender,
-            Email.recipients,
-            Email.date,
-            Email.body,
-            Email.fingerprint,
-        )
-        .filter(Email.__ts_vector__.op("@@")(func.to_tsquery(search_term)))
-        .all()
-    )
+            next_cursor = None
+            if next_position is not None:
+                next_cursor = encode_cursor(dict(next_position, kind=search_backend.name))
+        else:
+            ids, next_cursor = _search_by_date(db, filters, position, limit)
+
+        search_cache.set(cache_key, ids, next_cursor)  # Cache the result IDs
+
+    snippets = search_backend.snippets(db, parsed.terms, ids) if parsed.terms else {}
+    emails = _load_emails(db, ids, snippets)
 
     end_time = time.time()
     search_time = end_time - start_time
     logging.info(
         f"Found {len(emails)} emails matching the search query in {search_time} seconds."
     )
-    search_cache[cache_key] = emails  # Cache the search results
-    return emails, search_time
+    return emails, search_time, next_cursor
+
+
+def iter_search_results(query, cursor=None):
+    """
+    Yield every email matching query, starting after cursor, in the order
+    of search_emails. Results are read from a server-side cursor and
+    returned in batches of STREAM_BATCH_SIZE, so the first results are
+    available before the whole result set has been read. Streams are not
+    cached.
+    """
+    parsed = parse_search_query(query.strip())
+    if parsed.is_empty():
+        return
+
+    db = next(get_db())
+    position = decode_cursor(cursor) if cursor else None
+    filters = search_filters(parsed)
+    batch_size = config.STREAM_BATCH_SIZE
+
+    if parsed.terms:
+        if position is not None and position.get("kind") != search_backend.name:
+            position = None
+        batches = search_backend.iter_ids(db, parsed.terms, filters, position, batch_size)
+    else:
+        rows = iter_keyset_rows(
+            db.query(Email.id, Email.date).filter(*filters),
+            Email.date,
+            Email.id,
+            _date_position(position),
+            True,
+            batch_size,
+        )
+        batches = ([row.id for row in batch] for batch in rows)
+
+    for ids in batches:
+        snippets = search_backend.snippets(db, parsed.terms, ids) if parsed.terms else {}
+        yield from _load_emails(db, ids, snippets)
@@ -1,5 +1,7 @@
-from models.models import Email, Account, Attachment
+from sqlalchemy import func
+from models.models import Email, Account, Attachment, Address, EmailAddress
 from models.database import get_db
+from config.config import config
 
 
 def email_statistics():
@@ -16,3 +18,32 @@ def email_statistics():
     }
 
     return stats
+
+
+def sender_statistics(limit=20):
+    """
+    Return the addresses that sent the most emails with their email count,
+    read from the (role, address_id) index of the address index.
+    """
+    db = next(get_db())
+    limit = max(1, min(limit, config.MAX_PAGE_SIZE))
+
+    email_count = func.count().label("email_count")
+    top_senders = (
+        db.query(EmailAddress.address_id, email_count)
+        .filter(EmailAddress.role == "from")
+        .group_by(EmailAddress.address_id)
+        .order_by(email_count.desc())
+        .limit(limit)
+        .subquery()
+    )
+    senders = (
+        db.query(Address.address, Address.name, top_senders.c.email_count)
+        .join(top_senders, top_senders.c.address_id == Address.id)
+        .order_by(top_senders.c.email_count.desc(), Address.address)
+    )
+
+    return [
+        {"address": address, "name": name, "emailCount": count}
+        for address, name, count in senders
+    ]
@@ -0,0 +1,313 @@
+# Services are used to interact with the database, perform business logic and other necesarry core functions. They are to be imported into the routes. Services should not use FastAPI's Request and Response classes. They should only return data to the routes. The routes will then use this data to return a response to the client.
+
+# suggest_service.py serves type-ahead suggestions for the search box from an in-memory prefix index of the addresses and display names in Email.sender and Email.recipients and of frequent subject words. The index is a sorted array of lowercase keys searched with bisect. New keys go into a small sorted delta that is merged into the main array in the background, so lookups never wait for writes and a write never costs a pass over the whole index. It is built once at startup by a queue task and extended by the batch writer as emails are ingested; deleted emails are not removed, so counts are approximate.
+
+import bisect
+import heapq
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import getaddresses
+from operator import itemgetter
+from sqlalchemy import func
+from models.database import get_db
+from models.models import Email
+from config.config import config
+from utils.search_query import split_search_words
+
+logger = logging.getLogger(__name__)
+
+# Word starts of a value, after the first, are indexed as extra keys so
+# "smith" finds "John Smith" and "john.smith@example.com"
+WORD_STARTS = re.compile(r"(?<![^\W_])[^\W_]", re.UNICODE)
+MAX_KEY_WORDS = 4
+
+# Subject words shorter than this are not suggested
+MIN_SUBJECT_WORD_LENGTH = 3
+
+# Merges the delta into the main array. A worker of its own, since the
+# maintenance worker of the task queue may be busy with a long backfill.
+merge_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="suggest-merge")
+
+EMPTY_RUN = ([], [])
+
+
+def _index_keys(value):
+    key = value.lower()
+    starts = [match.start() for match in WORD_STARTS.finditer(key)][1:MAX_KEY_WORDS]
+    return [key] + [key[start:] for start in starts]
+
+
+def _subject_words(subject):
+    return {
+        word
+        for word in split_search_words(subject or "")
+        if len(word) >= MIN_SUBJECT_WORD_LENGTH and not any(c.isdigit() for c in word)
+    }
+
+
+def _sorted_run(pairs):
+    pairs.sort(key=itemgetter(0))
+    return [key for key, _ in pairs], [suggestion for _, suggestion in pairs]
+
+
+def _merge_runs(runs):
+    pairs = heapq.merge(*(zip(keys, targets) for keys, targets in runs), key=itemgetter(0))
+    keys, targets = [], []
+    for key, suggestion in pairs:
+        keys.append(key)
+        targets.append(suggestion)
+    return keys, targets
+
+
+def email_suggestions(sender, recipients, subject):
+    """
+    Return the (kind, value) suggestions found in one email, and its subject
+    words separately since those are only suggested once they are frequent.
+    """
+    suggestions = set()
+    for name, address in getaddresses([sender or "", recipients or ""]):
+        if "@" in address:
+            suggestions.add(("address", address.lower()))
+        name = name.strip()
+        if name and name.lower() != address.lower():
+            suggestions.add(("name", name))
+    return suggestions, _subject_words(subject)
+
+
+class PrefixIndex:
+    """
+    Suggestions keyed by every lowercase key produced by _index_keys. runs
+    holds sorted runs, the main array first and the delta last, each a
+    (keys, targets) pair where targets[i] is the suggestion of keys[i]; a
+    suggestion is a [kind, value, count] list shared by all of its keys.
+
+    Runs are never modified. Writers, serialized by lock, build new runs
+    and swap them in, so lookups read a consistent snapshot without taking
+    the lock. A write only rebuilds the delta; once it holds
+    SUGGEST_DELTA_LIMIT keys, merge() folds it into the main array on
+    merge_executor while a new delta takes the writes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = (EMPTY_RUN, EMPTY_RUN)
+        self.merge_scheduled = False
+        self.suggestions = {}  # (kind, lowercase value) -> suggestion
+        self.subject_word_counts = Counter()
+        self.ready = False
+        self.build_failed = False
+        # Highest ID of the emails archived before the build finished, and
+        # the highest ID the build counted
+        self.pending_max_id = None
+        self.built_through = 0
+        # Incremented by reset_build, so a merge started before is dropped
+        self.generation = 0
+
+    def __len__(self):
+        return sum(len(keys) for keys, _ in self.runs)
+
+    def _add(self, kind, value, count, new_keys):
+        suggestion = self.suggestions.get((kind, value.lower()))
+        if suggestion is not None:
+            suggestion[2] += count
+            return
+        suggestion = [kind, value, count]
+        self.suggestions[(kind, value.lower())] = suggestion
+        for key in _index_keys(value):
+            new_keys.append((key, suggestion))
+
+    def _insert_keys(self, new_keys):
+        if not new_keys:
+            return
+        *runs, delta = self.runs
+        delta = _merge_runs([delta, _sorted_run(new_keys)])
+        self.runs = (*runs, delta)
+        if len(delta[0]) >= config.SUGGEST_DELTA_LIMIT and not self.merge_scheduled:
+            self.merge_scheduled = True
+            merge_executor.submit(self.merge)
+
+    def merge(self):
+        """
+        Merge the delta into the main array. The merge runs outside the
+        lock; the delta is frozen and stays searchable until the merged
+        array replaces it, while writes go to a new delta.
+        """
+        try:
+            with self.lock:
+                if not self.ready:
+                    return
+                generation = self.generation
+                main, *deltas = self.runs
+                self.runs = (main, *deltas, EMPTY_RUN)
+            merged = _merge_runs([main, *deltas])
+            with self.lock:
+                if self.generation == generation:
+                    self.runs = (merged,) + self.runs[1 + len(deltas) :]
+        except Exception as e:
+            logging.error(f"Merging the suggestion index failed: {str(e)}")
+        finally:
+            self.merge_scheduled = False
+
+    def _add_counts(self, suggestion_counts, subject_word_counts):
+        new_keys = []
+        for (kind, value), count in suggestion_counts.items():
+            self._add(kind, value, count, new_keys)
+
+        for word, count in subject_word_counts.items():
+            previous = self.subject_word_counts[word]
+            self.subject_word_counts[word] = previous + count
+            if previous + count >= config.SUGGEST_MIN_SUBJECT_COUNT:
+                # Words become suggestions with their full count once frequent
+                added = count if previous >= config.SUGGEST_MIN_SUBJECT_COUNT else previous + count
+                self._add("subject", word, added, new_keys)
+        return new_keys
+
+    def add_emails(self, rows):
+        """
+        Add (id, sender, recipients, subject) rows of newly archived emails.
+        Until the startup build has finished only their highest ID is kept,
+        the build scans up to it; rows the build counted are skipped.
+        """
+        with self.lock:
+            if not self.ready:
+                for email_id, *_ in rows:
+                    self.pending_max_id = max(self.pending_max_id or 0, email_id)
+                return
+            rows = [row for row in rows if row[0] > self.built_through]
+            self._insert_keys(self._add_counts(*_count_suggestions(row[1:] for row in rows)))
+
+    def reset_build(self):
+        """
+        Empty the index before a build, discarding what a failed build
+        counted or, for a rebuild, the whole index. It is not ready until
+        the build has finished.
+        """
+        with self.lock:
+            self.runs = (EMPTY_RUN, EMPTY_RUN)
+            self.suggestions = {}
+            self.subject_word_counts = Counter()
+            self.ready = False
+            self.build_failed = False
+            # Emails reported so far are below the first max ID of the build
+            self.pending_max_id = None
+            self.built_through = 0
+            self.generation += 1
+
+    def add_build_counts(self, suggestion_counts, subject_word_counts):
+        # Writers leave the suggestions alone until the build has finished,
+        # so they are counted and sorted outside the lock
+        new_keys = self._add_counts(suggestion_counts, subject_word_counts)
+        run = _sorted_run(new_keys)
+        main, *deltas = self.runs
+        merged = _merge_runs([main, run])
+        with self.lock:
+            self.runs = (merged, *deltas)
+
+    def finish_build(self, scanned_through):
+        """
+        Make the index ready if the build has counted every email archived
+        so far, which it scanned up to scanned_through. Returns False if
+        emails above that have been archived meanwhile.
+        """
+        with self.lock:
+            if self.pending_max_id is not None and self.pending_max_id > scanned_through:
+                return False
+            self.built_through = scanned_through
+            self.pending_max_id = None
+            self.ready = True
+            return True
+
+    def lookup(self, prefix, limit):
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        found = {}
+        for keys, targets in self.runs:
+            position = bisect.bisect_left(keys, prefix)
+            end = min(position + config.SUGGEST_SCAN_LIMIT, len(keys))
+            while position < end and keys[position].startswith(prefix):
+                suggestion = targets[position]
+                found[id(suggestion)] = suggestion
+                position += 1
+        best = sorted(found.values(), key=lambda suggestion: -suggestion[2])[:limit]
+        return [{"kind": kind, "value": value, "count": count} for kind, value, count in best]
+
+
+suggest_index = PrefixIndex()
+
+
+def _count_suggestions(rows):
+    suggestion_counts = Counter()
+    subject_word_counts = Counter()
+    for sender, recipients, subject in rows:
+        suggestions, words = email_suggestions(sender, recipients, subject)
+        suggestion_counts.update(suggestions)
+        subject_word_counts.update(words)
+    return suggestion_counts, subject_word_counts
+
+
+def add_emails(records):
+    """
+    Add newly archived emails to the index. records are dictionaries with
+    id, sender, recipients and subject, such as those of the batch writer.
+    """
+    suggest_index.add_emails(
+        [
+            (record["id"], record["sender"], record["recipients"], record["subject"])
+            for record in records
+        ]
+    )
+
+
+def build_suggest_index():
+    """
+    Index the emails archived before the index was available. Emails are
+    scanned up to the highest ID read before each scan, and scanned again
+    above it until no email the batch writer reported is left out; those
+    the build counted are skipped when the writer adds them, so no email is
+    counted twice. Returns False if the build failed, the index then stays
+    not ready until a retry succeeds.
+    """
+    db = next(get_db())
+    started = time.time()
+    suggest_index.reset_build()
+    scanned_through = 0
+    try:
+        while True:
+            max_id = db.query(func.max(Email.id)).scalar() or 0
+            if max_id > scanned_through:
+                rows = (
+                    db.query(Email.sender, Email.recipients, Email.subject)
+                    .filter(Email.id > scanned_through, Email.id <= max_id)
+                    .yield_per(config.STREAM_BATCH_SIZE)
+                )
+                suggest_index.add_build_counts(*_count_suggestions(rows))
+                scanned_through = max_id
+            if suggest_index.finish_build(scanned_through):
+                break
+    except Exception as e:
+        suggest_index.build_failed = True
+        logging.error(f"Building the suggestion index failed: {str(e)}")
+        return False
+    logging.info(
+        f"Built the suggestion index with {len(suggest_index)} keys in {time.time() - started:.2f} seconds."
+    )
+    return True
+
+
+def suggest(prefix, limit=10):
+    """
+    Return up to limit suggestions starting with prefix, most frequent
+    first. ready is False while the startup build is still running, and
+    failed is True while a failed build waits to be retried.
+    """
+    limit = max(1, min(limit, config.MAX_PAGE_SIZE))
+    return {
+        "suggestions": suggest_index.lookup(prefix, limit),
+        "ready": suggest_index.ready,
+        "failed": suggest_index.build_failed,
+    }
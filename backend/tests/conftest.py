@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from cryptography.fernet import Fernet
+
+# Settings are read when config is imported, so the environment is set up
+# before any application module is loaded. Every test run gets its own
+# database and attachment store.
+TEST_DIR = tempfile.mkdtemp(prefix="email-archive-tests-")
+os.environ["SECRET_KEY"] = Fernet.generate_key().decode()
+os.environ["DATABASE_DIR"] = TEST_DIR
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TEST_DIR, 'archive.db')}"
+os.environ["ATTACHMENT_DIR"] = os.path.join(TEST_DIR, "attachments")
+
+# utils/encryption.py writes the key to .env in the working directory
+os.chdir(TEST_DIR)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.database import SessionLocal, engine, initialize_database  # noqa: E402
+from models.models import Base  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    initialize_database()
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(database):
+    """
+    Session on the test database. Every table is emptied after the test.
+    """
+    session = SessionLocal()
+    yield session
+    session.rollback()
+    with database.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+    session.close()
@@ -0,0 +1,116 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import services.attachment_service as attachment_service
+from api.routes.attachments import router
+from config.config import config
+from models.models import Account, Attachment, Email
+from services.attachment_service import parse_range_header
+from utils.attachment_store import blob_path, store_blob
+
+PAYLOAD = bytes(range(256)) * 4
+
+app = FastAPI()
+app.include_router(router, prefix="/attachments")
+client = TestClient(app)
+
+
+@pytest.fixture
+def attachment(db):
+    account = Account(email="me@example.com", protocol="imap", server="imap.example.com")
+    db.add(account)
+    db.flush()
+    email = Email(
+        account_id=account.id,
+        subject="Report",
+        sender="finance@example.com",
+        recipients="me@example.com",
+        date=datetime(2024, 5, 1),
+        body="",
+        fingerprint=b"\x02" * 32,
+    )
+    db.add(email)
+    db.flush()
+    sha256, size = store_blob(PAYLOAD)
+    attachment = Attachment(email_id=email.id, filename="report €.bin", sha256=sha256, size=size)
+    db.add(attachment)
+    db.commit()
+    return attachment
+
+
+def download(attachment, range_header=None):
+    headers = {"Range": range_header} if range_header else {}
+    return client.get(f"/attachments/download_attachment/{attachment.id}", headers=headers)
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        (None, None),
+        ("bytes=0-99", (0, 99)),
+        ("bytes=1000-", (1000, 1023)),
+        ("bytes=1000-5000", (1000, 1023)),
+        ("bytes=-24", (1000, 1023)),
+        ("bytes=-5000", (0, 1023)),
+        ("bytes=0-1,5-9", None),
+        ("items=0-9", None),
+        ("bytes=a-b", None),
+    ],
+)
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, len(PAYLOAD)) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1024-", "bytes=10-5", "bytes=-0"])
+def test_parse_range_header_rejects_unsatisfiable_ranges(header):
+    with pytest.raises(ValueError):
+        parse_range_header(header, len(PAYLOAD))
+
+
+def test_range_is_sent_with_206(attachment):
+    response = download(attachment, "bytes=100-199")
+    assert response.status_code == 206
+    assert response.content == PAYLOAD[100:200]
+    assert response.headers["content-range"] == f"bytes 100-199/{len(PAYLOAD)}"
+    assert response.headers["content-length"] == "100"
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["content-disposition"] == "attachment; filename*=utf-8''report%20%E2%82%AC.bin"
+
+
+def test_suffix_range_is_sent_with_206(attachment):
+    response = download(attachment, "bytes=-10")
+    assert response.status_code == 206
+    assert response.content == PAYLOAD[-10:]
+    assert response.headers["content-range"] == f"bytes {len(PAYLOAD) - 10}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}"
+
+
+def test_unsatisfiable_range_is_rejected_with_416(attachment):
+    response = download(attachment, f"bytes={len(PAYLOAD)}-")
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(PAYLOAD)}"
+
+
+@pytest.mark.parametrize("header", [None, "bytes=0-9,20-29"])
+def test_whole_file_is_sent_without_a_single_range(attachment, header):
+    response = download(attachment, header)
+    assert response.status_code == 200
+    assert response.content == PAYLOAD
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+def test_sweep_removes_old_unreferenced_blobs(attachment):
+    old = time.time() - config.BLOB_GRACE_PERIOD - 60
+    orphan, _ = store_blob(b"deleted email")
+    recent, _ = store_blob(b"attachment row not committed yet")
+    for sha256 in (orphan, attachment.sha256):
+        os.utime(blob_path(sha256), (old, old))
+
+    assert attachment_service.sweep_unreferenced_blobs() == 1
+    assert not os.path.exists(blob_path(orphan))
+    assert os.path.exists(blob_path(recent))
+    assert os.path.exists(blob_path(attachment.sha256))
@@ -0,0 +1,145 @@
+import builtins
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy import event
+
+import services.email_service as email_service
+from config.config import config
+from models.database import engine
+from models.models import Account, Attachment, Email, MailboxSyncState, Pop3SeenMessage
+from utils.attachment_store import store_blob
+
+# Columns holding the raw bodies, but not body_size
+RAW_BODY_COLUMNS = re.compile(r"emails\.(body|html_body)\b")
+
+
+def test_email_details_use_the_stored_rendering(db, monkeypatch):
+    html = "<html><body>" + "<p>quarterly figures</p>" * 100000 + "</body></html>"
+    account = Account(email="reader@example.com", protocol="imap", server="imap.example.com")
+    db.add(account)
+    db.flush()
+    email = Email(
+        account_id=account.id,
+        subject="Report",
+        sender="finance@example.com",
+        recipients="reader@example.com",
+        date=datetime(2024, 5, 1, 8, 0),
+        body="quarterly figures " * 100000,
+        html_body=html,
+        content_type="text/html",
+        rendered_body=html,
+        body_size=len(html),
+        fingerprint=b"\x01" * 32,
+    )
+    db.add(email)
+    db.flush()
+    sha256, size = store_blob(b"%PDF-1.4 figures")
+    db.add(Attachment(email_id=email.id, filename="figures.pdf", sha256=sha256, size=size))
+    db.commit()
+    email_id = email.id
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the stored body was rendered again")
+
+    monkeypatch.setattr(email_service, "render_body", fail)
+    monkeypatch.setattr(email_service, "render_email", fail)
+
+    attachment_dir = os.path.abspath(config.ATTACHMENT_DIR)
+    builtin_open = builtins.open
+
+    def guarded_open(file, *args, **kwargs):
+        if isinstance(file, str) and os.path.abspath(file).startswith(attachment_dir):
+            raise AssertionError("an attachment payload was read")
+        return builtin_open(file, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", guarded_open)
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        details = email_service.get_email_details(email_id)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    assert details["email"]["body"] == html
+    assert details["email"]["content_type"] == "text/html"
+    assert details["is_large_file"] is True
+    assert details["attachments"] == [{"id": details["attachments"][0]["id"], "filename": "figures.pdf"}]
+
+    # One query for the email, one for the attachment metadata
+    assert len(statements) == 2
+    email_query, attachment_query = statements
+    assert re.search(r"\bFROM emails\b", email_query)
+    assert not RAW_BODY_COLUMNS.search(email_query)
+    assert re.search(r"\bFROM attachments\b", attachment_query)
+    assert not re.search(r"attachments\.content\b", attachment_query)
+
+
+HEADERS = b"Subject: Hello\r\nFrom: alice@example.com\r\nMessage-ID: <%d@example.com>\r\n\r\n"
+
+
+class FetchClient:
+    def __init__(self, data):
+        self.data = data
+
+    def uid(self, command, uids, items):
+        return "OK", self.data
+
+
+class NoDuplicates:
+    def find_existing(self, db, fingerprints):
+        return set()
+
+
+def test_fetch_entries_without_uid_or_size_are_failed(db):
+    account = Account(email="reader@example.com", protocol="imap", server="imap.example.com")
+    db.add(account)
+    db.flush()
+    state = MailboxSyncState(account_id=account.id, mailbox="INBOX", last_uid=0)
+    db.add(state)
+    db.commit()
+
+    client = FetchClient(
+        [
+            (b"1 (UID 11 RFC822.SIZE 120 BODY[HEADER.FIELDS (...)] {60}", HEADERS % 11),
+            b")",
+            # UID sent after the literal
+            (b"2 (RFC822.SIZE 130 BODY[HEADER.FIELDS (...)] {60}", HEADERS % 12),
+            b" UID 12)",
+            # No RFC822.SIZE
+            (b"3 (UID 13 BODY[HEADER.FIELDS (...)] {60}", HEADERS % 13),
+            b")",
+            (b"4 (UID 15 RFC822.SIZE 140 BODY[HEADER.FIELDS (...)] {60}", HEADERS % 15),
+            b")",
+        ]
+    )
+    stats = {"skipped": 0}
+    new_messages, missing = email_service._filter_new_messages(
+        client, db, NoDuplicates(), account.id, ["11", "12", "13", "14", "15"], stats
+    )
+    assert new_messages == [("11", 120), ("12", 130), ("15", 140)]
+    assert missing == ["13", "14"]
+
+    # Failed UIDs hold the checkpoint below them
+    email_service._uid_checkpoint(state.id, 15, set(missing))(db)
+    db.refresh(state)
+    assert state.last_uid == 12
+
+
+def test_pop3_checkpoint_ignores_recorded_uidls(db):
+    account = Account(email="reader@example.com", protocol="pop3", server="pop.example.com")
+    db.add(account)
+    db.commit()
+
+    email_service._pop3_checkpoint(account.id, ["a", "b"], set())(db)
+    # An overlapping sync records "b" again, "d" failed
+    email_service._pop3_checkpoint(account.id, ["b", "c", "b", "d"], {"d"})(db)
+
+    uidls = [uidl for (uidl,) in db.query(Pop3SeenMessage.uidl).order_by(Pop3SeenMessage.uidl)]
+    assert uidls == ["a", "b", "c"]
@@ -0,0 +1,50 @@
+import threading
+
+import services.queue_service as queue_service
+from config.config import config
+from services.idle_service import IdleWatcher
+
+
+def test_idle_connections_have_their_own_limit(monkeypatch):
+    monkeypatch.setattr(config, "MAX_CONNECTIONS_PER_HOST", 2)
+    monkeypatch.setattr(config, "MAX_IDLE_CONNECTIONS_PER_HOST", 3)
+    host = "imap.example.net"
+
+    assert all(queue_service.acquire_idle_connection(host) for _ in range(3))
+    assert not queue_service.acquire_idle_connection(host)
+    # Retrievals still get every connection they are allowed
+    assert queue_service.host_connections.get(host) is None
+
+    for _ in range(3):
+        queue_service.release_idle_connection(host)
+    assert host not in queue_service.idle_connections
+
+
+def test_watcher_catches_up_after_reconnecting(monkeypatch):
+    monkeypatch.setattr(config, "IDLE_BACKOFF_BASE", 0)
+    requests = []
+    idle_calls = []
+    done = threading.Event()
+
+    def on_new_mail(account_id):
+        requests.append(account_id)
+
+    watcher = IdleWatcher(7, "imap.example.net", 993, "me", b"", "INBOX", on_new_mail)
+
+    def idle_once():
+        idle_calls.append(len(requests))
+        if len(idle_calls) == 1:
+            raise OSError("connection reset")
+        watcher.stop_event.set()
+        done.set()
+        return False
+
+    monkeypatch.setattr(watcher, "_connect", lambda: None)
+    monkeypatch.setattr(watcher, "_idle_once", idle_once)
+    watcher.start()
+    assert done.wait(5)
+    watcher.join(5)
+
+    # No retrieval on the first connection, one after the reconnect
+    assert idle_calls == [0, 1]
+    assert requests == [7]
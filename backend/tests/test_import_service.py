@@ -0,0 +1,42 @@
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import services.dedup_service as dedup_service
+import services.import_service as import_service
+import services.queue_service as queue_service
+from api.routes.imports import router
+from config.config import config
+
+
+def test_finished_import_jobs_expire(db, tmp_path, monkeypatch):
+    job_id = import_service.create_import_job(12345, str(tmp_path / "missing.mbox"))
+    import_service.run_import_job(job_id)
+
+    job = import_service.get_import_job(job_id)
+    assert job["status"] == "failed"
+    assert job["finished_at"] <= time.time()
+
+    running_id = import_service.create_import_job(12345, str(tmp_path))
+    monkeypatch.setattr(config, "IMPORT_JOB_TTL", 0)
+    monkeypatch.setattr(import_service.time, "time", lambda: job["finished_at"] + 1)
+
+    assert import_service.get_import_job(job_id) is None
+    assert job_id not in import_service.import_jobs
+    # Jobs that have not finished are kept
+    assert import_service.get_import_job(running_id)["status"] == "queued"
+
+
+def test_refresh_caches_reloads_the_archive_state(db, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(queue_service, "schedule_task", scheduled.append)
+    dedup = dedup_service.get_deduplicator(db)
+
+    app = FastAPI()
+    app.include_router(router, prefix="/imports")
+    response = TestClient(app).post("/imports/refresh_caches")
+
+    assert response.status_code == 200
+    assert [task.task_type for task in scheduled] == [queue_service.SUGGEST_INDEX_BUILD]
+    assert dedup_service.get_deduplicator(db) is not dedup
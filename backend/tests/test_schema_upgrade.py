@@ -0,0 +1,123 @@
+import hashlib
+import os
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+import models.database as database
+import services.email_service as email_service
+from models.database import SessionLocal
+from models.models import Account, Attachment, Email
+from utils.attachment_store import blob_path
+
+# Tables as created by the first release, before the columns and tables of
+# later versions existed
+BASELINE_SCHEMA = [
+    """
+    CREATE TABLE accounts (
+        id INTEGER NOT NULL, email VARCHAR, password VARCHAR, protocol VARCHAR,
+        server VARCHAR, port INTEGER, available_inboxes VARCHAR,
+        selected_inboxes VARCHAR, update_interval INTEGER,
+        PRIMARY KEY (id), UNIQUE (email)
+    )
+    """,
+    """
+    CREATE TABLE emails (
+        id INTEGER NOT NULL, account_id INTEGER, subject VARCHAR, sender VARCHAR,
+        recipients VARCHAR, date DATETIME, body TEXT, fingerprint VARCHAR,
+        PRIMARY KEY (id), FOREIGN KEY(account_id) REFERENCES accounts (id),
+        UNIQUE (fingerprint)
+    )
+    """,
+    """
+    CREATE TABLE email_uids (
+        id INTEGER NOT NULL, account_id INTEGER, uid VARCHAR,
+        PRIMARY KEY (id), FOREIGN KEY(account_id) REFERENCES accounts (id)
+    )
+    """,
+    """
+    CREATE TABLE attachments (
+        id INTEGER NOT NULL, email_id INTEGER, filename VARCHAR, content VARCHAR,
+        cid VARCHAR, PRIMARY KEY (id), FOREIGN KEY(email_id) REFERENCES emails (id)
+    )
+    """,
+]
+
+PAYLOAD = b"%PDF-1.4 invoice"
+
+
+@pytest.fixture
+def baseline_engine(tmp_path):
+    """
+    Database with the baseline schema and one archived email, used by the
+    sessions of the application for the duration of the test.
+    """
+    engine = create_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    with engine.begin() as connection:
+        for ddl in BASELINE_SCHEMA:
+            connection.execute(text(ddl))
+        connection.execute(
+            text(
+                "INSERT INTO accounts (id, email, protocol, server, port, update_interval) "
+                "VALUES (1, 'me@example.com', 'imap', 'imap.example.com', 993, 300)"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO emails (id, account_id, subject, sender, recipients, date, body, fingerprint) "
+                "VALUES (1, 1, 'Invoice', 'Billing <billing@example.com>', 'me@example.com', "
+                "'2024-03-01 09:30:00.000000', '<p>Your   invoice</p>', :fingerprint)"
+            ),
+            {"fingerprint": hashlib.sha256(b"invoice").hexdigest()},
+        )
+        connection.execute(
+            text(
+                "INSERT INTO attachments (id, email_id, filename, content) "
+                "VALUES (1, 1, 'invoice.pdf', :content)"
+            ),
+            {"content": PAYLOAD},
+        )
+
+    SessionLocal.configure(bind=engine)
+    yield engine
+    SessionLocal.configure(bind=database.engine)
+    engine.dispose()
+
+
+def test_metadata_backfill_upgrades_baseline_database(baseline_engine):
+    assert email_service.backfill_email_metadata() == 1
+
+    columns = {column["name"] for column in inspect(baseline_engine).get_columns("attachments")}
+    assert "content" not in columns
+
+    session = SessionLocal()
+    try:
+        account = session.query(Account).one()
+        assert account.push_enabled is False
+
+        email = session.query(Email).one()
+        assert email.fingerprint == hashlib.sha256(b"invoice").digest()
+        assert email.content_type == "text/html"
+        assert email.snippet == "Your invoice"
+        assert email.attachment_count == 1
+        assert email.size_bytes > len(PAYLOAD)
+
+        attachment = session.query(Attachment).one()
+        assert attachment.sha256 == hashlib.sha256(PAYLOAD).hexdigest()
+        assert attachment.size == len(PAYLOAD)
+        assert attachment.content_type == "application/pdf"
+        assert attachment.inline is False
+        with open(blob_path(attachment.sha256), "rb") as f:
+            assert f.read() == PAYLOAD
+    finally:
+        session.close()
+
+
+def test_schema_upgrade_is_idempotent(baseline_engine):
+    database.upgrade_schema(baseline_engine)
+    indexes = {index["name"] for index in inspect(baseline_engine).get_indexes("emails")}
+    database.upgrade_schema(baseline_engine)
+
+    assert {index["name"] for index in inspect(baseline_engine).get_indexes("emails")} == indexes
+    assert "ix_emails_date_id" in indexes
+    assert os.path.exists(blob_path(hashlib.sha256(PAYLOAD).hexdigest()))
@@ -0,0 +1,218 @@
+import hashlib
+import os
+import re
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+import services.search_service as search_service
+from models.database import engine
+from models.models import Account, Base, Email
+from services.search_backends import get_search_backend
+from utils.search_query import parse_search_query
+
+
+def add_email(db, account, subject, body, date=datetime(2024, 1, 15, 12, 0), **columns):
+    email = Email(
+        account_id=account.id,
+        subject=subject,
+        sender=columns.pop("sender", "Alice Example <alice@example.com>"),
+        recipients=columns.pop("recipients", "bob@example.com"),
+        date=date,
+        body=body,
+        snippet=body[:160],
+        attachment_count=0,
+        fingerprint=hashlib.sha256(f"{subject}|{body}|{date}".encode()).digest(),
+        **columns,
+    )
+    db.add(email)
+    return email
+
+
+@pytest.fixture
+def account(db):
+    account = Account(email="bob@example.com", protocol="imap", server="imap.example.com")
+    db.add(account)
+    db.flush()
+    search_service.invalidate_search_cache()
+    yield account
+    search_service.invalidate_search_cache()
+
+
+def test_snippets_escape_the_email_text(db, account):
+    add_email(db, account, "Reminder", "<script>alert(1)</script> your invoice is due")
+    add_email(db, account, "Plain", "<b>bold</b> text without the search word")
+    db.commit()
+
+    emails, _, _ = search_service.search_emails("invoice")
+    assert len(emails) == 1
+    snippet = emails[0]["snippet"]
+    assert "<script>" not in snippet
+    assert "&lt;script&gt;" in snippet
+    assert "<mark>invoice</mark>" in snippet
+
+    # Stored snippets of results without text terms are escaped as well
+    emails, _, _ = search_service.search_emails("after:2024-01-01")
+    assert {email["snippet"] for email in emails} == {
+        "&lt;script&gt;alert(1)&lt;/script&gt; your invoice is due",
+        "&lt;b&gt;bold&lt;/b&gt; text without the search word",
+    }
+
+
+# Emails searched by every backend, by subject
+CORPUS = [
+    ("Invoice March", "Alice Example <alice@example.com>", "Please pay the attached invoice by Friday."),
+    ("Invoices overdue", "Billing <billing@example.com>", "Two invoices are still open."),
+    ("Project kickoff", "Carol <carol@example.com>", "Agenda for the project kickoff meeting."),
+    ("Weekly report", "Alice Example <alice@example.com>", "The kickoff of the project moved to Monday."),
+    ("Lunch", "Dave <dave@example.com>", "Anyone up for lunch? No report today."),
+]
+
+# Queries with the subjects they must find on every backend
+CORPUS_QUERIES = [
+    ("invoice", {"Invoice March", "Invoices overdue"}),
+    ('"invoice"', {"Invoice March"}),
+    ('"project kickoff"', {"Project kickoff"}),
+    ("project kickoff", {"Project kickoff", "Weekly report"}),
+    ("from:alice", {"Invoice March", "Weekly report"}),
+    ("subject:report", {"Weekly report"}),
+    ("report", {"Weekly report", "Lunch"}),
+    ("from:alice kickoff", {"Weekly report"}),
+    ("to:bob lunch", {"Lunch"}),
+    ("nothing-matches-this", set()),
+]
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def search_session(request):
+    """
+    Session on a database of the parameter's kind holding CORPUS, with its
+    search backend. PostgreSQL runs against TEST_POSTGRES_URL and is skipped
+    when that is not set or not reachable.
+    """
+    if request.param == "sqlite":
+        session = request.getfixturevalue("db")
+        engine = None
+    else:
+        url = os.getenv("TEST_POSTGRES_URL")
+        if not url:
+            pytest.skip("TEST_POSTGRES_URL is not set")
+        try:
+            engine = create_engine(url)
+            engine.connect().close()
+        except Exception as e:
+            pytest.skip(f"PostgreSQL is not available: {e}")
+        Base.metadata.create_all(engine)
+        session = Session(bind=engine)
+
+    backend = get_search_backend(str(session.get_bind().url))
+    if engine is not None:
+        backend.ensure_index(engine)
+
+    account = Account(email="bob@example.com", protocol="imap", server="imap.example.com")
+    session.add(account)
+    session.flush()
+    for subject, sender, body in CORPUS:
+        add_email(session, account, subject, body, sender=sender)
+    session.commit()
+
+    yield session, backend
+
+    if engine is not None:
+        session.close()
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+
+
+@pytest.mark.parametrize("query, subjects", CORPUS_QUERIES)
+def test_backends_find_the_same_emails(search_session, query, subjects):
+    session, backend = search_session
+    parsed = parse_search_query(query)
+    ids, next_position = backend.search(
+        session, parsed.terms, search_service.search_filters(parsed), None, 50
+    )
+
+    found = {subject for (subject,) in session.query(Email.subject).filter(Email.id.in_(ids))}
+    assert found == subjects
+    assert len(ids) == len(found)
+    assert next_position is None
+
+    assert set(backend.snippets(session, parsed.terms, ids)) == set(ids)
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "from:alice after:2024-01-01 invoice",
+        "subject:report account:1 before:2025-01-01 kickoff",
+        "has:attachment invoice",
+    ],
+)
+def test_operator_queries_use_the_full_text_index(query):
+    parsed = parse_search_query(query)
+    statement = search_service.search_backend.ranked_query(
+        parsed.terms, search_service.search_filters(parsed), None
+    ).limit(21)
+    sql = str(statement.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+
+    with engine.connect() as connection:
+        plan = [row.detail for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)]
+
+    # Matches come from the FTS index, emails are only looked up by rowid
+    assert any(re.match(r"SCAN emails_fts VIRTUAL TABLE INDEX \d+:M", detail) for detail in plan)
+    assert not [detail for detail in plan if re.search(r"\bSCAN emails\b", detail)]
+    assert "SEARCH emails USING INTEGER PRIMARY KEY (rowid=?)" in plan
+
+
+@pytest.mark.parametrize("with_cursor", [False, True])
+@pytest.mark.parametrize(
+    "query, index",
+    [
+        ("has:attachment", "ix_emails_attachments_date_id"),
+        ("has:attachment after:2024-01-01", "ix_emails_attachments_date_id"),
+        ("account:1", "ix_emails_account_date_id"),
+        ("account:bob@example.com", "ix_emails_account_date_id"),
+        ("account:1 before:2025-01-01", "ix_emails_account_date_id"),
+        ("after:2024-01-01", "ix_emails_date_id"),
+        ("before:2025-01-01", "ix_emails_date_id"),
+        ("after:2024-01-01 before:2025-01-01", "ix_emails_date_id"),
+    ],
+)
+def test_operator_only_queries_use_the_date_indexes(db, query, index, with_cursor):
+    parsed = parse_search_query(query)
+    position = None
+    if with_cursor:
+        position = search_service.decode_cursor(
+            search_service.encode_cursor({"kind": "date", "value": datetime(2024, 6, 1), "id": 100})
+        )
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        search_service._search_by_date(db, search_service.search_filters(parsed), position, 20)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+    assert statements
+    with engine.connect() as connection:
+        for statement, parameters in statements:
+            plan = [
+                row.detail
+                for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+            ]
+            assert any(
+                re.match(rf"SEARCH emails USING (COVERING )?INDEX {index} \(", detail)
+                for detail in plan
+            ), plan
+            assert not [detail for detail in plan if re.search(r"\bSCAN emails\b", detail)]
+            if "date IS NOT NULL" in statement:
+                # Emails with a date are read in index order. The segment of
+                # emails without one is sorted by ID, but a date comparison
+                # makes it empty.
+                assert not [detail for detail in plan if "TEMP B-TREE" in detail], plan
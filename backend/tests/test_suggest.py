@@ -0,0 +1,158 @@
+import time
+from collections import Counter
+from datetime import datetime
+
+import pytest
+
+import services.suggest_service as suggest_service
+from config.config import config
+from models.models import Account, Email
+from services.suggest_service import PrefixIndex
+
+# Addresses in the large index, with three keys each
+LARGE_INDEX_ADDRESSES = 200000
+
+
+def email_rows(first_id, count, domain="example.com"):
+    return [
+        (first_id + i, f"Sender {i} <sender{i}@{domain}>", "me@example.com", "Status update")
+        for i in range(count)
+    ]
+
+
+def built_index(suggestion_counts=None):
+    index = PrefixIndex()
+    index.add_build_counts(suggestion_counts or Counter(), Counter())
+    assert index.finish_build(0)
+    return index
+
+
+def test_adding_emails_does_not_rebuild_a_large_index():
+    index = built_index(
+        Counter(
+            {("address", f"user{i}@host{i % 1000}.example"): 1 for i in range(LARGE_INDEX_ADDRESSES)}
+        )
+    )
+    assert len(index) >= 3 * LARGE_INDEX_ADDRESSES
+
+    started = time.perf_counter()
+    index.add_emails(email_rows(1, 100))
+    elapsed = time.perf_counter() - started
+
+    # Rebuilding the main array for every batch takes about a second here
+    assert elapsed < 0.2
+    assert not index.merge_scheduled
+    assert index.lookup("sender42@", 5)[0]["value"] == "sender42@example.com"
+    assert index.lookup("user42@", 5)[0]["value"] == "user42@host42.example"
+
+
+def test_full_delta_is_merged_in_the_background(monkeypatch):
+    monkeypatch.setattr(config, "SUGGEST_DELTA_LIMIT", 50)
+    index = built_index(Counter({("address", "alice@example.com"): 2}))
+
+    index.add_emails(email_rows(1, 3))
+    assert len(index.runs[-1][0]) < 50
+    index.add_emails(email_rows(4, 30, domain="example.org"))
+    # Wait for the merge queued by the write
+    suggest_service.merge_executor.submit(lambda: None).result()
+
+    main, delta = index.runs
+    assert delta == ([], [])
+    assert main[0] == sorted(main[0])
+    assert len(main[0]) == len(index)
+    assert index.lookup("alice", 5) == [{"kind": "address", "value": "alice@example.com", "count": 2}]
+    assert {suggestion["value"] for suggestion in index.lookup("sender1@", 10)} == {
+        "sender1@example.com",
+        "sender1@example.org",
+    }
+    # Names found in both batches share one suggestion
+    assert index.lookup("sender 1", 1) == [{"kind": "name", "value": "Sender 1", "count": 2}]
+
+
+@pytest.fixture
+def suggest_index(monkeypatch):
+    index = PrefixIndex()
+    monkeypatch.setattr(suggest_service, "suggest_index", index)
+    return index
+
+
+def archive(db, count, first=0):
+    account = db.query(Account).first()
+    if account is None:
+        account = Account(email="me@example.com", protocol="imap", server="imap.example.com")
+        db.add(account)
+        db.flush()
+    emails = [
+        Email(
+            account_id=account.id,
+            subject="Status update",
+            sender=f"Sender {i} <sender{i}@example.com>",
+            recipients="me@example.com",
+            date=datetime(2024, 1, 1),
+            body="",
+            fingerprint=i.to_bytes(32, "big"),
+        )
+        for i in range(first, first + count)
+    ]
+    db.add_all(emails)
+    db.commit()
+    return [(email.id, email.sender, email.recipients, email.subject) for email in emails]
+
+
+def test_emails_archived_during_the_build_are_counted_once(db, suggest_index, monkeypatch):
+    archive(db, 3)
+    rows = []
+    count_suggestions = suggest_service._count_suggestions
+
+    def archive_during_scan(scanned):
+        # The batch writer reports an email while the first scan runs
+        if not rows:
+            rows.extend(archive(db, 1, first=3))
+            suggest_index.add_emails(rows)
+        return count_suggestions(scanned)
+
+    monkeypatch.setattr(suggest_service, "_count_suggestions", archive_during_scan)
+    assert suggest_service.build_suggest_index()
+    assert suggest_index.ready
+    assert suggest_index.pending_max_id is None
+    assert suggest_index.lookup("me@", 1)[0]["count"] == 4
+
+    # Reported again after the build, e.g. by an overlapping writer batch
+    suggest_index.add_emails(rows)
+    assert suggest_index.lookup("me@", 1)[0]["count"] == 4
+    suggest_index.add_emails(archive(db, 1, first=4))
+    assert suggest_index.lookup("me@", 1)[0]["count"] == 5
+
+
+def test_failed_build_is_recorded_and_retried(db, suggest_index, monkeypatch):
+    archive(db, 2)
+    count_suggestions = suggest_service._count_suggestions
+
+    def fail(rows):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(suggest_service, "_count_suggestions", fail)
+    assert suggest_service.build_suggest_index() is False
+    assert suggest_service.suggest("me") == {"suggestions": [], "ready": False, "failed": True}
+
+    # Only the highest reported ID is kept while the index is not ready
+    suggest_index.add_emails(archive(db, 50, first=2))
+    assert suggest_index.pending_max_id == db.query(Email.id).order_by(Email.id.desc()).first()[0]
+
+    monkeypatch.setattr(suggest_service, "_count_suggestions", count_suggestions)
+    assert suggest_service.build_suggest_index()
+    result = suggest_service.suggest("me@")
+    assert result["ready"] and not result["failed"]
+    assert result["suggestions"][0]["count"] == 52
+
+
+def test_rebuild_replaces_the_index(db, suggest_index):
+    archive(db, 2)
+    assert suggest_service.build_suggest_index()
+    suggest_index.add_emails(archive(db, 1, first=2))
+    assert suggest_index.lookup("me@", 1)[0]["count"] == 3
+
+    # E.g. after import_archive.py wrote to the database
+    archive(db, 2, first=3)
+    assert suggest_service.build_suggest_index()
+    assert suggest_index.lookup("me@", 1)[0]["count"] == 5
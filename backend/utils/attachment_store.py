@@ -0,0 +1,107 @@
+# Utilities are used for more low-level operations needed by services or application initialization.
+
+# attachment_store.py keeps attachment payloads on disk, addressed by the SHA-256 of their content. Files live in a two-level sharded tree (ab/cd/abcd...) below ATTACHMENT_DIR, so identical attachments of different emails and accounts are stored once.
+
+import hashlib
+import os
+import tempfile
+import time
+from config.config import config
+
+# Leading bytes identifying the formats that are served inline
+MEDIA_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"\x00\x00\x01\x00", "image/x-icon"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"%PDF-", "application/pdf"),
+)
+
+
+def blob_path(sha256):
+    return os.path.join(config.ATTACHMENT_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+def store_blob(content):
+    """
+    Write content to the store unless it is already present and return its
+    SHA-256 hex digest and size. Writes go to a temporary file that is
+    renamed into place, so concurrent writers of the same content never
+    expose a partial file. A file that is already present has its
+    modification time updated, so it is not removed as unreferenced before
+    the caller's attachment row is committed, see remove_unreferenced_blobs.
+    """
+    sha256 = hashlib.sha256(content).hexdigest()
+    path = blob_path(sha256)
+    try:
+        os.utime(path)
+        return sha256, len(content)
+    except FileNotFoundError:
+        pass
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return sha256, len(content)
+
+
+def sniff_media_type(content, declared=None):
+    """
+    Detect the media type from the leading bytes of content. Falls back to
+    the declared type, or application/octet-stream, if the format is not
+    recognized.
+    """
+    head = content[:512]
+    for signature, media_type in MEDIA_SIGNATURES:
+        if head.startswith(signature):
+            return media_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    stripped = head.lstrip().lower()
+    if stripped.startswith(b"<svg") or (stripped.startswith(b"<?xml") and b"<svg" in head.lower()):
+        return "image/svg+xml"
+    return declared or "application/octet-stream"
+
+
+def blob_age(sha256):
+    """
+    Return the seconds since the file of sha256 was last written or reused,
+    or None if it does not exist.
+    """
+    try:
+        return time.time() - os.path.getmtime(blob_path(sha256))
+    except FileNotFoundError:
+        return None
+
+
+def list_blobs():
+    """
+    Yield the SHA-256 of every file in the store. Temporary files of writes
+    in progress are skipped.
+    """
+    for directory, _, filenames in os.walk(config.ATTACHMENT_DIR):
+        for filename in filenames:
+            if not filename.startswith(".tmp-"):
+                yield filename
+
+
+def remove_blob(sha256):
+    try:
+        os.unlink(blob_path(sha256))
+    except FileNotFoundError:
+        pass
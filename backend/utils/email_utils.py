@@ -1,9 +1,32 @@
 # Utilities are used for more low-level operations needed by services or application initialization.
 
 import email
+import hashlib
+import re
 from email.header import decode_header
-from email.utils import parsedate_to_datetime
+from email.utils import getaddresses, parsedate_to_datetime
 from datetime import datetime
+from html import unescape
+from dateutil import parser
+
+# Charsets that are decoded as UTF-8 without a codec lookup (ASCII is a subset)
+FAST_CHARSETS = {None, "utf-8", "utf8", "us-ascii", "ascii"}
+
+HTML_SKIP_PATTERN = re.compile(r"<(script|style|head)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+HTML_TAG_PATTERN = re.compile(r"<[^>]+>")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+SNIPPET_LENGTH = 160
+HTML_DETECT_PATTERN = re.compile(r"<(?!!)(?P<tag>[a-zA-Z]+).*?>", re.IGNORECASE)
+CODE_BLOCK_PATTERN = re.compile(r"```.*?```", re.DOTALL)
+
+
+def quote_mailbox(mailbox):
+    return '"' + mailbox.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def format_date(date_str):
+    date_obj = parser.parse(date_str)
+    return date_obj.strftime("%a, %d %b %Y %H:%M:%S")
 
 
 def parse_date(date_str):
@@ -28,26 +51,129 @@ def decode_header(header):
     return "".join(decoded_parts)
 
 
-def extract_body(email_message):
-    body = ""
-    if email_message.is_multipart():
-        for part in email_message.walk():
-            content_type = part.get_content_type()
-            if content_type in ["text/plain", "text/html"]:
-                payload = part.get_payload(decode=True)
-                charset = part.get_content_charset()
-                body_part = payload.decode(charset or "utf-8", errors="replace")
-                body_part = body_part.replace(
-                    "\r\n", "<br>"
-                )  # Replace escaped newlines with <br> tags
-                body += body_part
+def decode_payload(part):
+    payload = part.get_payload(decode=True) or b""
+    charset = part.get_content_charset()
+    # Fast path: most parts are ASCII or UTF-8, which need no codec lookup
+    if charset in FAST_CHARSETS:
+        return payload.decode("utf-8", errors="replace")
+    try:
+        return payload.decode(charset, errors="replace")
+    except LookupError:
+        return payload.decode("utf-8", errors="replace")
+
+
+def html_to_text(html):
+    """
+    Reduce an HTML body to plain text, used as the searchable text of
+    messages that have no text/plain alternative.
+    """
+    text = HTML_SKIP_PATTERN.sub(" ", html)
+    text = HTML_TAG_PATTERN.sub(" ", text)
+    text = unescape(text)
+    return WHITESPACE_PATTERN.sub(" ", text).strip()
+
+
+def decompose_message(email_message):
+    """
+    Split a message into its text body, HTML body, inline parts and
+    attachments while visiting every MIME part exactly once.
+    """
+    text_parts = []
+    html_parts = []
+    inline_parts = []
+    attachments = []
+
+    for part in email_message.walk():
+        if part.is_multipart():
+            continue
+
+        content_type = part.get_content_type()
+        disposition = part.get_content_disposition()
+        filename = part.get_filename()
+
+        if disposition != "attachment" and not filename:
+            if content_type == "text/plain":
+                text_parts.append(decode_payload(part))
+                continue
+            if content_type == "text/html":
+                html_parts.append(decode_payload(part))
+                continue
+
+        cid = part.get("Content-ID", "")  # Get the Content-ID (cid) value
+        if not filename and not cid:
+            # Nameless parts that are neither text nor referenced by a cid
+            # (e.g. calendar stubs) are not kept
+            continue
+
+        record = {
+            "filename": decode_filename(filename),
+            "content": part.get_payload(decode=True) or b"",
+            "content_type": content_type,
+            "cid": cid,
+        }
+        if disposition == "inline" or (cid and disposition != "attachment"):
+            inline_parts.append(record)
+        else:
+            attachments.append(record)
+
+    html_body = "\n".join(html_parts) or None
+    text_body = "\n".join(text_parts)
+    if not text_body and html_body:
+        text_body = html_to_text(html_body)
+
+    return {
+        "text_body": text_body,
+        "html_body": html_body,
+        "inline_parts": inline_parts,
+        "attachments": attachments,
+    }
+
+
+def make_snippet(text_body):
+    """
+    Return the first SNIPPET_LENGTH characters of a body with whitespace
+    collapsed, as shown in email lists.
+    """
+    if not text_body:
+        return ""
+    return WHITESPACE_PATTERN.sub(" ", text_body[: SNIPPET_LENGTH * 4]).strip()[:SNIPPET_LENGTH]
+
+
+def render_body(text_body, html_body=None):
+    """
+    Classify an email body and prepare it for display. Returns the content
+    type, the render-ready body and its size. Bodies archived before the
+    HTML alternative was stored separately are classified by their content.
+    """
+    body = html_body or text_body or ""
+    lowered = body.lower()
+
+    # Replace code blocks with <pre><code> tags
+    rendered = CODE_BLOCK_PATTERN.sub(
+        lambda match: f"<pre><code>{match.group()[3:-3]}</code></pre>", body
+    )
+
+    if (
+        html_body
+        or "<!doctype html>" in lowered
+        or "<html" in lowered
+        or HTML_DETECT_PATTERN.search(body) is not None
+    ):
+        content_type = "text/html"
+
+        # Extract the HTML portion of the email
+        lowered = rendered.lower()
+        html_start = lowered.find("<!doctype html>")
+        if html_start == -1:
+            html_start = lowered.find("<html")
+        html_end = lowered.rfind("</html>")
+        if html_start != -1 and html_end != -1:
+            rendered = rendered[html_start : html_end + len("</html>")]
     else:
-        payload = email_message.get_payload(decode=True)
-        charset = email_message.get_content_charset()
-        body = payload.decode(charset or "utf-8", errors="replace")
-        body = body.replace("\r\n", "<br>")  # Replace escaped newlines with <br> tags
+        content_type = "text/plain"
 
-    return body
+    return content_type, rendered, len(rendered)
 
 
 def decode_filename(filename):
@@ -59,3 +185,102 @@ def decode_filename(filename):
         for part, encoding in parts
     ]
     return "".join(decoded_parts)
+
+
+def compute_fingerprint(email_message):
+    """
+    Return the SHA-256 digest identifying a message. Only the Subject, From,
+    To, Date and Message-ID headers are used, so the fingerprint can also be
+    computed from the headers alone.
+    """
+    return fingerprint_from_fields(
+        decode_header(email_message["Subject"]),
+        decode_header(email_message["From"]),
+        decode_header(email_message["To"]),
+        email_message["Date"],
+        email_message["Message-ID"],
+    )
+
+
+def fingerprint_from_fields(subject, sender, recipients, date, message_id):
+    fingerprint_data = f"{subject}|{sender}|{recipients}|{date}|{message_id}"
+    return hashlib.sha256(fingerprint_data.encode()).digest()
+
+
+def fingerprint_from_headers(raw_headers):
+    return compute_fingerprint(email.message_from_bytes(raw_headers))
+
+
+# Address headers and the role their addresses are stored with
+ADDRESS_HEADERS = (("from", "From"), ("to", "To"), ("cc", "Cc"), ("bcc", "Bcc"))
+
+
+def parse_addresses(header_values):
+    """
+    Return the (display name, lowercase address) pairs of raw or decoded
+    address header values. Entries without an address are skipped.
+    """
+    addresses = []
+    for name, address in getaddresses([value for value in header_values if value]):
+        address = address.strip().lower()
+        if "@" not in address:
+            continue
+        addresses.append((decode_header(name).strip() or None, address))
+    return addresses
+
+
+def message_addresses(email_message):
+    """
+    Return the (role, display name, address) triples of the address headers
+    of a message, without duplicates.
+    """
+    seen = set()
+    addresses = []
+    for role, header in ADDRESS_HEADERS:
+        for name, address in parse_addresses(email_message.get_all(header, [])):
+            if (role, address) not in seen:
+                seen.add((role, address))
+                addresses.append((role, name, address))
+    return addresses
+
+
+def parse_raw_email(raw_email):
+    """
+    Parse a raw RFC 822 message into a plain dictionary holding the header
+    fields and addresses, text and HTML bodies, fingerprint and attachments
+    (including inline parts) needed to archive it.
+    """
+    email_message = email.message_from_bytes(raw_email)
+
+    subject = decode_header(email_message["Subject"])
+    sender = decode_header(email_message["From"])
+    recipients = decode_header(email_message["To"])
+    date = email_message["Date"]
+    fingerprint = fingerprint_from_fields(
+        subject, sender, recipients, date, email_message["Message-ID"]
+    )
+    parts = decompose_message(email_message)
+    content_type, rendered_body, body_size = render_body(
+        parts["text_body"], parts["html_body"]
+    )
+    attachments = [dict(attachment, inline=False) for attachment in parts["attachments"]]
+
+    return {
+        "subject": subject,
+        "sender": sender,
+        "recipients": recipients,
+        "date": parse_date(date),
+        "body": parts["text_body"],
+        "html_body": parts["html_body"],
+        "content_type": content_type,
+        "rendered_body": rendered_body,
+        "body_size": body_size,
+        "snippet": make_snippet(parts["text_body"]),
+        "size_bytes": len(raw_email),
+        # Inline parts belong to the HTML body and are not counted
+        "attachment_count": len(attachments),
+        "fingerprint": fingerprint,
+        "addresses": message_addresses(email_message),
+        "attachments": attachments
+        + [dict(part, inline=True) for part in parts["inline_parts"]],
+    }
@@ -0,0 +1,120 @@
+# Utilities are used for more low-level operations needed by services or application initialization.
+
+# pagination.py implements keyset (cursor) pagination. A page is requested relative to the sort value and ID of the last row of the previous page, so the database seeks into the matching (sort column, id) index instead of skipping OFFSET rows. NULL sort values are treated as smaller than any other value on every database.
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from sqlalchemy import tuple_
+
+
+def encode_cursor(data):
+    """
+    Encode a JSON-serializable dictionary as an opaque URL-safe cursor.
+    """
+    raw = json.dumps(data, separators=(",", ":"), default=_encode_value).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor created by encode_cursor. Returns None if the cursor is
+    malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    raise TypeError(f"Cannot encode {type(value).__name__} in a cursor")
+
+
+def decode_sort_value(value):
+    if isinstance(value, dict) and "$dt" in value:
+        return datetime.fromisoformat(value["$dt"])
+    return value
+
+
+def order_by_clauses(column, id_column, descending):
+    if descending:
+        return [column.desc().nulls_last(), id_column.desc()]
+    return [column.asc().nulls_first(), id_column.asc()]
+
+
+def keyset_segments(query, column, id_column, after, descending):
+    """
+    Split the rows of query that follow after, a (value, id) pair or None
+    for the start, into (query, order_by) segments that together produce
+    the order of order_by_clauses.
+
+    Rows with and without a sort value are read as two segments, so each is
+    a single index seek: non-NULL rows with a row-value comparison on
+    (column, id) and NULL rows by ID alone.
+    """
+    null_rows = query.filter(column.is_(None))
+    value_rows = query.filter(column.isnot(None))
+    id_order = id_column.desc() if descending else id_column.asc()
+    value_order = column.desc() if descending else column.asc()
+
+    if after is not None:
+        value, row_id = after
+        if value is None:
+            null_rows = null_rows.filter(
+                id_column < row_id if descending else id_column > row_id
+            )
+            if descending:
+                # NULL values sort last, nothing with a value follows
+                value_rows = None
+        else:
+            cursor_key = tuple_(column, id_column)
+            value_rows = value_rows.filter(
+                cursor_key < (value, row_id) if descending else cursor_key > (value, row_id)
+            )
+            if not descending:
+                # NULL values sort first and were all passed already
+                null_rows = None
+
+    segments = [
+        (value_rows, [value_order, id_order]),
+        (null_rows, [id_order]),
+    ]
+    if not descending:
+        segments.reverse()
+    return [(segment, ordering) for segment, ordering in segments if segment is not None]
+
+
+def fetch_keyset_page(query, column, id_column, after, descending, limit):
+    """
+    Return up to limit rows of query that follow after, a (value, id) pair
+    or None for the first page, in the order produced by order_by_clauses.
+    """
+    rows = []
+    for segment, ordering in keyset_segments(query, column, id_column, after, descending):
+        if len(rows) >= limit:
+            break
+        rows.extend(segment.order_by(*ordering).limit(limit - len(rows)).all())
+    return rows
+
+
+def iter_keyset_rows(query, column, id_column, after, descending, batch_size):
+    """
+    Yield lists of up to batch_size rows of query that follow after, in the
+    same order as fetch_keyset_page. Rows are fetched batch by batch from
+    a server-side cursor, so memory use does not grow with the result.
+    """
+    for segment, ordering in keyset_segments(query, column, id_column, after, descending):
+        batch = []
+        for row in segment.order_by(*ordering).yield_per(batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
@@ -0,0 +1,116 @@
+# Utilities are used for more low-level operations needed by services or application initialization.
+
+# search_query.py parses the search box syntax. Besides plain words, a query can contain quoted phrases, the operators from:, to:, subject:, account:, has:attachment, before: and after:, and a date range of the form "1 Jan 2024 - 31 Jan 2024". Text terms are matched by the full-text index, the other operators become column predicates, see search_service.
+
+import re
+from collections import namedtuple
+from datetime import timedelta
+from dateutil import parser
+
+# Search words are split on the same boundaries by every search backend
+WORD_PATTERN = re.compile(r"[^\W_]+", re.UNICODE)
+
+# An optional operator followed by a quoted phrase or a single token
+TOKEN_PATTERN = re.compile(r'(?:(?P<operator>[A-Za-z]+):)?(?:"(?P<phrase>[^"]*)"?|(?P<token>\S+))')
+
+DATE_RANGE_PATTERN = re.compile(r"(\d{1,2}\s+\w{3}\s+\d{4})\s*-\s*(\d{1,2}\s+\w{3}\s+\d{4})")
+
+# Operators restricting a text term to one indexed column
+TERM_COLUMNS = {
+    "from": "sender",
+    "to": "recipients",
+    "subject": "subject",
+}
+
+# A text term: the words must appear in this order in column, or in any
+# indexed column if column is None. With prefix, the last word may be the
+# beginning of a longer word.
+SearchTerm = namedtuple("SearchTerm", ["column", "words", "prefix"])
+
+
+def split_search_words(text):
+    return WORD_PATTERN.findall(text.lower())
+
+
+class ParsedQuery:
+    def __init__(self):
+        self.terms = []
+        self.account = None  # Account ID or address
+        self.has_attachment = False
+        self.after = None  # Inclusive
+        self.before = None  # Exclusive
+
+    def add_term(self, column, text, prefix):
+        words = split_search_words(text)
+        if words:
+            self.terms.append(SearchTerm(column, tuple(words), prefix))
+
+    def normalized(self):
+        """
+        Canonical form of the query, equal for queries that only differ in
+        case, spacing, punctuation or the order of their terms.
+        """
+        terms = sorted(
+            (term.column or "") + ':"' + " ".join(term.words) + '"' + ("*" if term.prefix else "")
+            for term in self.terms
+        )
+        parts = terms + [
+            f"account:{self.account or ''}",
+            f"has:{int(self.has_attachment)}",
+            f"after:{self.after.isoformat() if self.after else ''}",
+            f"before:{self.before.isoformat() if self.before else ''}",
+        ]
+        return " ".join(parts)
+
+    def is_empty(self):
+        return not (
+            self.terms
+            or self.account
+            or self.has_attachment
+            or self.after is not None
+            or self.before is not None
+        )
+
+
+def _parse_date(value):
+    try:
+        return parser.parse(value)
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_search_query(query):
+    """
+    Parse a search query into a ParsedQuery. Unquoted tokens match as
+    prefixes, so "inv" finds "invoice", while quoted phrases match whole
+    words only. Tokens with an unknown operator or an invalid date are
+    searched as text.
+    """
+    parsed = ParsedQuery()
+
+    date_range_match = DATE_RANGE_PATTERN.search(query)
+    if date_range_match:
+        start_date = _parse_date(date_range_match.group(1))
+        end_date = _parse_date(date_range_match.group(2))
+        if start_date is not None and end_date is not None:
+            parsed.after = start_date
+            parsed.before = end_date + timedelta(days=1)  # The end date is included
+            query = query[: date_range_match.start()] + " " + query[date_range_match.end() :]
+
+    for match in TOKEN_PATTERN.finditer(query):
+        operator = (match.group("operator") or "").lower()
+        quoted = match.group("phrase") is not None
+        value = match.group("phrase") if quoted else match.group("token")
+
+        if operator in TERM_COLUMNS:
+            parsed.add_term(TERM_COLUMNS[operator], value, not quoted)
+        elif operator == "account" and value.strip():
+            parsed.account = value.strip()
+        elif operator == "has" and value.lower() in ("attachment", "attachments"):
+            parsed.has_attachment = True
+        elif operator in ("before", "after") and _parse_date(value) is not None:
+            setattr(parsed, operator, _parse_date(value))
+        else:
+            parsed.add_term(None, match.group(0), not quoted)
+
+    return parsed
@@ -43,6 +43,8 @@ const ArchivePage = () => {
   const [sortBy, setSortBy] = useState("date");
   const [sortOrder, setSortOrder] = useState("desc");
   const [totalEmails, setTotalEmails] = useState(0);
+  const [cursors, setCursors] = useState({ next: null, prev: null });
+  const pageCursorRef = useRef(null);
   const [isDrawerOpen, setIsDrawerOpen] = useState(false);
   const [deleteConfirmationOpen, setDeleteConfirmationOpen] = useState(false);
   const [emailToDelete, setEmailToDelete] = useState(null);
@@ -59,11 +61,17 @@ const ArchivePage = () => {
           per_page: rowsPerPage,
           sort_by: sortBy,
           sort_order: sortOrder,
+          cursor: pageCursorRef.current || undefined,
         },
       });
+      pageCursorRef.current = null;
+      setCursors({
+        next: response.data.next_cursor,
+        prev: response.data.prev_cursor,
+      });
       const emailsWithAttachments = response.data.emails.map((email) => ({
         ...email,
-        hasAttachments: email.attachments && email.attachments.length > 0,
+        hasAttachments: email.has_attachments,
       }));
       setEmails(emailsWithAttachments);
       setTotalEmails(response.data.total_emails);
@@ -94,6 +102,14 @@ const ArchivePage = () => {
   }, [page]);
 
   const handleChangePage = (event, newPage) => {
+    // Neighbouring pages are fetched by cursor, other jumps fall back to the page number
+    if (newPage === page + 1) {
+      pageCursorRef.current = cursors.next;
+    } else if (newPage === page - 1) {
+      pageCursorRef.current = cursors.prev;
+    } else {
+      pageCursorRef.current = null;
+    }
     setPage(newPage);
   };
 
@@ -109,6 +125,7 @@ const ArchivePage = () => {
       setSortBy(column);
       setSortOrder("asc");
     }
+    setPage(0);
   };
 
   const handleViewDetails = (emailId) => {
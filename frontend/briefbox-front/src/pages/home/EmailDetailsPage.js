@@ -194,7 +194,7 @@ const EmailDetailsPage = () => {
       );
     }
 
-    const { body, content_type } = email;
+    const { id, body, content_type } = email;
 
     const emailContentStyle = {
       backgroundColor: "#1e1e1e",
@@ -221,7 +221,7 @@ const EmailDetailsPage = () => {
 
     const cidPattern = /cid:([^"]+)/g;
     const replacedBody = body.replace(cidPattern, (match, cid) => {
-      return `http://localhost:5050/attachments/get_inline_image/${encodeURIComponent(cid)}`;
+      return `http://localhost:5050/attachments/get_inline_image/${id}/${encodeURIComponent(cid)}`;
     });
 
     if (content_type === "text/plain") {